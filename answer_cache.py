@@ -0,0 +1,263 @@
+# =========================================
+# Кэш ответов GPT на повторяющиеся вопросы
+# =========================================
+# Ключ — нормализованный текст вопроса плюс «корзина» профиля (цель, пол,
+# есть ли ограничения по здоровью): одинаковый вопрос от людей с разными
+# целями должен получать разные ответы. Кроме точного совпадения кэш умеет
+# (если включено) находить близкие формулировки по сходству символьных
+# триграмм — но только при совпадении всех чисел в вопросе: «200 г гречки»
+# и «100 г гречки» похожи по триграммам, а ответы у них разные.
+# Кэшируются только самостоятельные вопросы (is_standalone_question):
+# уточнения к разговору («а если без сахара?») зависят от истории.
+
+import asyncio
+import math
+import re
+import sqlite3
+import time
+from collections import OrderedDict
+
+from cache import TTLCache
+from metrics import record_answer_cache
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_SPACES = re.compile(r"\s+")
+_NUMBER = re.compile(r"\d+")
+# Слова, отсылающие к предыдущим репликам: «а если его заменить», «расскажи подробнее»
+_CONTEXT_WORDS = {
+    "это", "этот", "эта", "эти", "этого", "этой", "этом", "этим", "эту", "этих",
+    "он", "она", "оно", "они", "его", "ее", "их", "ему", "ей", "им", "него", "нее", "них", "ним", "ней",
+    "там", "тогда", "тоже", "также", "еще", "выше", "предыдущий", "прошлый", "подробнее", "вариант", "варианты",
+}
+_FOLLOWUP_STARTS = {"а", "и", "но", "ну", "так", "тогда", "ок", "окей", "да", "нет"}
+MIN_STANDALONE_WORDS = 3
+_NO_RESTRICTIONS = {"", "нет", "нету", "не имею", "никаких", "нет ограничений", "без ограничений", "-"}
+
+
+def normalize_question(text: str) -> str:
+    text = text.lower().replace("ё", "е")
+    text = _PUNCTUATION.sub(" ", text)
+    return _SPACES.sub(" ", text).strip()
+
+
+def profile_bucket(params: dict) -> str:
+    goal = str(params.get("цель", "")).lower()
+    if "похуд" in goal:
+        goal_key = "loss"
+    elif "набор" in goal or "масс" in goal:
+        goal_key = "gain"
+    else:
+        goal_key = "other"
+    gender = str(params.get("пол", "")).lower()
+    gender_key = "m" if gender.startswith("м") else "f" if gender.startswith("ж") else "?"
+    health = normalize_question(str(params.get("здоровье", "")))
+    health_key = "0" if health in _NO_RESTRICTIONS else "1"
+    return f"{goal_key}|{gender_key}|{health_key}"
+
+
+def is_standalone_question(text: str) -> bool:
+    """Вопрос понятен без истории разговора: не короткий и без отсылок к сказанному."""
+    words = normalize_question(text).split()
+    if len(words) < MIN_STANDALONE_WORDS or words[0] in _FOLLOWUP_STARTS:
+        return False
+    return not any(word in _CONTEXT_WORDS for word in words)
+
+
+def numbers(text: str) -> tuple:
+    # По нормализованному тексту: "1,5 л" -> ("1", "5")
+    return tuple(_NUMBER.findall(text))
+
+
+def trigrams(text: str) -> frozenset:
+    padded = f"  {text} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class MemoryBackend:
+    """Хранилище ответов в памяти процесса (TTL + LRU)."""
+
+    def __init__(self, maxsize: int = 5000, ttl: float = 86400):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def get(self, key: str):
+        return self._cache.get(key)
+
+    async def set(self, key: str, answer: str):
+        self._cache.set(key, answer)
+
+    async def keys(self) -> list:
+        return []
+
+
+class SQLiteBackend:
+    """Хранилище ответов в локальном SQLite-файле: переживает перезапуск.
+
+    Запросы к файлу выполняются в пуле потоков, чтобы не блокировать event loop.
+    """
+
+    def __init__(self, path: str, maxsize: int = 50000, ttl: float = 86400):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = asyncio.Lock()
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            "key TEXT PRIMARY KEY, answer TEXT NOT NULL, expires_at REAL NOT NULL, used_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS answers_used_at ON answers (used_at)")
+        self._conn.commit()
+
+    def _get(self, key: str):
+        now = time.time()
+        row = self._conn.execute("SELECT answer, expires_at FROM answers WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if row[1] < now:
+            self._conn.execute("DELETE FROM answers WHERE key = ?", (key,))
+            self._conn.commit()
+            return None
+        self._conn.execute("UPDATE answers SET used_at = ? WHERE key = ?", (now, key))
+        self._conn.commit()
+        return row[0]
+
+    def _set(self, key: str, answer: str):
+        now = time.time()
+        self._conn.execute(
+            "INSERT OR REPLACE INTO answers (key, answer, expires_at, used_at) VALUES (?, ?, ?, ?)",
+            (key, answer, now + self.ttl, now),
+        )
+        self._conn.execute("DELETE FROM answers WHERE expires_at < ?", (now,))
+        self._conn.execute(
+            "DELETE FROM answers WHERE key IN ("
+            "SELECT key FROM answers ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+            (self.maxsize,),
+        )
+        self._conn.commit()
+
+    def _keys(self) -> list:
+        rows = self._conn.execute(
+            "SELECT key FROM answers WHERE expires_at >= ? ORDER BY used_at", (time.time(),)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    async def get(self, key: str):
+        async with self._lock:
+            return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, answer: str):
+        async with self._lock:
+            await asyncio.to_thread(self._set, key, answer)
+
+    async def keys(self) -> list:
+        async with self._lock:
+            return await asyncio.to_thread(self._keys)
+
+    def close(self):
+        self._conn.close()
+
+
+class AnswerCache:
+    """Поиск готового ответа: сначала точный ключ, затем (если
+    similarity_threshold > 0) самый похожий вопрос из той же корзины профиля.
+
+    Для приблизительного поиска держит в памяти инвертированный индекс
+    триграмм по последним index_size вопросам.
+    """
+
+    SEPARATOR = "\x1f"
+
+    def __init__(self, backend, similarity_threshold: float = 0.0, index_size: int = 5000):
+        self.backend = backend
+        self.similarity_threshold = similarity_threshold
+        self.index_size = index_size
+        self._grams = OrderedDict()
+        self._postings = {}
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    def key(self, text: str, params: dict) -> str:
+        return f"{profile_bucket(params)}{self.SEPARATOR}{normalize_question(text)}"
+
+    async def warm_up(self):
+        # Восстанавливает индекс похожих вопросов из персистентного хранилища
+        for key in await self.backend.keys():
+            self._index(key)
+
+    async def get(self, text: str, params: dict):
+        key = self.key(text, params)
+        answer = await self.backend.get(key)
+        if answer is not None:
+            self.hits += 1
+            record_answer_cache("hit")
+            return answer
+        if self.similarity_threshold > 0:
+            similar = self._most_similar(key)
+            if similar is not None:
+                answer = await self.backend.get(similar)
+                if answer is not None:
+                    self.near_hits += 1
+                    record_answer_cache("near_hit")
+                    return answer
+                self._forget(similar)
+        self.misses += 1
+        record_answer_cache("miss")
+        return None
+
+    async def set(self, text: str, params: dict, answer: str):
+        key = self.key(text, params)
+        await self.backend.set(key, answer)
+        if self.similarity_threshold > 0:
+            self._index(key)
+
+    def stats(self) -> dict:
+        total = self.hits + self.near_hits + self.misses
+        return {
+            "hits": self.hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.near_hits) / total if total else 0.0,
+        }
+
+    def _index(self, key: str):
+        if key in self._grams:
+            self._grams.move_to_end(key)
+            return
+        bucket, question = key.split(self.SEPARATOR, 1)
+        grams = trigrams(question)
+        self._grams[key] = grams
+        for gram in grams:
+            self._postings.setdefault((bucket, gram), set()).add(key)
+        while len(self._grams) > self.index_size:
+            self._forget(next(iter(self._grams)))
+
+    def _forget(self, key: str):
+        grams = self._grams.pop(key, None)
+        if grams is None:
+            return
+        bucket = key.split(self.SEPARATOR, 1)[0]
+        for gram in grams:
+            postings = self._postings.get((bucket, gram))
+            if postings is not None:
+                postings.discard(key)
+                if not postings:
+                    del self._postings[(bucket, gram)]
+
+    def _most_similar(self, key: str):
+        bucket, question = key.split(self.SEPARATOR, 1)
+        grams = trigrams(question)
+        digits = numbers(question)
+        overlap = {}
+        for gram in grams:
+            for candidate in self._postings.get((bucket, gram), ()):
+                overlap[candidate] = overlap.get(candidate, 0) + 1
+        best, best_score = None, 0.0
+        for candidate, common in overlap.items():
+            # Числа (граммы, вес, подходы) должны совпадать точно — триграммы их почти не различают
+            if numbers(candidate.split(self.SEPARATOR, 1)[1]) != digits:
+                continue
+            # Косинусная мера на множествах триграмм
+            score = common / math.sqrt(len(grams) * len(self._grams[candidate]))
+            if score > best_score:
+                best, best_score = candidate, score
+        return best if best_score >= self.similarity_threshold else None
@@ -0,0 +1,51 @@
+# =========================================
+# Микро-бенчмарк поиска продуктов в локальной таблице КБЖУ
+# =========================================
+# Запуск из корня репозитория:
+#   python benchmarks/bench_food_db.py [foods.csv] [повторов]
+
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from food_db import DEFAULT_PATH, FoodDatabase
+
+# Точные названия, синонимы, опечатки, составные блюда и неизвестные продукты
+QUERIES = [
+    ("гречка", "200 г"), ("Гречневая каша", "250 гр"), ("гречкка", "150"),
+    ("куриная грудка", "0,3 кг"), ("курина грутка", "200 г"), ("бананы", "2 шт"),
+    ("яблоко", "1"), ("молоко", "стакан"), ("оливковое масло", "1 ст.л."),
+    ("творог 5%", "180 г"), ("омлет из 2 яиц", "1 порция"), ("овсянка с бананом", "300 г"),
+    ("борщь", "тарелка"), ("котлета", "2 шт"), ("салат цезарь", "250 г"),
+    ("кефир", "500 мл"), ("пицца", "кусок"), ("шаурма", "1 шт"),
+    ("протеиновый коктейль", "1 порция"), ("неизвестное блюдо", "100 г"),
+]
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_PATH
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    started = time.perf_counter()
+    db = FoodDatabase.load(path)
+    load_ms = (time.perf_counter() - started) * 1000
+
+    for name, quantity in QUERIES:
+        result = db.nutrition(name, quantity)
+        found = f"{result['food']}, {result['grams']:g} г, {result['kcal']:g} ккал" if result else "не найдено"
+        print(f"{name!r:28} {quantity!r:12} -> {found}")
+
+    def run():
+        for name, quantity in QUERIES:
+            db.nutrition(name, quantity)
+
+    per_query = min(timeit.repeat(run, number=repeat, repeat=5)) / (repeat * len(QUERIES))
+    print(f"\nПродуктов: {len(db)}, загрузка: {load_ms:.1f} мс")
+    print(f"Поиск + КБЖУ: {per_query * 1e6:.2f} мкс/запрос, {1 / per_query:,.0f} запросов/с")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# =========================================
+# Рендер и разбиение длинных ответов GPT: прежний путь против formatting.py
+# =========================================
+# Запуск из корня репозитория:
+#   python benchmarks/bench_markdown.py [повторов]
+#
+# Прежний путь: fix_markdown_telegram + split_message и parse_mode=Markdown —
+# части, где разметка разрезана или не закрыта, Telegram отклоняет, и их
+# приходится отправлять повторно без разметки. Новый: render_chunks() в
+# entities (Telegram текст не разбирает) и to_markdown_v2() для сравнения.
+# Поток: ответ приходит токенами по ~4 символа, снимок раз в 25 токенов
+# (как правки сообщения раз в секунду).
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from formatting import MarkdownRenderer, render_chunks, render_markdown, to_markdown_v2
+
+
+# Прежняя реализация из formatting.py
+def fix_markdown_telegram(text: str) -> str:
+    lines = text.split("\n")
+    new_lines = []
+    for line in lines:
+        if line.startswith("### "):
+            heading = line[4:].strip()
+            line = f"**{heading}**"
+        elif line.startswith("## "):
+            heading = line[3:].strip()
+            line = f"**{heading}**"
+        new_lines.append(line)
+    return "\n".join(new_lines)
+
+
+def split_message(text, max_length=4096):
+    parts = []
+    while len(text) > max_length:
+        split_index = text.rfind("\n", 0, max_length)
+        if split_index == -1:
+            split_index = max_length
+        parts.append(text[:split_index])
+        text = text[split_index:].strip()
+    parts.append(text)
+    return parts
+
+
+_CODE = re.compile(r"```.*?```|`[^`\n]*`", re.S)
+
+
+def legacy_markdown_ok(part: str) -> bool:
+    # Грубая проверка парсера Markdown (legacy) в Telegram: маркеры вне кода должны быть парными
+    if part.count("```") % 2:
+        return False
+    outside = _CODE.sub("", part)
+    return outside.count("*") % 2 == 0 and outside.count("_") % 2 == 0 and outside.count("`") % 2 == 0
+
+
+SECTION = (
+    "### **{n}. Тренировка и питание**\n"
+    "Держи *умеренный* дефицит 300–500 ккал и **белок 1,6–2 г на кг веса** 💪. "
+    "Силовые 3 раза в неделю, между ними — ходьба 8–10 тысяч шагов и сон 7–9 часов.\n\n"
+    "- Разминка 5–10 минут, суставная гимнастика\n"
+    "- Присед, **жим гантелей лёжа, тяга к поясу** — 3×10–12\n"
+    "- Планка 3×40 с, `RPE 7–8` в последнем подходе\n"
+    "* Вода: 30–35 мл × вес, в жару больше\n\n"
+    "Пример расчёта:\n"
+    "```\nкалории = вес × 30 − 400\nбелок = вес × 1.8\n```\n"
+    "Подробнее — в [рекомендациях ВОЗ](https://www.who.int/ru/news-room/fact-sheets/detail/physical-activity). "
+    "Таблица норм — файл activity_guidelines.pdf. "
+    "Не гонись за быстрым результатом: **минус 0,5–1 кг в неделю — хороший темп, "
+    "а резкие ограничения чаще заканчиваются срывом и набором веса обратно**.\n\n"
+)
+
+
+def make_reply(sections: int) -> str:
+    return "".join(SECTION.format(n=n + 1) for n in range(sections))
+
+
+def stream(text: str, token: int = 4, snapshot_every: int = 25):
+    renderer = MarkdownRenderer()
+    for index, start in enumerate(range(0, len(text), token)):
+        renderer.feed(text[start:start + token])
+        if index % snapshot_every == 0:
+            renderer.snapshot()
+    return renderer.close()
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    print(f"{'ответ':>12}{'частей':>9}{'прежний, мс':>14}{'отклонено':>11}{'entities, мс':>14}"
+          f"{'MarkdownV2, мс':>16}{'поток, мс':>12}")
+    for sections in (2, 8, 24, 64):
+        reply = make_reply(sections)
+        legacy_parts = split_message(fix_markdown_telegram(reply))
+        rejected = sum(not legacy_markdown_ok(part) for part in legacy_parts)
+        parts = render_chunks(reply)
+        assert stream(reply) == render_markdown(reply)
+        legacy_ms = timeit.timeit(lambda: split_message(fix_markdown_telegram(reply)), number=repeat) / repeat * 1000
+        new_ms = timeit.timeit(lambda: render_chunks(reply), number=repeat) / repeat * 1000
+        v2_ms = timeit.timeit(lambda: [to_markdown_v2(part) for part in render_chunks(reply)], number=repeat) / repeat * 1000
+        stream_ms = timeit.timeit(lambda: stream(reply), number=max(1, repeat // 10)) / max(1, repeat // 10) * 1000
+        print(f"{len(reply):>10} с{len(parts):>9}{legacy_ms:>14.3f}{f'{rejected}/{len(legacy_parts)}':>11}"
+              f"{new_ms:>14.3f}{v2_ms:>16.3f}{stream_ms:>12.3f}")
+    print("\nотклонено — части прежнего пути с непарной разметкой: Telegram отвечает \"can't parse entities\" "
+          "(send_split_message такую часть терял, поток слал её вторым запросом без разметки).")
+
+
+if __name__ == "__main__":
+    main()
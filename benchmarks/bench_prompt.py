@@ -0,0 +1,112 @@
+# =========================================
+# Входные токены на ответ: прежняя сборка промпта против PromptBuilder
+# =========================================
+# Запуск из корня репозитория:
+#   python benchmarks/bench_prompt.py [messages.txt]
+# Без tiktoken токены оцениваются по символам (одинаково для обеих версий).
+# Прежний промпт — последние LIMIT реплик; PromptBuilder получает всю ещё не
+# сжатую историю и отбирает реплики по бюджету (PROMPT_HISTORY_BUDGET). К его
+# ответам добавлены токены фоновых запросов сводки при разных HISTORY_SUMMARY_BATCH.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prompt import SYSTEM_PROMPT, PromptBuilder, count_message_tokens, count_tokens, summary_messages
+
+
+# Прежняя реализация из bot.py: инструкция, параметры и history[-10:] в одном system-сообщении
+def build_gpt_messages(user_message: str, user_data: dict) -> list:
+    params = user_data.get("params", {})
+    history = user_data.get("history", [])
+    params_context = ""
+    if params:
+        params_context = (
+            f"Параметры пользователя: Пол: {params.get('пол', 'N/A')}, "
+            f"Вес: {params.get('вес', 'N/A')} кг, "
+            f"Рост: {params.get('рост', 'N/A')} см, "
+            f"Возраст: {params.get('возраст', 'N/A')}, "
+            f"Состояние здоровья: {params.get('здоровье', 'N/A')}, "
+            f"Цель: {params.get('цель', 'N/A')}."
+        )
+    history_context = ""
+    if history:
+        history_context = "\n".join([f"{msg['role']}: {msg['text']}" for msg in history[-10:]])
+    system_message = (
+        "Ты профессиональный AI-тренер, консультируешь по фитнесу, здоровью и питанию. "
+        f"{params_context} "
+        "Если пользователь спрашивает про вредные продукты (чипсы, фастфуд, алкоголь и т.д.), "
+        "объясняй возможный вред, указывай калорийность, давай советы по умеренности и предлагай более здоровые альтернативы. "
+        "Если пользователь спрашивает про здоровое питание, тренировки, баланс — помогай. "
+        "Если есть ограничения по здоровью, предлагай альтернативы. "
+        "Отвечай дружелюбно и понятно, используя Markdown, совместимый с Telegram. "
+        "Не используй заголовки вида '###'; вместо этого используй жирный текст. "
+        "Если вопрос не по теме, отвечай: 'Извини, я могу отвечать только на вопросы о фитнесе, тренировках и здоровом образе жизни.'"
+    )
+    messages = []
+    if history_context:
+        messages.append({"role": "system", "content": system_message + "\nИстория:\n" + history_context})
+    else:
+        messages.append({"role": "system", "content": system_message})
+    messages.append({"role": "user", "content": user_message})
+    return messages
+
+
+PARAMS = {"пол": "женщина", "вес": "68", "рост": "170", "возраст": "29", "здоровье": "здорова", "цель": "похудение"}
+ANSWER = (
+    "**Коротко:** держи дефицит 300–500 ккал, белок 1,6–2 г на кг веса, 3 силовые тренировки в неделю "
+    "и 8–10 тысяч шагов в день. Овощи в каждом приёме пищи, сладкое — не чаще пары раз в неделю. "
+) * 8
+
+
+LIMIT = 4
+# Сводка в проде пишется GPT; здесь — заглушка типичной длины (она же выход запроса сводки)
+SUMMARY = "Женщина 29 лет, цель — похудение, тренируется дома 3 раза в неделю, не ест молочное."
+
+
+def simulate(questions: list, batch: int, history_budget: int = None) -> tuple:
+    """Входные токены ответов и токены запросов сводки (вход + выход) при сводке раз в batch реплик."""
+    builder = PromptBuilder(budget=2000, history_budget=history_budget)
+    answers, summaries = [], []
+    history, summary = [], ""
+    for question in questions:
+        # Как в боте: вся ещё не сжатая история, лишнее отбрасывает бюджет PromptBuilder
+        user_data = {"params": PARAMS, "history": history, "history_summary": summary}
+        _, tokens = builder.build(question, user_data)
+        answers.append(tokens)
+        history += [{"role": "user", "text": question}, {"role": "bot", "text": ANSWER}]
+        # Как UserRepository.append_history: обрезка только при переполнении limit + batch
+        if len(history) > LIMIT + batch:
+            dropped, history = history[:-LIMIT], history[-LIMIT:]
+            summaries.append(count_message_tokens(summary_messages(summary, dropped)) + count_tokens(SUMMARY))
+            summary = SUMMARY
+    return answers, summaries
+
+
+def main():
+    corpus_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), "messages.txt")
+    with open(corpus_path, encoding="utf-8") as f:
+        questions = [line.strip() for line in f if line.strip()]
+
+    # Одинаковое окно истории для обеих версий: последние LIMIT реплик
+    legacy, history = [], []
+    for question in questions:
+        legacy.append(count_message_tokens(build_gpt_messages(question, {"params": PARAMS, "history": history[-LIMIT:]})))
+        history += [{"role": "user", "text": question}, {"role": "bot", "text": ANSWER}]
+    static = count_message_tokens([{"role": "system", "content": SYSTEM_PROMPT}])
+    print(f"Вопросов: {len(questions)}, окно истории {LIMIT} реплик")
+    print(f"{'вариант':<44}{'вход/ответ':>12}{'сводок':>9}{'сводка/ответ':>14}{'всего/ответ':>13}")
+    print(f"{'прежний промпт':<44}{sum(legacy) / len(legacy):>12.1f}{0:>9}{0:>14.1f}{sum(legacy) / len(legacy):>13.1f}")
+    for batch, history_budget in ((0, None), (8, None), (0, 800), (8, 800), (16, 800)):
+        answers, summaries = simulate(questions, batch, history_budget)
+        per_answer = sum(summaries) / len(answers)
+        total = (sum(answers) + sum(summaries)) / len(answers)
+        label = f"PromptBuilder, пачка {batch}, история {history_budget or 'без лимита'}"
+        print(f"{label:<44}{sum(answers) / len(answers):>12.1f}{len(summaries):>9}{per_answer:>14.1f}{total:>13.1f}")
+    print(f"\nОбщий статический префикс для кэша провайдера: {static} токенов")
+    print("сводка/ответ — вход и выход фоновых запросов сводки, поделённые на число ответов.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+# =========================================
+# Холодный старт бота: импорт, первый обработанный апдейт, память
+# =========================================
+# Запуск из корня репозитория:
+#   python benchmarks/bench_startup.py [запусков]
+#
+# Каждый замер — отдельный процесс (холодный импорт). Сеть не нужна: сессия
+# бота подменяется заглушкой, отвечающей на методы Bot API сразу. Для
+# сравнения с прежним поведением режим eager создаёт клиенты Firestore и
+# OpenAI синхронно сразу после импорта, как это делалось при загрузке bot.py.
+# Без ключа Firebase клиент Firestore в фоне не создастся — на замер
+# первого апдейта это не влияет, ошибка прогрева лишь попадёт в лог.
+
+import asyncio
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENV = {
+    "BOT_TOKEN": "123456:bench",
+    "OPENAI_API_KEY": "sk-bench",
+    "BOT_MODE": "polling",
+    "FSM_STORAGE": "memory",
+    "ANSWER_CACHE": "memory",
+}
+
+
+def rss_mb() -> float:
+    # Текущий RSS из /proc, иначе пиковый (ru_maxrss в КБ на Linux)
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def fake_update(update_id: int, text: str) -> dict:
+    user = {"id": 42, "is_bot": False, "first_name": "Bench"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": 42, "type": "private"},
+            "from": user,
+            "text": text,
+        },
+    }
+
+
+async def child(eager: bool) -> dict:
+    started = time.perf_counter()
+    import bot as app
+    import_s = time.perf_counter() - started
+
+    from aiogram import types
+    from aiogram.client.session.base import BaseSession
+    from aiogram.methods import SendMessage
+
+    class FakeSession(BaseSession):
+        async def make_request(self, bot, method, timeout=None):
+            if isinstance(method, SendMessage):
+                return types.Message(
+                    message_id=1, date=int(time.time()), text=method.text,
+                    chat=types.Chat(id=method.chat_id, type="private"),
+                )
+            return True
+
+        async def stream_content(self, *args, **kwargs):
+            yield b""
+
+        async def close(self):
+            pass
+
+    app.bot.session = FakeSession()
+
+    eager_s = 0.0
+    if eager:
+        clients_started = time.perf_counter()
+        for service in (app.db, app.openai_client):
+            try:
+                service.get()
+            except Exception as e:
+                print(f"eager: {type(e).__name__}: {e}", file=sys.stderr)
+        eager_s = time.perf_counter() - clients_started
+
+    await app.dp.emit_startup(dispatcher=app.dp, bot=app.bot, bots=[app.bot])
+    await app.dp.feed_update(app.bot, types.Update.model_validate(fake_update(1, "❓ FAQ")))
+    first_update_s = time.perf_counter() - started
+    return {
+        "import_s": import_s,
+        "eager_clients_s": eager_s,
+        "first_update_s": first_update_s,
+        "rss_mb": rss_mb(),
+    }
+
+
+def run_child(eager: bool) -> dict:
+    env = {**os.environ, **ENV}
+    args = [sys.executable, os.path.abspath(__file__), "--child"] + (["--eager"] if eager else [])
+    out = subprocess.run(args, cwd=ROOT, env=env, capture_output=True, text=True, timeout=120)
+    if out.returncode != 0:
+        raise RuntimeError(out.stderr[-2000:])
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def report(title: str, runs: list):
+    def median(key):
+        return statistics.median(run[key] for run in runs)
+
+    print(f"{title}:")
+    print(f"  импорт bot.py:             {median('import_s') * 1000:8.0f} мс")
+    if median("eager_clients_s"):
+        print(f"  создание клиентов:         {median('eager_clients_s') * 1000:8.0f} мс")
+    print(f"  до первого апдейта:        {median('first_update_s') * 1000:8.0f} мс")
+    print(f"  RSS после первого апдейта: {median('rss_mb'):8.1f} МБ")
+
+
+def main():
+    if "--child" in sys.argv:
+        sys.path.insert(0, ROOT)
+        result = asyncio.run(child("--eager" in sys.argv))
+        print(json.dumps(result))
+        sys.stdout.flush()
+        # Не ждём фоновый прогрев клиентов в потоках — замер уже готов
+        os._exit(0)
+
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    started = time.perf_counter()
+    import aiogram  # noqa: F401 — нижняя граница: без aiogram бот не запустится
+    print(f"импорт aiogram (в этом процессе): {(time.perf_counter() - started) * 1000:.0f} мс\n")
+    report("ленивые клиенты", [run_child(eager=False) for _ in range(runs)])
+    report("клиенты при импорте (прежний старт)", [run_child(eager=True) for _ in range(runs)])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# =========================================
+# Микро-бенчмарк фильтра темы: прежние функции против TopicMatcher
+# =========================================
+# Запуск из корня репозитория:
+#   python benchmarks/bench_topic_filter.py [messages.txt] [повторов]
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from topic_filter import BLACKLIST, WHITELIST, HEALTH_PATTERNS, TOPIC_PATTERNS, topic_matcher
+
+
+# Прежняя реализация из bot.py: списки собираются заново при каждом вызове,
+# текст переводится в нижний регистр в каждой функции и для каждого шаблона.
+def is_topic_by_regex(text: str) -> bool:
+    patterns = list(TOPIC_PATTERNS)
+    return any(re.search(pattern, text.lower()) for pattern in patterns)
+
+def is_health_restriction_question(text: str) -> bool:
+    patterns = list(HEALTH_PATTERNS)
+    return any(re.search(pattern, text.lower()) for pattern in patterns)
+
+def is_in_whitelist(text: str) -> bool:
+    whitelist = list(WHITELIST)
+    return any(word in text.lower() for word in whitelist)
+
+def is_in_blacklist(text: str) -> bool:
+    blacklist = list(BLACKLIST)
+    return any(word in text.lower() for word in blacklist)
+
+def legacy_category(text: str):
+    if is_in_blacklist(text):
+        return "blacklist"
+    if is_in_whitelist(text):
+        return "whitelist"
+    if is_health_restriction_question(text):
+        return "health"
+    if is_topic_by_regex(text):
+        return "topic"
+    return None
+
+
+def main():
+    corpus_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), "messages.txt")
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    with open(corpus_path, encoding="utf-8") as f:
+        messages = [line.strip() for line in f if line.strip()]
+
+    mismatches = [m for m in messages if legacy_category(m) != topic_matcher.match(m)]
+    for message in mismatches:
+        print(f"РАСХОЖДЕНИЕ: {message!r}: {legacy_category(message)} != {topic_matcher.match(message)}")
+
+    def run_legacy():
+        for message in messages:
+            legacy_category(message)
+
+    def run_matcher():
+        for message in messages:
+            topic_matcher.match(message)
+
+    legacy = min(timeit.repeat(run_legacy, number=repeat, repeat=5)) / (repeat * len(messages))
+    matcher = min(timeit.repeat(run_matcher, number=repeat, repeat=5)) / (repeat * len(messages))
+    print(f"Сообщений в корпусе: {len(messages)}, расхождений: {len(mismatches)}")
+    print(f"Прежние функции: {legacy * 1e6:8.2f} мкс/сообщение")
+    print(f"TopicMatcher:    {matcher * 1e6:8.2f} мкс/сообщение")
+    print(f"Ускорение:       {legacy / matcher:8.1f}x")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,21 +3,45 @@ import asyncio
 import os
 import re
 import difflib
-from datetime import datetime
+import json
+from contextlib import aclosing
+from datetime import datetime, timedelta
 
 from aiogram import Bot, Dispatcher, types
-from aiogram.filters import CommandStart, Command
+from aiogram.filters import CommandStart, Command, CommandObject, ExceptionTypeFilter
 from aiogram.enums import ParseMode
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ErrorEvent
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
-
-import firebase_admin
-from firebase_admin import credentials, firestore
-
-# Для работы с OpenAI (gpt-4o-mini)
-from openai import AsyncOpenAI
+from aiohttp import web
+
+from answer_cache import AnswerCache, MemoryBackend, SQLiteBackend, is_standalone_question
+from broadcast import BroadcastRunner, format_stats
+from cache import TTLCache
+from coalescer import MessageCoalescer
+from food_db import DEFAULT_PATH as FOOD_DB_DEFAULT_PATH, FoodDatabase, quantity_grams
+from food_estimator import ESTIMATE_PROMPT, FoodEstimator, parse_estimates
+from fsm_storage import FirestoreStorage, SQLiteStorage
+from history import HistoryWriter
+from llm import LLMScheduler, LLMUnavailableError, estimate_tokens
+from menu_router import MenuRouter
+from metrics import log_summary_every, record_answer_cache, record_tokens, record_topic_stage, registry as metrics
+from profiler import ProfilerRequestMiddleware, SlowUpdateProfiler
+from middlewares import ConcurrencyLimitMiddleware, MetricsMiddleware, ProfilerMiddleware
+from progress_analytics import ProgressAnalytics, parse_goal_weight
+from prompt import PromptBuilder, SummaryMemory, count_tokens, summary_messages
+from reminders import REMINDER_TITLES, ReminderScheduler, build_schedule, format_minute, local_times, parse_times
+from sender import RateLimitedSender
+from services import LazyService, create_firestore_client, create_openai_client
+from streaming import StreamingReply, send_markdown
+from topic_classifier import DecisionLog, load_stage
+from topic_filter import BLACKLIST_MATCH, topic_matcher
+from webhook import create_app
+from repository import (
+    UserRepository, ProgressRepository, DiaryRepository, FoodRepository, ReminderRepository,
+    BroadcastRepository, day_key,
+)
 
 # =========================================
 # 1. Константы окружения
@@ -25,36 +49,183 @@ from openai import AsyncOpenAI
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
+# Кэш документов users/{id} между апдейтами (0 — выключен). Запись сбрасывает его только
+# в своём процессе, поэтому для webhook (несколько воркеров за балансировщиком) по умолчанию
+# он выключен: документ читается один раз за апдейт. То же для кэша аналитики прогресса
+_MULTI_PROCESS = os.getenv("BOT_MODE", "polling") == "webhook"
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "0" if _MULTI_PROCESS else "30"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "2048"))
+PROGRESS_ANALYTICS_TTL = float(os.getenv("PROGRESS_ANALYTICS_TTL", "0" if _MULTI_PROCESS else "3600"))
+
+# Сколько реплик хранить в history (пары вопрос-ответ, старые уходят в сводку)
+# и как часто сбрасывать буфер истории (0 — писать сразу)
+HISTORY_LIMIT = 4
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "0"))
+# Сколько вытесненных реплик копить перед запросом сводки к GPT (0 — после каждого ответа)
+HISTORY_SUMMARY_BATCH = int(os.getenv("HISTORY_SUMMARY_BATCH", "8"))
+# Бюджет входных токенов на ответ и длина сводки старых реплик (символов)
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "2000"))
+# Из него на реплики истории (вся ещё не сжатая в сводку history, с конца)
+PROMPT_HISTORY_BUDGET = int(os.getenv("PROMPT_HISTORY_BUDGET", "800"))
+HISTORY_SUMMARY_CHARS = int(os.getenv("HISTORY_SUMMARY_CHARS", "600"))
+
+# Потоковые ответы GPT и минимальный интервал между правками сообщения (сек)
+GPT_STREAMING = os.getenv("GPT_STREAMING", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+
+# Локальный классификатор темы: файл модели, порог уверенности и журнал решений GPT для обучения
+TOPIC_MODEL_PATH = os.getenv("TOPIC_MODEL_PATH", "topic_model.npz")
+TOPIC_MODEL_THRESHOLD = float(os.getenv("TOPIC_MODEL_THRESHOLD", "0.85"))
+TOPIC_LOG_PATH = os.getenv("TOPIC_LOG_PATH")
+
+# Кэш ответов GPT: memory | sqlite | off, срок жизни (сек), размер и порог похожести (0 — только точное совпадение)
+ANSWER_CACHE = os.getenv("ANSWER_CACHE", "memory")
+ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", "answer_cache.sqlite3")
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "86400"))
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "5000"))
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0"))
+
+# Лимиты запросов к OpenAI: одновременные запросы, запросы и токены в минуту, таймаут и повторы
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "16"))
+OPENAI_RPM = float(os.getenv("OPENAI_RPM", "500"))
+OPENAI_TPM = float(os.getenv("OPENAI_TPM", "200000"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "4"))
+
+# Режим получения апдейтов: polling (по умолчанию, для локальной разработки) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT = int(os.getenv("PORT", "8080"))
+# Сколько апдейтов обрабатывается одновременно и сколько ждать их завершения при остановке
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "100"))
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "25"))
+# Сводка метрик в лог раз в столько секунд (0 — выключена); в режиме webhook они также на /metrics
+METRICS_LOG_INTERVAL = float(os.getenv("METRICS_LOG_INTERVAL", "300"))
+# Профилировщик медленных апдейтов: пишет в PROFILE_PATH апдейты дольше PROFILE_SLOW_SECONDS
+# (0 — выключен) и долю PROFILE_SAMPLE_RATE остальных; сводка — python profiler.py report
+PROFILE_SLOW_SECONDS = float(os.getenv("PROFILE_SLOW_SECONDS", "0"))
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_PATH = os.getenv("PROFILE_PATH", "profile.jsonl")
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "10"))
+
+# Окно склейки быстрых серий сообщений одного пользователя (сек, 0 — без ожидания)
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", "0.4"))
+
+# Локальная таблица КБЖУ продуктов (на 100 г) для записей дневника
+FOOD_DB_PATH = os.getenv("FOOD_DB_PATH", FOOD_DB_DEFAULT_PATH)
+# Незнакомые блюда: окно сбора пачки для GPT (сек) и размер пачки
+FOOD_ESTIMATE_WINDOW = float(os.getenv("FOOD_ESTIMATE_WINDOW", "2"))
+FOOD_ESTIMATE_BATCH = int(os.getenv("FOOD_ESTIMATE_BATCH", "30"))
+
+# Напоминания: часовой пояс пользователей (минуты от UTC, по умолчанию Москва),
+# окно предзагрузки расписаний (мин, не больше 30) и общий лимит отправки Telegram (сообщений/сек)
+REMINDER_TZ_OFFSET = int(os.getenv("REMINDER_TZ_OFFSET", "180"))
+REMINDER_WINDOW_MINUTES = int(os.getenv("REMINDER_WINDOW_MINUTES", "10"))
+# Рассылать ли напоминания из этого процесса: при нескольких воркерах webhook — только в одном,
+# иначе каждый отправит их заново (изменения расписаний он подхватит со следующим окном)
+REMINDERS_ENABLED = os.getenv("REMINDERS_ENABLED", "1") == "1"
+TELEGRAM_SEND_RATE = float(os.getenv("TELEGRAM_SEND_RATE", "30"))
+
+# Администраторы бота (id через запятую): им доступна команда /broadcast
+ADMIN_IDS = {admin_id.strip() for admin_id in os.getenv("ADMIN_IDS", "").split(",") if admin_id.strip()}
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "500"))
+
+# Хранилище состояний FSM: memory | sqlite | firestore (для нескольких процессов)
+FSM_STORAGE = os.getenv("FSM_STORAGE", "memory")
+FSM_SQLITE_PATH = os.getenv("FSM_SQLITE_PATH", "fsm.sqlite3")
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", "1"))
+
 # =========================================
 # 2. Firebase инициализация
 # =========================================
-firebase_credentials = os.getenv("FIREBASE_CREDENTIALS")
-if firebase_credentials:
-    with open("firebase.json", "w") as f:
-        f.write(firebase_credentials)
-else:
-    print("Внимание: переменная FIREBASE_CREDENTIALS не установлена!")
-
-cred = credentials.Certificate("firebase.json")
-firebase_admin.initialize_app(cred)
-db = firestore.client()
+# Ключ сервисного аккаунта читается из переменной окружения в память.
+# Клиент создаётся в фоне при старте (или при первом запросе к базе),
+# импорт google.cloud.firestore не задерживает запуск бота
+FIREBASE_CREDENTIALS = os.getenv("FIREBASE_CREDENTIALS")
+db = LazyService("Firestore", lambda: create_firestore_client(FIREBASE_CREDENTIALS))
+
+# Асинхронные репозитории: пользователи, прогресс, дневник питания
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL) if USER_CACHE_TTL > 0 else None
+user_repo = UserRepository(db, cache=user_cache)
+progress_repo = ProgressRepository(db, user_repo)
+progress_analytics = ProgressAnalytics(progress_repo, ttl=PROGRESS_ANALYTICS_TTL)
+diary_repo = DiaryRepository(db)
+food_repo = FoodRepository(db)
+reminder_repo = ReminderRepository(db)
+broadcast_repo = BroadcastRepository(db)
 
 # =========================================
 # 3. Инициализация OpenAI (GPT-4o-mini)
 # =========================================
-openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+# Клиент (и модуль openai) создаётся в фоне при старте или при первом запросе
+openai_client = LazyService("OpenAI", lambda: create_openai_client(OPENAI_API_KEY, OPENAI_TIMEOUT))
+llm_scheduler = LLMScheduler(
+    max_concurrency=OPENAI_MAX_CONCURRENCY,
+    requests_per_minute=OPENAI_RPM,
+    tokens_per_minute=OPENAI_TPM,
+    max_retries=OPENAI_MAX_RETRIES,
+)
 
 # =========================================
-# 4. (Удалено) Инициализация NLP-модели и функция nlp_is_fitness_topic
+# 4. Локальный классификатор темы (вместо NLP-модели)
 # =========================================
+topic_stage = load_stage(TOPIC_MODEL_PATH, TOPIC_MODEL_THRESHOLD)
+topic_decision_log = DecisionLog(TOPIC_LOG_PATH) if TOPIC_LOG_PATH else None
+
+# Кэш готовых ответов на популярные вопросы
+if ANSWER_CACHE == "sqlite":
+    answer_cache = AnswerCache(SQLiteBackend(ANSWER_CACHE_PATH, maxsize=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL),
+                               similarity_threshold=ANSWER_CACHE_SIMILARITY, index_size=ANSWER_CACHE_SIZE)
+elif ANSWER_CACHE == "memory":
+    answer_cache = AnswerCache(MemoryBackend(maxsize=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL),
+                               similarity_threshold=ANSWER_CACHE_SIMILARITY, index_size=ANSWER_CACHE_SIZE)
+else:
+    answer_cache = None
+
+# Таблица КБЖУ продуктов: записи дневника получают КБЖУ без запроса к GPT
+food_db = FoodDatabase.load(FOOD_DB_PATH)
 
 # =========================================
 # 5. Инициализация бота и Dispatcher
 # =========================================
 logging.basicConfig(level=logging.INFO)
 bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+if FSM_STORAGE == "firestore":
+    storage = FirestoreStorage(db, cache_ttl=FSM_CACHE_TTL)
+elif FSM_STORAGE == "sqlite":
+    storage = SQLiteStorage(FSM_SQLITE_PATH)
+else:
+    storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
+concurrency_limit = ConcurrencyLimitMiddleware(MAX_CONCURRENT_UPDATES)
+dp.update.outer_middleware(concurrency_limit)
+# Метрики — внутри лимита: время ожидания слота не входит в задержку хендлера
+metrics_middleware = MetricsMiddleware()
+dp.update.outer_middleware(metrics_middleware)
+dp.message.middleware(metrics_middleware)
+dp.callback_query.middleware(metrics_middleware)
+profiler = None
+if PROFILE_SLOW_SECONDS > 0 or PROFILE_SAMPLE_RATE > 0:
+    profiler = SlowUpdateProfiler(
+        PROFILE_PATH,
+        slow_threshold=PROFILE_SLOW_SECONDS if PROFILE_SLOW_SECONDS > 0 else float("inf"),
+        sample_rate=PROFILE_SAMPLE_RATE,
+        interval=PROFILE_INTERVAL_MS / 1000,
+    )
+    # После метрик: к концу апдейта имя хендлера и счётчики Firestore уже известны
+    dp.update.outer_middleware(ProfilerMiddleware(profiler))
+metrics.gauge("bot_updates_in_flight", "Апдейтов в обработке", lambda: concurrency_limit.in_flight)
+metrics.gauge("bot_openai_queue_depth", "Запросов к OpenAI в очереди", lambda: llm_scheduler.waiting)
+menu = MenuRouter()
+
+# Фоновые сообщения (напоминания) идут через общий лимит Telegram
+sender = RateLimitedSender(bot, rate=TELEGRAM_SEND_RATE)
+reminder_scheduler = ReminderScheduler(reminder_repo, sender, window_minutes=REMINDER_WINDOW_MINUTES)
+broadcast_runner = BroadcastRunner(user_repo, broadcast_repo, sender, page_size=BROADCAST_PAGE_SIZE)
+broadcast_tasks = set()
 
 # =========================================
 # 6. Клавиатуры
@@ -106,6 +277,7 @@ diary_actions_kb = ReplyKeyboardMarkup(
         [KeyboardButton(text="✏️ Изменить последнюю запись (питание)")],
         [KeyboardButton(text="🗑 Удалить последнюю запись (питание)")],
         [KeyboardButton(text="📌 Последние записи (питание)")],
+        [KeyboardButton(text="📅 Итоги за день и неделю (питание)")],
         [KeyboardButton(text="🔙 В главное меню")]
     ],
     resize_keyboard=True
@@ -153,6 +325,20 @@ confirm_delete_kb = ReplyKeyboardMarkup(
     resize_keyboard=True
 )
 
+# Клавиатура настроек напоминаний (кнопка -> вид напоминания)
+reminder_buttons = {
+    "🍽 Напоминания о еде": "meal",
+    "⚖️ Напоминание о взвешивании": "weigh",
+    "🏋️ Напоминание о тренировке": "workout",
+}
+notifications_kb = ReplyKeyboardMarkup(
+    keyboard=[[KeyboardButton(text=text)] for text in reminder_buttons] + [
+        [KeyboardButton(text="🔕 Отключить напоминания")],
+        [KeyboardButton(text="🔙 В главное меню")]
+    ],
+    resize_keyboard=True
+)
+
 # =========================================
 # 7. FSM состояния
 # =========================================
@@ -194,39 +380,13 @@ class DiaryDelete(StatesGroup):
     choosing_meal_category = State()        # Завтрак/Обед/Ужин/Перекус
     confirm_delete = State()                # Подтверждение удаления
 
+class NotificationSettings(StatesGroup):
+    waiting_for_times = State()             # Время напоминаний выбранного вида
+
 # =========================================
 # 8. Вспомогательные функции
 # =========================================
 
-def fix_markdown_telegram(text: str) -> str:
-    lines = text.split("\n")
-    new_lines = []
-    for line in lines:
-        if line.startswith("### "):
-            heading = line[4:].strip()
-            line = f"**{heading}**"
-        elif line.startswith("## "):
-            heading = line[3:].strip()
-            line = f"**{heading}**"
-        new_lines.append(line)
-    return "\n".join(new_lines)
-
-def split_message(text, max_length=4096):
-    parts = []
-    while len(text) > max_length:
-        split_index = text.rfind("\n", 0, max_length)
-        if split_index == -1:
-            split_index = max_length
-        parts.append(text[:split_index])
-        text = text[split_index:].strip()
-    parts.append(text)
-    return parts
-
-async def send_split_message(chat_id, text, parse_mode=None):
-    parts = split_message(text)
-    for part in parts:
-        await bot.send_message(chat_id, part, parse_mode=parse_mode)
-
 # Функции для фильтрации и GPT оставляем без изменений
 GREETINGS = [
     "привет", "здравствуйте", "добрый день", "доброе утро", "хай", "приветствую",
@@ -234,71 +394,36 @@ GREETINGS = [
     "hello", "hi", "hey", "good morning", "good day"
 ]
 
-def is_greeting_fuzzy(text: str) -> bool:
+# Длиннее этого текст не пройдёт cutoff=0.8 ни с одним приветствием —
+# такие сообщения (вопросы, записи дневника) не гоняем через difflib
+GREETING_MAX_LENGTH = int(max(len(g) for g in GREETINGS) * 1.5)
+
+def is_greeting_fuzzy(text) -> bool:
+    if not text:
+        return False
     text_lower = text.lower().strip()
+    if len(text_lower) > GREETING_MAX_LENGTH:
+        return False
     matches = difflib.get_close_matches(text_lower, GREETINGS, n=1, cutoff=0.8)
     return len(matches) > 0
 
-def is_topic_by_regex(text: str) -> bool:
-    patterns = [
-        r"\bфитнес\w*", r"\bтрениров\w*", r"\bтренир\w*", r"\bупражн\w*",
-        r"\bфизкульт\w*", r"\bспорт\w*", r"\bсил\w*", r"\bпресс\w*",
-        r"\bягодиц\w*", r"\bрастяжк\w*", r"\bвыносливост\w*",
-        r"\bдиет\w*", r"\bпитан\w*", r"\bкалор\w*", r"\bбелк\w*",
-        r"\bовощ\w*", r"\bфрукт\w*", r"\bменю\w*", r"\bрецепт\w*",
-        r"\bчипс\w*", r"\bснэк\w*", r"\bфастфуд\w*", r"\bбургер\w*", r"\bгамбургер\w*",
-        r"\bшаурм\w*", r"\bдонер\w*", r"\bкартофел[ьья]\s?фри", r"\bфри\b",
-        r"\bмайонез\w*", r"\bкетчуп\w*", r"\bсоус\w*", r"\bнаггетс\w*",
-        r"\bпицц\w*", r"\bролл\w*", r"\bсуши\w*", r"\bхотдог\w*",
-        r"\bсэндвич\w*", r"\bбутерброд\w*", r"\bджанкфуд\w*", r"\bjunk food\b",
-        r"\bгазиров\w*", r"\bкол\w*", r"\bпепси\w*", r"\bспрайт\w*",
-        r"\bэнергетик\w*", r"\bалкогол\w*", r"\bпиво\w*", r"\bвино\w*", r"\bспиртн\w*",
-        r"\bсухар\w*", r"\bшоколад\w*", r"\bконфет\w*", r"\bторт\w*", r"\bпирож\w*", r"\bвыпеч\w*",
-        r"\bмакарон\w*", r"\bпаста\w*", r"\bбулк\w*", r"\bхлеб\w*", r"\bбатон\w*"
-    ]
-    return any(re.search(pattern, text.lower()) for pattern in patterns)
-
-def is_health_restriction_question(text: str) -> bool:
-    patterns = [
-        r"\bне могу\b", r"\bиз-за\b", r"\bболит\b", r"\bболь\b",
-        r"\bограничен\b", r"\bнет возможности\b", r"\bпроблемы со\b", r"\bс травмой\b"
-    ]
-    return any(re.search(pattern, text.lower()) for pattern in patterns)
-
-def is_in_whitelist(text: str) -> bool:
-    whitelist = [
-        "привет", "здравствуйте", "добрый день", "доброе утро", "хай", "приветствую",
-        "как дела", "спасибо",
-        "фитнес", "тренировка", "упражнения", "бег", "кардио", "силовые", "плавание",
-        "йога", "стретчинг", "физкультура", "спорт", "здоровье", "диета", "питание",
-        "мотивация", "прогресс", "результат", "расписание", "план",
-        "физическая активность", "тренир", "кроссфит", "силовые тренировки"
-    ]
-    return any(word in text.lower() for word in whitelist)
-
-def is_in_blacklist(text: str) -> bool:
-    blacklist = [
-        "политика", "финансы", "экономика", "инвестиции", "бизнес", "коррупция",
-        "расизм", "религия", "война", "конфликт", "скандал", "новости", "забастовка",
-        "кино", "игры", "секс", "шоу", "телевидение", "мем", "юмор",
-        "кредит", "банки", "инфляция", "акции", "инвестиционный", "трейдинг"
-    ]
-    return any(word in text.lower() for word in blacklist)
-
-async def is_fitness_question_combined(user_id: str, text: str) -> bool:
-    if is_in_blacklist(text):
-        return False
-    if is_in_whitelist(text):
-        return True
-    if is_health_restriction_question(text):
-        return True
-    if is_topic_by_regex(text):
-        return True
-    return await is_topic_by_gpt(user_id, text)
-
-async def is_topic_by_gpt(user_id: str, text: str) -> bool:
-    doc = db.collection("users").document(user_id).get()
-    user_data = doc.to_dict() if doc.exists else {}
+async def is_fitness_question_combined(user_id: str, text: str, user_data: dict) -> bool:
+    category = topic_matcher.match(text)
+    if category is not None:
+        record_topic_stage(category)
+        return category != BLACKLIST_MATCH
+    if topic_stage is not None:
+        decision = topic_stage.decide(text)
+        if decision is not None:
+            record_topic_stage("model")
+            return decision
+    record_topic_stage("gpt")
+    decision = await is_topic_by_gpt(user_id, text, user_data)
+    if topic_decision_log is not None:
+        topic_decision_log.write(text, decision, "gpt")
+    return decision
+
+async def is_topic_by_gpt(user_id: str, text: str, user_data: dict) -> bool:
     history = user_data.get("history", [])
     history_context = "\n".join([f"{msg['role']}: {msg['text']}" for msg in history[-10:]])
     system_prompt = (
@@ -306,91 +431,130 @@ async def is_topic_by_gpt(user_id: str, text: str) -> bool:
         f"История диалога:\n{history_context}\n\n"
         "Относится ли следующий текст к теме фитнеса, тренировок, здоровью или питанию?\n"
     )
-    response = await openai_client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": text}
-        ],
-        temperature=0,
-        max_tokens=10
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": text}
+    ]
+    response = await llm_scheduler.run(
+        user_id,
+        lambda: openai_client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=messages,
+            temperature=0,
+            max_tokens=10
+        ),
+        tokens=estimate_tokens(messages, 10),
+        purpose="topic",
     )
     answer = response.choices[0].message.content.strip().lower()
     return "да" in answer
 
-async def update_history(user_id: str, role: str, text: str):
-    user_ref = db.collection("users").document(user_id)
-    doc = user_ref.get()
-    if doc.exists:
-        data = doc.to_dict()
-        history = data.get("history", [])
-    else:
-        history = []
-    history.append({"role": role, "text": text})
-    history = history[-5:]
-    user_ref.update({"history": history})
-
-# Обновляем progress_history (до 7 последних записей)
-async def update_progress_history(user_id: str):
-    progress_ref = db.collection("users").document(user_id).collection("progress")
-    docs = progress_ref.order_by("timestamp", direction=firestore.Query.DESCENDING).limit(7).stream()
-    history = []
-    for doc in docs:
-        data = doc.to_dict()
-        if isinstance(data.get("timestamp"), datetime):
-            data["timestamp_str"] = data["timestamp"].strftime("%d.%m.%Y %H:%M")
-        else:
-            data["timestamp_str"] = "N/A"
-        history.append(data)
-    db.collection("users").document(user_id).update({"progress_history": history})
+# КБЖУ незнакомых блюд: один запрос на пачку названий от всех пользователей
+async def estimate_foods_by_gpt(names: list) -> dict:
+    messages = [
+        {"role": "system", "content": ESTIMATE_PROMPT},
+        {"role": "user", "content": json.dumps(names, ensure_ascii=False)}
+    ]
+    max_tokens = 60 * len(names) + 50
+    response = await llm_scheduler.run(
+        "food-estimator",
+        lambda: openai_client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=messages,
+            temperature=0,
+            max_tokens=max_tokens,
+            response_format={"type": "json_object"}
+        ),
+        tokens=estimate_tokens(messages, max_tokens),
+        purpose="food",
+    )
+    return parse_estimates(names, response.choices[0].message.content)
 
-async def ask_gpt(user_id: str, user_message: str) -> str:
-    doc = db.collection("users").document(user_id).get()
-    user_data = doc.to_dict() if doc.exists else {}
-    params = user_data.get("params", {})
-    history = user_data.get("history", [])
-    params_context = ""
-    if params:
-        params_context = (
-            f"Параметры пользователя: Пол: {params.get('пол', 'N/A')}, "
-            f"Вес: {params.get('вес', 'N/A')} кг, "
-            f"Рост: {params.get('рост', 'N/A')} см, "
-            f"Возраст: {params.get('возраст', 'N/A')}, "
-            f"Состояние здоровья: {params.get('здоровье', 'N/A')}, "
-            f"Цель: {params.get('цель', 'N/A')}."
-        )
-    history_context = ""
-    if history:
-        history_context = "\n".join([f"{msg['role']}: {msg['text']}" for msg in history[-10:]])
-    system_message = (
-        "Ты профессиональный AI-тренер, консультируешь по фитнесу, здоровью и питанию. "
-        f"{params_context} "
-        "Если пользователь спрашивает про вредные продукты (чипсы, фастфуд, алкоголь и т.д.), "
-        "объясняй возможный вред, указывай калорийность, давай советы по умеренности и предлагай более здоровые альтернативы. "
-        "Если пользователь спрашивает про здоровое питание, тренировки, баланс — помогай. "
-        "Если есть ограничения по здоровью, предлагай альтернативы. "
-        "Отвечай дружелюбно и понятно, используя Markdown, совместимый с Telegram. "
-        "Не используй заголовки вида '###'; вместо этого используй жирный текст. "
-        "Если вопрос не по теме, отвечай: 'Извини, я могу отвечать только на вопросы о фитнесе, тренировках и здоровом образе жизни.'"
+food_estimator = FoodEstimator(
+    food_db, food_repo, diary_repo, estimate_foods_by_gpt,
+    window=FOOD_ESTIMATE_WINDOW, max_batch=FOOD_ESTIMATE_BATCH,
+)
+
+# Старые реплики сжимаются в history_summary, промпт собирается в пределах бюджета токенов
+prompt_builder = PromptBuilder(budget=PROMPT_TOKEN_BUDGET, history_budget=PROMPT_HISTORY_BUDGET)
+
+async def summarize_history(user_id: str, summary: str, entries: list) -> str:
+    messages = summary_messages(summary, entries, max_chars=HISTORY_SUMMARY_CHARS)
+    response = await llm_scheduler.run(
+        user_id,
+        lambda: openai_client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=messages,
+            temperature=0,
+            max_tokens=400
+        ),
+        tokens=estimate_tokens(messages, 400),
+        purpose="summary",
     )
-    messages = []
-    if history_context:
-        messages.append({"role": "system", "content": system_message + "\nИстория:\n" + history_context})
-    else:
-        messages.append({"role": "system", "content": system_message})
-    messages.append({"role": "user", "content": user_message})
-    response = await openai_client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=messages,
-        temperature=0.5,
-        max_tokens=1000
+    return response.choices[0].message.content.strip()[:HISTORY_SUMMARY_CHARS * 2]
+
+summary_memory = SummaryMemory(user_repo, summarize_history)
+history_writer = HistoryWriter(
+    user_repo, limit=HISTORY_LIMIT, flush_interval=HISTORY_FLUSH_INTERVAL, on_overflow=summary_memory.add,
+    summary_batch=HISTORY_SUMMARY_BATCH,
+)
+
+async def ask_gpt(user_id: str, user_message: str, user_data: dict) -> str:
+    messages, prompt_tokens = prompt_builder.build(user_message, user_data)
+    response = await llm_scheduler.run(
+        user_id,
+        lambda: openai_client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=messages,
+            temperature=0.5,
+            max_tokens=1000
+        ),
+        tokens=prompt_tokens + 1000,
     )
+    if response.usage:
+        logging.info("GPT: prompt_tokens=%s (оценка %s)", response.usage.prompt_tokens, prompt_tokens)
     return response.choices[0].message.content
 
+# Потоковый вариант: ответ показывается пользователю по мере генерации
+async def ask_gpt_stream(message: types.Message, text: str, user_data: dict) -> str:
+    messages, prompt_tokens = prompt_builder.build(text, user_data)
+    # В потоковом режиме usage не приходит — логируем оценку
+    logging.info("GPT: prompt_tokens≈%s", prompt_tokens)
+    stream = llm_scheduler.stream(
+        str(message.from_user.id),
+        lambda: openai_client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=messages,
+            temperature=0.5,
+            max_tokens=1000,
+            stream=True
+        ),
+        tokens=prompt_tokens + 1000,
+    )
+    reply = StreamingReply(message.bot, message.chat.id, edit_interval=STREAM_EDIT_INTERVAL)
+    # Слот OpenAI держится, пока поток не дочитан; aclosing отпускает его и при ошибке отправки
+    async with aclosing(stream):
+        try:
+            async for chunk in stream:
+                if chunk.choices:
+                    await reply.feed(chunk.choices[0].delta.content)
+        except LLMUnavailableError:
+            # Поток оборвался посреди ответа — оставляем пользователю уже показанную часть
+            await reply.finish()
+            raise
+    text = await reply.finish()
+    record_tokens("chat", str(message.from_user.id), prompt_tokens, count_tokens(text or ""))
+    return text
+
 # =========================================
 # 9. Хендлеры приветствий и стартовая команда
 # =========================================
 
+# Стикеры, фото, голосовые и т.п.: у них нет msg.text, дальше по цепочке их не пускаем
+@dp.message(lambda msg: msg.text is None)
+async def handle_non_text(message: types.Message):
+    await message.answer("Я понимаю только текстовые сообщения. Напиши, пожалуйста, вопрос текстом.")
+
 @dp.message(lambda msg: is_greeting_fuzzy(msg.text))
 async def greet(message: types.Message):
     await message.answer("Привет! Чем могу помочь по фитнесу, питанию и здоровому образу жизни?")
@@ -398,15 +562,14 @@ async def greet(message: types.Message):
 @dp.message(CommandStart())
 async def start(message: types.Message, state: FSMContext):
     user_id = str(message.from_user.id)
-    user_ref = db.collection("users").document(user_id)
-    doc = user_ref.get()
-    if not doc.exists or not doc.to_dict().get("params"):
-        user_ref.set({
+    user_data = await user_repo.get(user_id)
+    if not user_data.get("params"):
+        await user_repo.set(user_id, {
             "name": message.from_user.full_name,
             "telegram_id": user_id,
             "subscription": "free",
             "params": {}
-        }, merge=True)
+        })
         await message.answer(
             "Привет! Чтобы я мог давать персональные рекомендации, нужно задать несколько вопросов.\n"
             "Для начала, укажи свой **пол** (например: мужчина или женщина).",
@@ -420,11 +583,67 @@ async def start(message: types.Message, state: FSMContext):
             reply_markup=main_menu_kb
         )
 
+# Рассылка всем пользователям (только для ADMIN_IDS): /broadcast текст, /broadcast_resume
+def is_admin(message: types.Message) -> bool:
+    return str(message.from_user.id) in ADMIN_IDS
+
+async def run_broadcast(message: types.Message, broadcast_id: str):
+    status = await message.answer(f"📣 Рассылка {broadcast_id} запущена…")
+
+    async def report(stats: dict):
+        try:
+            await status.edit_text(f"📣 Рассылка {broadcast_id} идёт:\n{format_stats(stats)}")
+        except Exception:
+            pass
+
+    try:
+        stats = await broadcast_runner.run(broadcast_id, report=report)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        logging.exception("Рассылка %s прервана", broadcast_id)
+        await message.answer(f"⚠️ Рассылка {broadcast_id} прервана. Продолжить: /broadcast_resume")
+        return
+    await message.answer(f"✅ Рассылка {broadcast_id} завершена:\n{format_stats(stats)}")
+
+def start_broadcast(message: types.Message, broadcast_id: str):
+    task = asyncio.create_task(run_broadcast(message, broadcast_id))
+    broadcast_tasks.add(task)
+    task.add_done_callback(broadcast_tasks.discard)
+
+@dp.message(Command("broadcast"), is_admin)
+async def handle_broadcast(message: types.Message, command: CommandObject):
+    if not command.args:
+        await message.answer("Использование: /broadcast текст сообщения")
+        return
+    unfinished = await broadcast_repo.unfinished()
+    if unfinished:
+        await message.answer(f"Рассылка {unfinished['id']} ещё не завершена. Продолжить: /broadcast_resume")
+        return
+    broadcast_id = await broadcast_runner.create(command.args, str(message.from_user.id))
+    start_broadcast(message, broadcast_id)
+
+@dp.message(Command("broadcast_resume"), is_admin)
+async def handle_broadcast_resume(message: types.Message):
+    unfinished = await broadcast_repo.unfinished()
+    if not unfinished:
+        await message.answer("Незавершённых рассылок нет.")
+        return
+    if broadcast_runner.is_running(unfinished["id"]):
+        await message.answer(f"Рассылка {unfinished['id']} уже идёт.")
+        return
+    start_broadcast(message, unfinished["id"])
+
 # =========================================
 # 10. Основные хендлеры меню
 # =========================================
 
-@dp.message(lambda msg: msg.text == "📝 Изменить данные")
+# Все кнопки меню (@menu.button) обслуживает один хендлер: поиск в словаре вместо цепочки фильтров
+@dp.message(lambda msg: msg.text in menu)
+async def route_menu_button(message: types.Message, state: FSMContext):
+    await menu.dispatch(message, state)
+
+@menu.button("📝 Изменить данные")
 async def handle_change_data(message: types.Message, state: FSMContext):
     await message.answer(
         "Хорошо! Давай заново укажем параметры.\n\n"
@@ -433,7 +652,7 @@ async def handle_change_data(message: types.Message, state: FSMContext):
     )
     await state.set_state(Onboarding.waiting_for_gender)
 
-@dp.message(lambda msg: msg.text == "🎯 Изменить цель")
+@menu.button("🎯 Изменить цель")
 async def handle_change_goal(message: types.Message, state: FSMContext):
     await message.answer("Окей! Введи, пожалуйста, новую цель (например: похудение, набор массы и т.д.)")
     await state.set_state(ChangeGoal.waiting_for_new_goal)
@@ -442,15 +661,14 @@ async def handle_change_goal(message: types.Message, state: FSMContext):
 async def process_new_goal(message: types.Message, state: FSMContext):
     new_goal = message.text.strip()
     user_id = str(message.from_user.id)
-    db.collection("users").document(user_id).update({"params.цель": new_goal})
+    await user_repo.update(user_id, {"params.цель": new_goal})
     await message.answer(f"Цель обновлена на: *{new_goal}*", parse_mode=ParseMode.MARKDOWN)
     await state.clear()
 
-@dp.message(lambda msg: msg.text == "🍽 Посчитать КБЖУ")
+@menu.button("🍽 Посчитать КБЖУ")
 async def handle_calculate_kbju(message: types.Message):
     user_id = str(message.from_user.id)
-    doc = db.collection("users").document(user_id).get()
-    user_data = doc.to_dict() if doc.exists else {}
+    user_data = await user_repo.get(user_id)
     if not user_data or "params" not in user_data:
         await message.answer(
             "Чтобы рассчитать КБЖУ, мне нужны твои параметры. Пожалуйста, сначала задай их с помощью /start или '📝 Изменить данные'."
@@ -502,25 +720,48 @@ async def handle_calculate_kbju(message: types.Message):
     await message.answer(response_text)
 
 # Новый обработчик для кнопки "🔙 В главное меню"
-@dp.message(lambda msg: msg.text == "🔙 В главное меню")
+@menu.button("🔙 В главное меню")
 async def back_to_main_menu(message: types.Message, state: FSMContext):
     await state.clear()
     await message.answer("🔙 Ты вернулся в главное меню.", reply_markup=main_menu_kb)
 
 # =========================================
 # 11. Хендлеры для раздела "Мой прогресс"
-# (код без изменений)
 # =========================================
 
-@dp.message(lambda msg: msg.text == "📊 Мой прогресс")
+def format_progress_report(report: dict) -> str:
+    if not report.get("weighed"):
+        return ""
+    lines = [
+        f"⚖️ Вес: {report['last_weight']:g} кг (среднее за неделю {report['average_weight']:.1f} кг)",
+        f"📉 С {report['since'].strftime('%d.%m.%Y')}: {report['total_change']:+.1f} кг",
+    ]
+    if report["weekly_rate"] is not None:
+        lines.append(f"📈 Темп за последние 4 недели: {report['weekly_rate']:+.2f} кг/нед")
+    if report["goal_date"] is not None:
+        lines.append(f"🎯 {report['goal_weight']:g} кг при таком темпе — примерно к {report['goal_date'].strftime('%d.%m.%Y')}")
+    for name, (value, change) in report.get("measurements", {}).items():
+        lines.append(f"📏 {name.capitalize()}: {value:g} см" + (f" ({change:+g})" if change else ""))
+    if report["outliers"]:
+        dates = ", ".join(ts.strftime("%d.%m") for ts, _ in report["outliers"][-3:])
+        lines.append(f"⚠️ Похоже на опечатки, в расчёте не учтены: записи за {dates}")
+    return "\n".join(lines)
+
+@menu.button("📊 Мой прогресс")
 async def open_progress_menu(message: types.Message):
-    await message.answer("📊 Что хочешь сделать в разделе прогресса?", reply_markup=progress_actions_kb)
-
-@dp.message(lambda msg: msg.text == "📌 Мои параметры")
+    user_id = str(message.from_user.id)
+    user_data = await user_repo.get(user_id)
+    goal_weight = parse_goal_weight(user_data.get("params", {}).get("цель"))
+    report_text = format_progress_report(await progress_analytics.get(user_id, goal_weight))
+    text = "📊 Что хочешь сделать в разделе прогресса?"
+    if report_text:
+        text = f"{report_text}\n\n{text}"
+    await message.answer(text, reply_markup=progress_actions_kb)
+
+@menu.button("📌 Мои параметры")
 async def handle_my_params(message: types.Message):
     user_id = str(message.from_user.id)
-    doc = db.collection("users").document(user_id).get()
-    data = doc.to_dict() if doc.exists else {}
+    data = await user_repo.get(user_id)
     params = data.get("params", {})
     progress_history = data.get("progress_history", [])
     if progress_history:
@@ -543,21 +784,11 @@ async def handle_my_params(message: types.Message):
     )
     await message.answer(response_text, parse_mode=ParseMode.MARKDOWN, reply_markup=progress_actions_kb)
 
-@dp.message(lambda msg: msg.text == "📌 Последние показатели (прогресс)")
+@menu.button("📌 Последние показатели (прогресс)")
 async def last_progress_entry(message: types.Message):
     user_id = str(message.from_user.id)
-    progress_ref = db.collection("users").document(user_id).collection("progress")
-    docs = progress_ref.order_by("timestamp", direction=firestore.Query.DESCENDING).limit(7).stream()
-    entries = []
-    for doc in docs:
-        data = doc.to_dict()
-        if isinstance(data.get("timestamp"), datetime):
-            data["timestamp_str"] = data["timestamp"].strftime("%d.%m.%Y %H:%M")
-        else:
-            data["timestamp_str"] = "N/A"
-        entries.append(data)
+    entries = await progress_repo.history(user_id)
     if entries:
-        db.collection("users").document(user_id).update({"progress_history": entries})
         text = "📌 Твои последние показатели:\n"
         for entry in entries:
             text += f"• Вес: {entry.get('weight', 'не указан')} кг, Обхваты: {entry.get('measurements', 'не указаны')} ({entry.get('timestamp_str')})\n"
@@ -565,7 +796,7 @@ async def last_progress_entry(message: types.Message):
     else:
         await message.answer("❌ У тебя пока нет записей.", reply_markup=progress_actions_kb)
 
-@dp.message(lambda msg: msg.text == "✅ Добавить запись (прогресс)")
+@menu.button("✅ Добавить запись (прогресс)")
 async def add_progress_entry(message: types.Message, state: FSMContext):
     await message.answer("Введи свой текущий вес (кг):", reply_markup=cancel_kb)
     await state.set_state(ProgressEntry.waiting_for_weight)
@@ -596,26 +827,20 @@ async def process_progress_measurements(message: types.Message, state: FSMContex
         "measurements": measurements if measurements.lower() != "пропустить" else "не указаны"
     }
     user_id = str(message.from_user.id)
-    db.collection("users").document(user_id).collection("progress").add(entry)
-    db.collection("users").document(user_id).update({"params.вес": weight})
-    await update_progress_history(user_id)
+    await progress_repo.add(user_id, entry, user_fields={"params.вес": weight})
+    progress_analytics.invalidate(user_id)
     await message.answer(
         f"✅ Записал твои показатели:\n🗓 {timestamp.strftime('%d.%m.%Y %H:%M')}\n⚖️ Вес: {weight} кг\n📏 Обхваты: {entry['measurements']}",
         reply_markup=progress_actions_kb
     )
     await state.clear()
 
-@dp.message(lambda msg: msg.text == "✏️ Изменить последнюю запись (прогресс)")
+@menu.button("✏️ Изменить последнюю запись (прогресс)")
 async def edit_last_progress_entry(message: types.Message, state: FSMContext):
     user_id = str(message.from_user.id)
-    progress_ref = db.collection("users").document(user_id).collection("progress")
-    docs = progress_ref.order_by("timestamp", direction=firestore.Query.DESCENDING).limit(1).stream()
-    last_entry = None
-    for doc in docs:
-        last_entry = doc
-        break
+    last_entry = await progress_repo.last(user_id)
     if last_entry:
-        await state.update_data(last_doc_id=last_entry.id)
+        await state.update_data(last_doc_id=last_entry["id"])
         await message.answer("Введи новый вес (кг):", reply_markup=cancel_kb)
         await state.set_state(EditProgressEntry.waiting_for_new_weight)
     else:
@@ -641,37 +866,26 @@ async def update_progress_measurements(message: types.Message, state: FSMContext
     data = await state.get_data()
     new_weight = data.get("new_weight")
     user_id = str(message.from_user.id)
-    progress_ref = db.collection("users").document(user_id).collection("progress")
-    docs = progress_ref.order_by("timestamp", direction=firestore.Query.DESCENDING).limit(1).stream()
-    updated = False
-    for doc in docs:
-        doc.reference.update({
+    last_entry = await progress_repo.last(user_id)
+    if last_entry:
+        await progress_repo.update(user_id, last_entry["id"], {
             "weight": new_weight,
             "measurements": new_measurements,
             "timestamp": datetime.now()
-        })
-        updated = True
-        break
-    if updated:
-        db.collection("users").document(user_id).update({"params.вес": new_weight})
-        await update_progress_history(user_id)
+        }, user_fields={"params.вес": new_weight})
+        progress_analytics.invalidate(user_id)
         await message.answer(f"✅ Запись изменена на:\n⚖️ Вес: {new_weight} кг\n📏 Обхваты: {new_measurements}", reply_markup=progress_actions_kb)
     else:
         await message.answer("❌ Нет записи для изменения.", reply_markup=progress_actions_kb)
     await state.clear()
 
-@dp.message(lambda msg: msg.text == "🗑 Удалить последнюю запись (прогресс)")
+@menu.button("🗑 Удалить последнюю запись (прогресс)")
 async def delete_last_progress_entry(message: types.Message):
     user_id = str(message.from_user.id)
-    progress_ref = db.collection("users").document(user_id).collection("progress")
-    docs = progress_ref.order_by("timestamp", direction=firestore.Query.DESCENDING).limit(1).stream()
-    deleted = False
-    for doc in docs:
-        doc.reference.delete()
-        deleted = True
-        break
-    if deleted:
-        await update_progress_history(user_id)
+    last_entry = await progress_repo.last(user_id)
+    if last_entry:
+        await progress_repo.delete(user_id, last_entry["id"])
+        progress_analytics.invalidate(user_id)
         await message.answer("🗑 Последняя запись удалена.", reply_markup=progress_actions_kb)
     else:
         await message.answer("❌ Нет записей для удаления.", reply_markup=progress_actions_kb)
@@ -680,23 +894,21 @@ async def delete_last_progress_entry(message: types.Message):
 # 12. Хендлеры для раздела "Дневник питания"
 # =========================================
 
-@dp.message(lambda msg: msg.text == "📒 Дневник питания")
+@menu.button("📒 Дневник питания")
 async def diary_menu(message: types.Message):
     await message.answer("📒 Что хочешь сделать в дневнике питания?", reply_markup=diary_actions_kb)
 
 # Обработчик для вывода последних записей (сортировка по типам приёмов пищи)
 meal_order = ["завтрак", "обед", "ужин", "перекус"]
 
-@dp.message(lambda msg: msg.text == "📌 Последние записи (питание)")
+@menu.button("📌 Последние записи (питание)")
 async def last_diary_entries(message: types.Message):
     user_id = str(message.from_user.id)
-    diary_ref = db.collection("users").document(user_id).collection("diary")
-    docs = diary_ref.order_by("timestamp", direction=firestore.Query.DESCENDING).limit(20).stream()
+    docs = await diary_repo.latest(user_id, limit=20)
     
     categorized_entries = {"завтрак": [], "обед": [], "ужин": [], "перекус": []}
     
-    for doc in docs:
-        data = doc.to_dict()
+    for data in docs:
         timestamp_str = data["timestamp"].strftime("%d.%m.%Y %H:%M")
         meal_type = data.get("meal_type", "перекус")
         entry_text = f"• {data['meal_name']} - {data['quantity']} ({timestamp_str})"
@@ -716,8 +928,51 @@ async def last_diary_entries(message: types.Message):
     else:
         await message.answer("❌ У тебя пока нет записей.", reply_markup=diary_actions_kb)
 
+# Итоги по дням читаются из сводок users/{id}/daily — по документу на день
+def format_daily_totals(summary: dict) -> str:
+    totals = summary.get("totals") or {}
+    if not totals:
+        return ""
+    return format_kbju(totals)
+
+def format_kbju(nutrition: dict) -> str:
+    return (
+        f"{int(nutrition.get('kcal', 0))} ккал, Б {int(nutrition.get('protein', 0))} / "
+        f"Ж {int(nutrition.get('fat', 0))} / У {int(nutrition.get('carbs', 0))} г"
+    )
+
+@menu.button("📅 Итоги за день и неделю (питание)")
+async def diary_daily_summary(message: types.Message):
+    user_id = str(message.from_user.id)
+    today = datetime.now()
+    days = [day_key(today - timedelta(days=i)) for i in range(7)]
+    summaries = await diary_repo.daily_summaries(user_id, days)
+    today_summary = summaries.get(days[0], {})
+    # Записи, сделанные до появления сводок, могли увести счётчик в минус при удалении
+    if today_summary.get("entries", 0) > 0:
+        meals = today_summary.get("meals", {})
+        meals_text = ", ".join(f"{meal}: {meals[meal]}" for meal in meal_order if meals.get(meal))
+        text = f"📅 Сегодня: {today_summary['entries']} записей ({meals_text})"
+        totals_text = format_daily_totals(today_summary)
+        if totals_text:
+            text += f"\n🔥 {totals_text}"
+    else:
+        text = "📅 Сегодня записей пока нет."
+    week_lines = []
+    for day in days:
+        summary = summaries.get(day, {})
+        if summary.get("entries", 0) > 0:
+            line = f"• {datetime.strptime(day, '%Y-%m-%d').strftime('%d.%m')}: {summary['entries']} записей"
+            totals_text = format_daily_totals(summary)
+            if totals_text:
+                line += f", {totals_text}"
+            week_lines.append(line)
+    if week_lines:
+        text += "\n\n🗓 За 7 дней:\n" + "\n".join(week_lines)
+    await message.answer(text, reply_markup=diary_actions_kb)
+
 # Добавление записи (питание)
-@dp.message(lambda msg: msg.text == "✅ Добавить запись (питание)")
+@menu.button("✅ Добавить запись (питание)")
 async def add_diary_entry(message: types.Message, state: FSMContext):
     await message.answer("Выбери тип приема пищи:", reply_markup=meal_category_kb)
     await state.set_state(DiaryEntry.choosing_meal_type)
@@ -744,29 +999,40 @@ async def process_meal_name(message: types.Message, state: FSMContext):
     await message.answer("Теперь укажи количество (например, 250 г):", reply_markup=cancel_kb)
     await state.set_state(DiaryEntry.waiting_for_quantity)
 
+QUANTITY_HINT = "Не понял количество 🤔 Укажи его числом с единицей, например: 250 г, 2 шт, полстакана."
+
 @dp.message(DiaryEntry.waiting_for_quantity)
 async def process_quantity(message: types.Message, state: FSMContext):
     if message.text == "🔙 Отмена":
         await message.answer("Добавление записи отменено.", reply_markup=diary_actions_kb)
         await state.clear()
         return
+    if quantity_grams(message.text) is None:
+        # Без количества КБЖУ не посчитать ни по таблице, ни через GPT — просим ввести заново
+        await message.answer(QUANTITY_HINT, reply_markup=cancel_kb)
+        return
     data = await state.get_data()
     meal_entry = {
         "meal_type": data["meal_type"],
         "meal_name": data["meal_name"],
         "quantity": message.text,
-        "timestamp": datetime.now()
+        "timestamp": datetime.now(),
+        "nutrition": food_estimator.nutrition(data["meal_name"], message.text)
     }
     user_id = str(message.from_user.id)
-    db.collection("users").document(user_id).collection("diary").add(meal_entry)
-    await message.answer(
-        f"✅ Запись добавлена:\n{data['meal_type'].capitalize()}: {data['meal_name']} — {message.text}",
-        reply_markup=diary_actions_kb
-    )
+    entry_id = await diary_repo.add(user_id, meal_entry)
+    if meal_entry["nutrition"] is None:
+        food_estimator.submit(user_id, entry_id, data["meal_name"], message.text)
+    text = f"✅ Запись добавлена:\n{data['meal_type'].capitalize()}: {data['meal_name']} — {message.text}"
+    if meal_entry["nutrition"]:
+        text += f"\n🔥 {format_kbju(meal_entry['nutrition'])}"
+    elif food_db.lookup(data["meal_name"]) is None:
+        text += "\n🔥 КБЖУ этого блюда посчитаю чуть позже — оно появится в итогах дня."
+    await message.answer(text, reply_markup=diary_actions_kb)
     await state.clear()
 
 # Изменение последней записи (питание)
-@dp.message(lambda msg: msg.text == "✏️ Изменить последнюю запись (питание)")
+@menu.button("✏️ Изменить последнюю запись (питание)")
 async def edit_diary_entry(message: types.Message, state: FSMContext):
     await message.answer("В каком разделе изменить последнюю запись?", reply_markup=meal_category_kb)
     await state.set_state(DiaryEdit.choosing_meal_category)
@@ -779,19 +1045,19 @@ async def choose_meal_to_edit(message: types.Message, state: FSMContext):
         return
     meal_type = message.text.split()[1].lower()
     user_id = str(message.from_user.id)
-    diary_ref = db.collection("users").document(user_id).collection("diary")
-    last_entry = None
-    for doc in diary_ref.where("meal_type", "==", meal_type).order_by("timestamp", direction=firestore.Query.DESCENDING).limit(1).stream():
-        last_entry = doc
-        break
+    last_entry = await diary_repo.last_by_type(user_id, meal_type)
     if not last_entry:
         await message.answer("❌ Нет записей для изменения в этом разделе.", reply_markup=diary_actions_kb)
         await state.clear()
         return
-    entry_data = last_entry.to_dict()
-    await state.update_data(entry_id=last_entry.id, meal_type=meal_type)
+    await state.update_data(
+        entry_id=last_entry["id"],
+        meal_type=meal_type,
+        meal_name=last_entry["meal_name"],
+        quantity=last_entry["quantity"]
+    )
     await message.answer(
-        f"Последняя запись ({meal_type.capitalize()}):\n{entry_data['meal_name']} — {entry_data['quantity']}\n\nЧто хочешь изменить?",
+        f"Последняя запись ({meal_type.capitalize()}):\n{last_entry['meal_name']} — {last_entry['quantity']}\n\nЧто хочешь изменить?",
         reply_markup=meal_edit_field_kb
     )
     await state.set_state(DiaryEdit.choosing_field_to_edit)
@@ -827,16 +1093,26 @@ async def process_new_value(message: types.Message, state: FSMContext):
     data = await state.get_data()
     entry_id = data.get("entry_id")
     field_to_edit = data.get("field_to_edit")
+    if field_to_edit == "quantity" and quantity_grams(new_value) is None:
+        await message.answer(QUANTITY_HINT, reply_markup=cancel_kb)
+        return
     user_id = str(message.from_user.id)
-    db.collection("users").document(user_id).collection("diary").document(entry_id).update({
+    fields = {
         field_to_edit: new_value,
         "timestamp": datetime.now()
-    })
+    }
+    # Новое название или количество — пересчитываем КБЖУ записи
+    if field_to_edit in ("meal_name", "quantity"):
+        entry = {"meal_name": data.get("meal_name", ""), "quantity": data.get("quantity", ""), field_to_edit: new_value}
+        fields["nutrition"] = food_estimator.nutrition(entry["meal_name"], entry["quantity"])
+    await diary_repo.update(user_id, entry_id, fields)
+    if "nutrition" in fields and fields["nutrition"] is None:
+        food_estimator.submit(user_id, entry_id, entry["meal_name"], entry["quantity"])
     await message.answer("✅ Запись успешно обновлена.", reply_markup=diary_actions_kb)
     await state.clear()
 
 # Удаление последней записи (питание)
-@dp.message(lambda msg: msg.text == "🗑 Удалить последнюю запись (питание)")
+@menu.button("🗑 Удалить последнюю запись (питание)")
 async def delete_diary_entry(message: types.Message, state: FSMContext):
     await message.answer("Из какого раздела удалить последнюю запись?", reply_markup=meal_category_kb)
     await state.set_state(DiaryDelete.choosing_meal_category)
@@ -849,19 +1125,14 @@ async def confirm_delete_entry(message: types.Message, state: FSMContext):
         return
     meal_type = message.text.split()[1].lower()
     user_id = str(message.from_user.id)
-    diary_ref = db.collection("users").document(user_id).collection("diary")
-    last_entry = None
-    for doc in diary_ref.where("meal_type", "==", meal_type).order_by("timestamp", direction=firestore.Query.DESCENDING).limit(1).stream():
-        last_entry = doc
-        break
+    last_entry = await diary_repo.last_by_type(user_id, meal_type)
     if not last_entry:
         await message.answer("❌ Нет записей для удаления в этом разделе.", reply_markup=diary_actions_kb)
         await state.clear()
         return
-    entry_data = last_entry.to_dict()
-    await state.update_data(entry_id=last_entry.id, meal_type=meal_type)
+    await state.update_data(entry_id=last_entry["id"], meal_type=meal_type)
     await message.answer(
-        f"Ты точно хочешь удалить последнюю запись в разделе {meal_type.capitalize()}?\n{entry_data['meal_name']} — {entry_data['quantity']}",
+        f"Ты точно хочешь удалить последнюю запись в разделе {meal_type.capitalize()}?\n{last_entry['meal_name']} — {last_entry['quantity']}",
         reply_markup=confirm_delete_kb
     )
     await state.set_state(DiaryDelete.confirm_delete)
@@ -871,7 +1142,7 @@ async def delete_confirmed(message: types.Message, state: FSMContext):
     if message.text == "✅ Да, удалить":
         data = await state.get_data()
         user_id = str(message.from_user.id)
-        db.collection("users").document(user_id).collection("diary").document(data["entry_id"]).delete()
+        await diary_repo.delete(user_id, data["entry_id"])
         await message.answer("🗑 Запись удалена.", reply_markup=diary_actions_kb)
     else:
         await message.answer("Удаление отменено.", reply_markup=diary_actions_kb)
@@ -881,15 +1152,73 @@ async def delete_confirmed(message: types.Message, state: FSMContext):
 # 13. Хендлеры для разделов "Планы тренировок", "Настройки уведомлений", "FAQ", "Техподдержка", "Подписка"
 # =========================================
 
-@dp.message(lambda msg: msg.text == "🏋️ Планы тренировок")
+@menu.button("🏋️ Планы тренировок")
 async def handle_training_plans(message: types.Message):
     await message.answer("Скоро здесь будут твои персональные планы тренировок! 🏋️‍♂️📆")
 
-@dp.message(lambda msg: msg.text == "🔔 Настройки уведомлений")
+def format_reminders(schedule: dict) -> str:
+    times = local_times(schedule)
+    lines = []
+    for kind, title in REMINDER_TITLES.items():
+        minutes = times.get(kind)
+        lines.append(f"• {title}: {', '.join(format_minute(m) for m in minutes) if minutes else 'выключено'}")
+    return "\n".join(lines)
+
+@menu.button("🔔 Настройки уведомлений")
 async def handle_notifications(message: types.Message):
-    await message.answer("Настройки уведомлений скоро будут доступны! 🔔⚙️")
+    user_id = str(message.from_user.id)
+    schedule = await reminder_repo.get(user_id)
+    await message.answer(
+        f"🔔 Твои напоминания:\n{format_reminders(schedule)}\n\nВыбери, что настроить:",
+        reply_markup=notifications_kb
+    )
 
-@dp.message(lambda msg: msg.text == "❓ FAQ")
+async def choose_reminder_kind(message: types.Message, state: FSMContext):
+    kind = reminder_buttons[message.text]
+    await state.update_data(reminder_kind=kind)
+    await message.answer(
+        f"Во сколько напоминать ({REMINDER_TITLES[kind].lower()})? Напиши время через запятую, "
+        "например: 09:00, 13:30, 19:00. Чтобы выключить — напиши «выкл».",
+        reply_markup=cancel_kb
+    )
+    await state.set_state(NotificationSettings.waiting_for_times)
+
+for button_text in reminder_buttons:
+    menu.button(button_text)(choose_reminder_kind)
+
+@dp.message(NotificationSettings.waiting_for_times)
+async def process_reminder_times(message: types.Message, state: FSMContext):
+    if message.text == "🔙 Отмена":
+        await message.answer("Настройка отменена.", reply_markup=notifications_kb)
+        await state.clear()
+        return
+    try:
+        minutes = parse_times(message.text)
+    except ValueError:
+        await message.answer("Не понял время. Напиши, например: 08:30, 20:00 (не больше 6 раз в день) или «выкл».")
+        return
+    data = await state.get_data()
+    user_id = str(message.from_user.id)
+    times = local_times(await reminder_repo.get(user_id))
+    times[data["reminder_kind"]] = minutes
+    schedule = build_schedule(message.chat.id, times, REMINDER_TZ_OFFSET)
+    if schedule["slots"]:
+        await reminder_repo.set(user_id, schedule)
+        reminder_scheduler.reschedule(user_id, schedule)
+    else:
+        await reminder_repo.delete(user_id)
+        reminder_scheduler.reschedule(user_id, None)
+    await message.answer(f"✅ Напоминания обновлены:\n{format_reminders(schedule)}", reply_markup=notifications_kb)
+    await state.clear()
+
+@menu.button("🔕 Отключить напоминания")
+async def disable_reminders(message: types.Message):
+    user_id = str(message.from_user.id)
+    await reminder_repo.delete(user_id)
+    reminder_scheduler.reschedule(user_id, None)
+    await message.answer("🔕 Все напоминания выключены.", reply_markup=notifications_kb)
+
+@menu.button("❓ FAQ")
 async def handle_faq(message: types.Message):
     await message.answer(
         "❓ **Часто задаваемые вопросы:**\n\n"
@@ -899,15 +1228,15 @@ async def handle_faq(message: types.Message):
         "Остальные вопросы скоро появятся тут!"
     )
 
-@dp.message(lambda msg: msg.text == "🛠 Техподдержка")
+@menu.button("🛠 Техподдержка")
 async def handle_support(message: types.Message):
     await message.answer("Если у тебя возникли проблемы или вопросы, напиши нам: @support_account")
 
-@dp.message(lambda msg: msg.text == "💎 Подписка")
+@menu.button("💎 Подписка")
 async def handle_subscription(message: types.Message):
     user_id = str(message.from_user.id)
-    doc = db.collection("users").document(user_id).get()
-    subscription_status = doc.to_dict().get("subscription", "free") if doc.exists else "free"
+    user_data = await user_repo.get(user_id)
+    subscription_status = user_data.get("subscription", "free")
     await message.answer(
         f"Твой текущий статус подписки: *{subscription_status.upper()}* 💎\n\n"
         "Скоро будет возможность оформить премиум-подписку с дополнительными возможностями!"
@@ -979,7 +1308,7 @@ async def process_activity(message: types.Message, state: FSMContext):
         "цель": data.get("goal"),
         "активность": activity_factor
     }
-    db.collection("users").document(user_id).update({"params": params})
+    await user_repo.update(user_id, {"params": params})
     await message.answer(
         "Отлично! Я записал твои параметры:\n"
         f"• Пол: {data.get('gender')}\n"
@@ -1006,7 +1335,7 @@ async def update_goal(message: types.Message):
         new_goal = message.text.split("на", 1)[1].strip()
         if new_goal:
             user_id = str(message.from_user.id)
-            db.collection("users").document(user_id).update({"params.цель": new_goal})
+            await user_repo.update(user_id, {"params.цель": new_goal})
             await message.answer(f"Цель обновлена на: *{new_goal}*", parse_mode=ParseMode.MARKDOWN)
             return
     await message.answer("Пожалуйста, укажи новую цель после фразы 'поменяй мою цель на'.", parse_mode=ParseMode.MARKDOWN)
@@ -1017,9 +1346,15 @@ async def update_goal(message: types.Message):
 
 @dp.message(lambda msg: not ("поменяй мою цель" in msg.text.lower() or "измени мою цель" in msg.text.lower()))
 async def handle_message(message: types.Message):
+    await message_coalescer.submit(str(message.from_user.id), message)
+
+# Обработка пачки сообщений одного пользователя (MessageCoalescer склеивает быстрые серии)
+async def answer_messages(messages: list):
+    message = messages[-1]
+    text = "\n".join(m.text for m in messages)
     user_id = str(message.from_user.id)
-    doc = db.collection("users").document(user_id).get()
-    user_data = doc.to_dict() if doc.exists else {}
+    user_data = await user_repo.get(user_id)
+    user_data["history"] = history_writer.merged(user_id, user_data.get("history", []))
     params = user_data.get("params", {})
     if not params:
         await message.answer(
@@ -1029,26 +1364,109 @@ async def handle_message(message: types.Message):
             parse_mode=ParseMode.MARKDOWN
         )
         return
-    if not await is_fitness_question_combined(user_id, message.text):
+    if not await is_fitness_question_combined(user_id, text, user_data):
         await message.answer(
             "Прости, но я не смогу помочь с этим вопросом.\n\n"
             "Я специализируюсь на фитнесе, тренировках, питании и здоровом образе жизни.",
             parse_mode=ParseMode.MARKDOWN
         )
         return
-    await message.chat.do("typing")
-    response = await ask_gpt(user_id, message.text)
-    clean_response = fix_markdown_telegram(response)
-    await send_split_message(message.chat.id, clean_response, parse_mode=ParseMode.MARKDOWN)
-    await update_history(user_id, "user", message.text)
-    await update_history(user_id, "bot", response)
+    # Решение о кэше — по самому вопросу. Самостоятельный вопрос отвечается без истории и сводки:
+    # ответ зависит только от вопроса и параметров профиля и годится другим пользователям.
+    # Уточнения к разговору («а если без сахара?») идут с историей и мимо кэша
+    cacheable = answer_cache is not None and is_standalone_question(text)
+    if answer_cache is not None and not cacheable:
+        record_answer_cache("skipped")
+    prompt_data = {**user_data, "history": [], "history_summary": ""} if cacheable else user_data
+    cached_response = await answer_cache.get(text, params) if cacheable else None
+    if cached_response is not None:
+        response = cached_response
+        await send_markdown(bot, message.chat.id, response)
+    else:
+        await message.chat.do("typing")
+        if GPT_STREAMING:
+            response = await ask_gpt_stream(message, text, prompt_data)
+        else:
+            response = await ask_gpt(user_id, text, prompt_data)
+            await send_markdown(bot, message.chat.id, response)
+        if cacheable and response:
+            await answer_cache.set(text, params, response)
+    await history_writer.append(user_id, [("user", text), ("bot", response)])
+
+message_coalescer = MessageCoalescer(answer_messages, window=COALESCE_WINDOW)
+
+# OpenAI не ответил после всех повторов — вместо трейсбэка вежливое сообщение
+@dp.error(ExceptionTypeFilter(LLMUnavailableError))
+async def handle_llm_unavailable(event: ErrorEvent):
+    logging.warning("LLM недоступен: %s", event.exception)
+    if event.update.message:
+        await event.update.message.answer("Сейчас слишком много запросов 🙏 Попробуй, пожалуйста, через минуту.")
 
 # =========================================
 # 17. Точка входа
 # =========================================
 
+background_tasks = set()
+
+async def start_services():
+    # Клиенты Firestore и OpenAI создаются в потоках, пока бот уже принимает апдейты;
+    # планировщику напоминаний база нужна сразу — запускаем его после прогрева
+    await asyncio.gather(db.warm_up(), openai_client.warm_up())
+    if REMINDERS_ENABLED:
+        await reminder_scheduler.start()
+
+@dp.startup()
+async def on_startup(bot: Bot):
+    if answer_cache:
+        await answer_cache.warm_up()
+    await history_writer.start()
+    if profiler:
+        profiler.start()
+        bot.session.middleware(ProfilerRequestMiddleware())
+    tasks = [asyncio.create_task(start_services())]
+    if METRICS_LOG_INTERVAL > 0:
+        tasks.append(asyncio.create_task(log_summary_every(METRICS_LOG_INTERVAL)))
+    else:
+        # Токены по пользователям нужны только сводке — без неё словарь рос бы без предела
+        metrics.track_user_tokens = False
+    for task in tasks:
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+    if BOT_MODE == "webhook":
+        await bot.set_webhook(
+            WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=min(MAX_CONCURRENT_UPDATES, 100),
+        )
+
+@dp.shutdown()
+async def on_shutdown():
+    # Даём уже принятым апдейтам доработать, затем сбрасываем буферы
+    if not await concurrency_limit.wait_idle(SHUTDOWN_TIMEOUT):
+        logging.warning("Остановка: %s апдейтов не успели завершиться", concurrency_limit.in_flight)
+    for task in list(background_tasks):
+        task.cancel()
+    await reminder_scheduler.close()
+    # Рассылки продолжатся по /broadcast_resume с сохранённого курсора
+    for task in list(broadcast_tasks):
+        task.cancel()
+    await history_writer.close()
+    await summary_memory.close()
+    await food_estimator.close()
+    if profiler:
+        profiler.close()
+
 async def main():
     await dp.start_polling(bot)
 
+def run_webhook():
+    if not WEBHOOK_BASE_URL:
+        raise RuntimeError("Для BOT_MODE=webhook нужно задать WEBHOOK_BASE_URL")
+    app = create_app(dp, bot, WEBHOOK_PATH, secret=WEBHOOK_SECRET, metrics=metrics)
+    web.run_app(app, host=WEB_HOST, port=WEB_PORT)
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    if BOT_MODE == "webhook":
+        run_webhook()
+    else:
+        asyncio.run(main())
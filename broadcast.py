@@ -0,0 +1,96 @@
+# =========================================
+# Массовая рассылка всем пользователям
+# =========================================
+# Id пользователей читаются из users страницами (без полей документа),
+# сообщения уходят через общий RateLimitedSender, после каждой страницы
+# курсор и счётчики сохраняются в broadcasts/{id}. Прерванная рассылка
+# продолжается со следующей после курсора страницы; в памяти всегда не
+# больше одной страницы id.
+
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+from sender import BLOCKED, SENT
+
+RUNNING = "running"
+DONE = "done"
+
+
+class BroadcastRunner:
+    def __init__(self, user_repo, broadcast_repo, sender, page_size: int = 500):
+        self._users = user_repo
+        self._broadcasts = broadcast_repo
+        self._sender = sender
+        self.page_size = page_size
+        self._running = set()
+
+    def is_running(self, broadcast_id: str) -> bool:
+        return broadcast_id in self._running
+
+    async def create(self, text: str, author_id: str) -> str:
+        broadcast_id = datetime.now().strftime("%Y%m%d-%H%M%S")
+        await self._broadcasts.set(broadcast_id, {
+            "text": text,
+            "author_id": author_id,
+            "status": RUNNING,
+            "cursor": None,
+            "sent": 0,
+            "blocked": 0,
+            "failed": 0,
+            "elapsed": 0.0,
+            "created_at": datetime.now(),
+        })
+        return broadcast_id
+
+    async def run(self, broadcast_id: str, report=None) -> dict:
+        """Отправляет рассылку с места последнего курсора. report(stats) —
+        необязательная корутина, вызывается после каждой страницы."""
+        state = await self._broadcasts.get(broadcast_id)
+        if state is None or state.get("status") == DONE or broadcast_id in self._running:
+            return state
+        self._running.add(broadcast_id)
+        try:
+            return await self._run(broadcast_id, state, report)
+        finally:
+            self._running.discard(broadcast_id)
+
+    async def _run(self, broadcast_id: str, state: dict, report):
+        stats = {key: state.get(key, 0) for key in ("sent", "blocked", "failed")}
+        cursor = state.get("cursor")
+        elapsed = state.get("elapsed", 0.0)
+        started = time.monotonic()
+        while True:
+            user_ids = await self._users.page_ids(after=cursor, limit=self.page_size)
+            if not user_ids:
+                break
+            results = await asyncio.gather(*(self._sender.send(user_id, state["text"]) for user_id in user_ids))
+            for result in results:
+                key = "sent" if result == SENT else "blocked" if result == BLOCKED else "failed"
+                stats[key] += 1
+            cursor = user_ids[-1]
+            stats["elapsed"] = elapsed + time.monotonic() - started
+            # Страница отправлена — сохраняем курсор: при перезапуске повторится не больше одной страницы
+            await self._broadcasts.set(broadcast_id, {"cursor": cursor, **stats, "updated_at": datetime.now()})
+            processed = stats["sent"] + stats["blocked"] + stats["failed"]
+            logging.info("Рассылка %s: %s пользователей, %.1f сообщ./с", broadcast_id, processed, throughput(stats))
+            if report is not None:
+                await report(stats)
+            if len(user_ids) < self.page_size:
+                break
+        stats["elapsed"] = elapsed + time.monotonic() - started
+        await self._broadcasts.set(broadcast_id, {"status": DONE, **stats, "finished_at": datetime.now()})
+        return stats
+
+
+def throughput(stats: dict) -> float:
+    processed = stats["sent"] + stats["blocked"] + stats["failed"]
+    return processed / stats["elapsed"] if stats.get("elapsed") else 0.0
+
+
+def format_stats(stats: dict) -> str:
+    return (
+        f"✅ доставлено: {stats['sent']}, 🚫 заблокировали бота: {stats['blocked']}, "
+        f"⚠️ ошибок: {stats['failed']}; {stats.get('elapsed', 0):.0f} с, {throughput(stats):.1f} сообщ./с"
+    )
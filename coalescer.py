@@ -0,0 +1,87 @@
+# =========================================
+# Очередь сообщений пользователя: сериализация, склейка, дедупликация
+# =========================================
+
+import asyncio
+import time
+
+from profiler import stage
+
+
+class _ChatQueue:
+    def __init__(self):
+        self.pending = []
+        self.futures = []
+        self.texts = set()
+        self.last_arrival = 0.0
+
+
+class MessageCoalescer:
+    """Обрабатывает сообщения одного пользователя строго по очереди.
+
+    Сообщения, пришедшие с паузой меньше window секунд, склеиваются в одну
+    пачку и уходят в process(messages) одним вызовом (один запрос к GPT,
+    одна запись истории). Сообщение с тем же текстом, что уже ждёт или
+    обрабатывается, отбрасывается. Первый хендлер в пачке становится
+    ведущим и крутит цикл обработки, остальные ждут свою пачку.
+    """
+
+    def __init__(self, process, window: float = 0.4, max_delay: float = 2.0):
+        self._process = process
+        self.window = window
+        self.max_delay = max_delay
+        self._chats = {}
+        self.coalesced = 0
+        self.duplicates = 0
+
+    async def submit(self, key, message):
+        chat = self._chats.get(key)
+        leader = chat is None
+        if leader:
+            chat = self._chats[key] = _ChatQueue()
+        if message.text in chat.texts:
+            self.duplicates += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        chat.pending.append(message)
+        chat.futures.append(future)
+        chat.texts.add(message.text)
+        chat.last_arrival = time.monotonic()
+        if leader:
+            await self._run(key, chat)
+        await future
+
+    async def _run(self, key, chat):
+        try:
+            while chat.pending:
+                with stage("coalesce.wait"):
+                    await self._debounce(chat)
+                batch, futures = chat.pending, chat.futures
+                chat.pending, chat.futures = [], []
+                self.coalesced += len(batch) - 1
+                try:
+                    await self._process(batch)
+                except Exception as e:
+                    # Ошибку получает один хендлер пачки — пользователь увидит одно сообщение о ней
+                    for future in futures[:-1]:
+                        future.set_result(None)
+                    futures[-1].set_exception(e)
+                else:
+                    for future in futures:
+                        future.set_result(None)
+                chat.texts.difference_update(m.text for m in batch)
+        finally:
+            del self._chats[key]
+            for future in chat.futures:
+                if not future.done():
+                    future.cancel()
+
+    async def _debounce(self, chat):
+        # Ждём паузу window после последнего сообщения, но не дольше max_delay
+        started = time.monotonic()
+        while True:
+            now = time.monotonic()
+            wait = min(chat.last_arrival + self.window, started + self.max_delay) - now
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
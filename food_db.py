@@ -0,0 +1,223 @@
+# =========================================
+# Локальная база КБЖУ продуктов с нечётким поиском
+# =========================================
+# Таблица data/foods.csv (ккал/Б/Ж/У на 100 г) загружается один раз в
+# компактный индекс: точные названия и синонимы — словарь,
+# основы первых слов — для падежей («хлеба» → «хлеб белый»), опечатки —
+# инвертированный индекс триграмм с мерой Дайса. Поиск занимает микросекунды,
+# поэтому КБЖУ к записи дневника добавляется без обращения к GPT.
+
+import csv
+import os
+import re
+from array import array
+
+import numpy as np
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "foods.csv")
+NUTRIENTS = ("kcal", "protein", "fat", "carbs")
+
+_CLEAN = re.compile(r"[^\w\s%-]")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_food_name(text: str) -> str:
+    text = _CLEAN.sub(" ", text.lower().replace("ё", "е"))
+    return _SPACES.sub(" ", text).strip()
+
+
+_ENDING = re.compile(r"[аеиоуыэюяйь]{1,2}$")
+
+
+def _stem(word: str) -> str:
+    # Грубая основа слова без окончания: «хлеба», «хлеб» -> «хлеб»; «яблоки», «яблоко» -> «яблок»
+    stem = _ENDING.sub("", word)
+    return stem if len(stem) >= 3 else ""
+
+
+def _trigrams(text: str) -> set:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+# =========================================
+# Разбор количества: "200 г", "0,5 кг", "2 шт", "стакан", "полстакана", "3 ст.л."
+# =========================================
+
+# Единица — сразу после числа или «пол» либо с начала слова: «бокал» и «стол» не литры
+_QUANTITY = re.compile(
+    r"(?:(?P<amount>\d+(?:[.,]\d+)?)\s*|(?<!\w)(?P<half>пол)-?\s*|(?<!\w))"
+    r"(?P<unit>кг|килограмм\w*|г|гр|грамм\w*|мл|миллилитр\w*|л|литр\w*|шт\w*|штук\w*|"
+    r"стакан\w*|кружк\w*|чашк\w*|ст\.?\s?л\.?|столов\w*\s+ложк\w*|ч\.?\s?л\.?|чайн\w*\s+ложк\w*|ложк\w*|"
+    r"порци\w*|кусо?ч?к\w*|тарелк\w*)?\b"
+)
+
+# Граммы на единицу; None — вес одной штуки берётся из таблицы продуктов
+UNIT_GRAMS = {
+    "кг": 1000, "килограмм": 1000, "г": 1, "гр": 1, "грамм": 1,
+    "мл": 1, "миллилитр": 1, "л": 1000, "литр": 1000,
+    "шт": None, "штук": None, "кусок": None, "кусочек": None,
+    "стакан": 250, "кружк": 300, "чашк": 200,
+    "ст.л": 15, "столов": 15, "ложк": 15, "ч.л": 5, "чайн": 5,
+    "порци": 250, "тарелк": 300,
+}
+
+DEFAULT_PIECE_GRAMS = 100
+
+
+def _unit_grams(unit: str):
+    unit = unit.replace(" ", "").rstrip(".")
+    if unit.startswith("ст.") or unit.startswith("стл"):
+        return UNIT_GRAMS["ст.л"]
+    if unit.startswith("ч.") or unit.startswith("чл"):
+        return UNIT_GRAMS["ч.л"]
+    for prefix in sorted(UNIT_GRAMS, key=len, reverse=True):
+        if unit.startswith(prefix):
+            return UNIT_GRAMS[prefix]
+    if unit.startswith("кус"):
+        return None
+    return 1
+
+
+def parse_quantity(text: str):
+    """'200 г' -> (200.0, 'г'); '2 шт' -> (2.0, 'шт'); 'стакан' -> (1.0, 'стакан');
+    'полстакана' -> (0.5, 'стакана'). Без распознаваемого числа и единицы, а также
+    для числа с незнакомым словом ('1 банка', '2 пачки') возвращает None."""
+    normalized = text.lower().replace("ё", "е").strip()
+    for m in _QUANTITY.finditer(normalized):
+        amount, unit = m.group("amount"), m.group("unit")
+        if amount is None and unit is None:
+            continue
+        if m.group("half"):
+            # «пол» без единицы («половина», «пол») количеством не считаем
+            if unit is None:
+                continue
+            return 0.5, unit.strip()
+        if unit is None and normalized[m.end():].lstrip()[:1].isalpha():
+            # Единица не распознана — граммами число считать нельзя
+            return None
+        value = float(amount.replace(",", ".")) if amount else 1.0
+        return value, (unit or "").strip()
+    return None
+
+
+def quantity_grams(quantity: str, piece_grams: float = None):
+    """Количество из записи дневника в граммах; piece_grams — вес одной штуки продукта."""
+    parsed = parse_quantity(quantity)
+    if parsed is None:
+        return None
+    amount, unit = parsed
+    if not unit:
+        # «2» — скорее штуки, «250» — граммы
+        return amount * piece_grams if amount < 20 and piece_grams else amount
+    per_unit = _unit_grams(unit)
+    return amount * ((piece_grams or DEFAULT_PIECE_GRAMS) if per_unit is None else per_unit)
+
+
+class FoodDatabase:
+    def __init__(self, rows):
+        self.names = []
+        self.piece_grams = []
+        values = []
+        self._exact = {}
+        for row in rows:
+            food_id = len(self.names)
+            self.names.append(row["name"])
+            values.append([float(row[n]) for n in NUTRIENTS])
+            self.piece_grams.append(float(row["piece_g"]) if row.get("piece_g") else None)
+            aliases = [row["name"]] + [a for a in (row.get("aliases") or "").split("|") if a]
+            for alias in aliases:
+                self._exact.setdefault(normalize_food_name(alias), food_id)
+        # Основа первого слова -> продукт (первый в таблице): «хлеб» -> «хлеб белый», а не «хлебцы»
+        self._stems = {}
+        for key, food_id in self._exact.items():
+            stem = _stem(key.split(" ")[0])
+            if stem:
+                self._stems.setdefault(stem, food_id)
+        # КБЖУ на 100 г: массив (N, 4) float32
+        self.values = np.asarray(values, dtype=np.float32)
+        # Индекс триграмм строится по всем ключам (названия и синонимы)
+        self._keys = list(self._exact)
+        self._key_food = array("I", (self._exact[k] for k in self._keys))
+        self._key_sizes = array("H", (len(_trigrams(k)) for k in self._keys))
+        postings = {}
+        for key_id, key in enumerate(self._keys):
+            for gram in _trigrams(key):
+                postings.setdefault(gram, array("I")).append(key_id)
+        self._postings = postings
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_PATH):
+        with open(path, encoding="utf-8") as f:
+            return cls(list(csv.DictReader(f)))
+
+    def __len__(self):
+        return len(self.names)
+
+    def lookup(self, name: str, threshold: float = 0.55):
+        """Возвращает (food_id, score) лучшего совпадения или None.
+
+        Порядок: точное название или синоним, совпадение по основе слова,
+        затем триграммы. Для коротких названий порог триграмм выше: у них
+        мало триграмм, и одна общая даёт большой балл («кура» ~ «курага»).
+        """
+        key = normalize_food_name(name)
+        if not key:
+            return None
+        best = self._match(key, threshold)
+        if best is None and " " in key:
+            # «гречка с курицей» — пробуем отдельные слова, начиная с первого
+            for word in key.split(" "):
+                if len(word) >= 3:
+                    best = self._match(word, threshold)
+                    if best is not None:
+                        break
+        return best
+
+    def _match(self, key: str, threshold: float):
+        food_id = self._exact.get(key)
+        if food_id is not None:
+            return food_id, 1.0
+        if " " not in key:
+            food_id = self._stems.get(_stem(key))
+            if food_id is not None:
+                return food_id, 0.9
+        return self._fuzzy(key, threshold + (1.0 - threshold) * max(0, 8 - len(key)) / 8)
+
+    def _fuzzy(self, key: str, threshold: float):
+        grams = _trigrams(key)
+        counts = {}
+        for gram in grams:
+            ids = self._postings.get(gram)
+            if ids is None:
+                continue
+            for key_id in ids:
+                counts[key_id] = counts.get(key_id, 0) + 1
+        best_id, best_score = None, 0.0
+        for key_id, common in counts.items():
+            score = 2.0 * common / (len(grams) + self._key_sizes[key_id])
+            if score > best_score:
+                best_id, best_score = key_id, score
+        if best_id is None or best_score < threshold:
+            return None
+        return self._key_food[best_id], best_score
+
+    def grams(self, food_id: int, quantity: str):
+        return quantity_grams(quantity, self.piece_grams[food_id])
+
+    def nutrition(self, meal_name: str, quantity: str):
+        """КБЖУ порции для записи дневника или None, если продукт/количество не распознаны."""
+        match = self.lookup(meal_name)
+        if match is None:
+            return None
+        food_id, _ = match
+        grams = self.grams(food_id, quantity)
+        if grams is None:
+            return None
+        return nutrition_from_per100(self.values[food_id], grams, self.names[food_id], source="local")
+
+
+def nutrition_from_per100(per100, grams: float, food: str, source: str) -> dict:
+    result = {n: round(float(v) * grams / 100, 1) for n, v in zip(NUTRIENTS, per100)}
+    result.update({"grams": round(grams, 1), "food": food, "source": source})
+    return result
@@ -0,0 +1,212 @@
+# =========================================
+# Оценка КБЖУ незнакомых блюд через GPT пачками
+# =========================================
+# Блюда, которых нет в локальной таблице, копятся window секунд от всех
+# пользователей и уходят в GPT одним JSON-запросом. Результат (КБЖУ на 100 г)
+# сохраняется в общий кэш foods/{название} в Firestore и в памяти процесса,
+# поэтому каждое новое блюдо оценивается один раз, а записи дневника
+# получают КБЖУ задним числом (вместе с дневными сводками).
+
+import asyncio
+import json
+import logging
+
+from cache import TTLCache
+from food_db import NUTRIENTS, normalize_food_name, nutrition_from_per100, quantity_grams
+
+ESTIMATE_PROMPT = (
+    "Ты нутрициолог. Для каждого блюда из списка оцени типичную пищевую ценность на 100 г: "
+    "калории (kcal), белки (protein), жиры (fat) и углеводы (carbs) в граммах, а также вес "
+    "одной штуки или порции в граммах (piece_g, null если неприменимо). "
+    'Ответь только JSON вида {"foods": [{"name": "...", "kcal": 0, "protein": 0, "fat": 0, '
+    '"carbs": 0, "piece_g": null}]}, блюда в том же порядке и с теми же названиями.'
+)
+
+
+def food_key(meal_name: str) -> str:
+    # Id документа в foods: без "/", "." и "__" (ограничения Firestore)
+    return normalize_food_name(meal_name.replace("_", " "))[:200]
+
+
+def _valid_food(item) -> dict:
+    if not isinstance(item, dict):
+        return None
+    food = {}
+    for field in NUTRIENTS:
+        value = item.get(field)
+        if not isinstance(value, (int, float)) or isinstance(value, bool) or not 0 <= value <= 1000:
+            return None
+        food[field] = float(value)
+    piece = item.get("piece_g")
+    food["piece_g"] = float(piece) if isinstance(piece, (int, float)) and not isinstance(piece, bool) and piece > 0 else None
+    return food
+
+
+def parse_estimates(names: list, content: str) -> dict:
+    """Ответ GPT -> {название: КБЖУ на 100 г}. Блюда сопоставляются по
+    нормализованному названию, иначе по позиции в списке."""
+    try:
+        items = json.loads(content).get("foods")
+    except (ValueError, AttributeError):
+        return {}
+    if not isinstance(items, list):
+        return {}
+    by_key = {food_key(name): name for name in names}
+    estimates = {}
+    for position, item in enumerate(items):
+        food = _valid_food(item)
+        if food is None:
+            continue
+        name = by_key.get(food_key(str(item.get("name", ""))))
+        if name is None and position < len(names):
+            name = names[position]
+        if name is not None:
+            estimates.setdefault(name, food)
+    return estimates
+
+
+class FoodEstimator:
+    """Дополняет записи дневника КБЖУ, если блюда нет в локальной таблице.
+
+    estimate(names) — корутина, которая одним запросом к GPT возвращает
+    {название: {"kcal", "protein", "fat", "carbs", "piece_g"}}.
+    Если пачку оценить не удалось, её записи возвращаются в очередь и
+    повторяются со следующей пачкой, но не больше max_attempts раз.
+    """
+
+    def __init__(self, food_db, food_repo, diary_repo, estimate, window: float = 2.0,
+                 max_batch: int = 30, cache_size: int = 10000, max_attempts: int = 3):
+        self._food_db = food_db
+        self._foods = food_repo
+        self._diary = diary_repo
+        self._estimate = estimate
+        self.window = window
+        self.max_batch = max_batch
+        self.max_attempts = max_attempts
+        # Оценки не устаревают: TTL сутки лишь ограничивает память процесса
+        self._cache = TTLCache(maxsize=cache_size, ttl=86400)
+        self._pending = {}
+        # Неудачные попытки оценки по ключу блюда
+        self._attempts = {}
+        self._task = None
+        # Метрики
+        self.batches = 0
+        self.estimated = 0
+        self.shared_hits = 0
+
+    def nutrition(self, meal_name: str, quantity: str):
+        # Локальная таблица, затем уже оценённые блюда из памяти процесса
+        nutrition = self._food_db.nutrition(meal_name, quantity)
+        if nutrition is not None:
+            return nutrition
+        food = self._cache.get(food_key(meal_name))
+        if food is None:
+            return None
+        return _nutrition(food, meal_name, quantity)
+
+    def submit(self, user_id: str, entry_id: str, meal_name: str, quantity: str):
+        """Ставит запись в очередь на оценку; КБЖУ появится в ней после ближайшей пачки."""
+        if self._food_db.lookup(meal_name) is not None:
+            # Блюдо известно, не распознано только количество — GPT тут не поможет
+            return
+        key = food_key(meal_name)
+        if not key:
+            return
+        self._pending.setdefault(key, []).append((user_id, entry_id, meal_name, quantity))
+        self._schedule()
+
+    def _schedule(self):
+        task = self._task
+        if task is None or task.done() or task is asyncio.current_task():
+            self._task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        await self.flush()
+
+    async def flush(self):
+        retry = {}
+        while self._pending:
+            keys = list(self._pending)[:self.max_batch]
+            waiting = {key: self._pending.pop(key) for key in keys}
+            try:
+                foods = await self._resolve(waiting)
+            except Exception:
+                logging.exception("Не удалось оценить КБЖУ блюд: %s", ", ".join(keys))
+                for key, entries in waiting.items():
+                    attempts = self._attempts.get(key, 0) + 1
+                    if attempts < self.max_attempts:
+                        self._attempts[key] = attempts
+                        retry[key] = entries
+                    else:
+                        self._attempts.pop(key, None)
+                        logging.error("КБЖУ блюда %r не оценено после %d попыток, записей: %d",
+                                      key, attempts, len(entries))
+                continue
+            for key in keys:
+                self._attempts.pop(key, None)
+            await self._write_back(foods, waiting)
+        if retry:
+            # Повтор — со следующей пачкой, а не сразу в этом же цикле
+            for key, entries in retry.items():
+                self._pending[key] = entries + self._pending.get(key, [])
+            self._schedule()
+
+    async def _resolve(self, waiting: dict) -> dict:
+        foods = {}
+        for key in waiting:
+            food = self._cache.get(key)
+            if food is not None:
+                foods[key] = food
+        missing = [key for key in waiting if key not in foods]
+        if missing:
+            stored = await self._foods.get_many(missing)
+            self.shared_hits += len(stored)
+            foods.update(stored)
+            missing = [key for key in missing if key not in stored]
+        if missing:
+            # Название — как его написал первый пользователь, ключ — нормализованное
+            names = [waiting[key][0][2] for key in missing]
+            self.batches += 1
+            estimates = await self._estimate(names)
+            estimated = {food_key(name): {**food, "name": name} for name, food in estimates.items()}
+            if estimated:
+                await self._foods.set_many(estimated)
+            self.estimated += len(estimated)
+            foods.update(estimated)
+        for key, food in foods.items():
+            self._cache.set(key, food)
+        return foods
+
+    async def _write_back(self, foods: dict, waiting: dict):
+        for key, entries in waiting.items():
+            food = foods.get(key)
+            if food is None:
+                continue
+            for user_id, entry_id, meal_name, quantity in entries:
+                nutrition = _nutrition(food, meal_name, quantity)
+                if nutrition is None:
+                    continue
+                try:
+                    # Пока шла оценка, запись могли отредактировать — тогда не трогаем её
+                    await self._diary.update(user_id, entry_id, {"nutrition": nutrition},
+                                             if_match={"meal_name": meal_name, "quantity": quantity})
+                except Exception:
+                    logging.exception("Не удалось записать КБЖУ в запись %s пользователя %s", entry_id, user_id)
+
+    async def close(self):
+        # Дожидаемся запланированной пачки и повторов, чтобы не потерять очередь при остановке
+        while True:
+            if self._task is not None:
+                task, self._task = self._task, None
+                await task
+            await self.flush()
+            if self._task is None:
+                break
+
+
+def _nutrition(food: dict, meal_name: str, quantity: str):
+    grams = quantity_grams(quantity, food.get("piece_g"))
+    if grams is None:
+        return None
+    return nutrition_from_per100([food[n] for n in NUTRIENTS], grams, meal_name, source="gpt")
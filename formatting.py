@@ -0,0 +1,501 @@
+# =========================================
+# Подготовка ответов GPT к отправке в Telegram
+# =========================================
+# Markdown из ответа GPT за один проход превращается в простой текст и
+# список сущностей Telegram (bold, italic, code, pre, text_link, ...).
+# Сообщение с entities не разбирается на стороне Telegram, поэтому не
+# бывает ошибок "can't parse entities" и повторных отправок без
+# разметки. Незакрытые маркеры (** без пары и т.п.) остаются текстом.
+#
+# Длинный ответ режется на части не длиннее TELEGRAM_MAX_LENGTH (в
+# единицах UTF-16, как считает Telegram): по абзацам, строкам или
+# пробелам, по возможности не внутри сущности; сущность, которую
+# разрезать пришлось, обрезается по границам части и остаётся валидной.
+# MarkdownRenderer принимает текст кусками — для потоковых ответов.
+
+import bisect
+import re
+
+TELEGRAM_MAX_LENGTH = 4096
+
+# Сущность: (тип, начало, длина, url или язык для pre) — в символах Python;
+# в единицы UTF-16 переводит telegram_entities()
+BOLD = "bold"
+ITALIC = "italic"
+STRIKETHROUGH = "strikethrough"
+CODE = "code"
+PRE = "pre"
+TEXT_LINK = "text_link"
+
+_SPECIAL = re.compile(r"[*_`~\[\\]")
+_HEADING = re.compile(r"(#{1,6})\s+(.*?)\s*#*\s*$")
+_LIST_ITEM = re.compile(r"([-*+])\s+")
+_LANGUAGE = re.compile(r"[\w#+.-]+$")
+_LINK_SCHEMES = ("http://", "https://", "tg://", "mailto:")
+_PUNCTUATION = set("!\"#$%&'()*+,-./:;<=>?@[\\]^_`{|}~")
+
+_ESCAPE_TEXT = str.maketrans({c: "\\" + c for c in "_*[]()~`>#+-=|{}.!\\"})
+_ESCAPE_CODE = str.maketrans({"`": "\\`", "\\": "\\\\"})
+_ESCAPE_URL = str.maketrans({")": "\\)", "\\": "\\\\"})
+_MARKDOWN_V2 = {BOLD: "*", ITALIC: "_", STRIKETHROUGH: "~", CODE: "`"}
+
+
+class Rendered:
+    """Текст без разметки и сущности к нему."""
+
+    __slots__ = ("text", "entities")
+
+    def __init__(self, text: str, entities: list):
+        self.text = text
+        self.entities = entities
+
+    def __eq__(self, other):
+        return isinstance(other, Rendered) and self.text == other.text and self.entities == other.entities
+
+    def __repr__(self):
+        return f"Rendered({self.text!r}, {self.entities!r})"
+
+    def slice(self, start: int, end: int = None) -> "Rendered":
+        """Часть текста; сущности на границах обрезаются, пустые отбрасываются."""
+        end = len(self.text) if end is None else end
+        entities = []
+        for kind, offset, length, extra in self.entities:
+            lo = max(offset, start)
+            hi = min(offset + length, end)
+            if hi > lo:
+                entities.append((kind, lo - start, hi - lo, extra))
+        return Rendered(self.text[start:end], entities)
+
+
+class MarkdownRenderer:
+    """Построчный рендер Markdown: feed() можно вызывать с кусками потока.
+
+    Завершённые строки рендерятся один раз и больше не меняются;
+    snapshot() показывает их вместе с незавершённой строкой, close()
+    дописывает хвост и возвращает итог.
+    """
+
+    def __init__(self):
+        self._parts = []
+        self._pos = 0
+        self._entities = []
+        self._buffer = ""
+        # Открытый блок ```: (начало в тексте, язык)
+        self._code = None
+        # Строка продолжает принудительно сброшенный хвост (commit_partial) — не начало строки
+        self._continued = False
+
+    @property
+    def committed_length(self) -> int:
+        return self._pos
+
+    def feed(self, chunk: str):
+        if not chunk:
+            return
+        self._buffer += chunk
+        if "\n" in chunk:
+            *lines, self._buffer = self._buffer.split("\n")
+            for line in lines:
+                self._line(line)
+
+    def commit_partial(self):
+        """Фиксирует незавершённую строку как есть: всё, что уже отрендерено,
+        перестаёт меняться (нужно, чтобы резать поток на сообщения)."""
+        if self._buffer:
+            self._line(self._buffer, newline=False)
+            self._buffer = ""
+            self._continued = True
+
+    def snapshot(self) -> Rendered:
+        if len(self._parts) > 1:
+            self._parts = ["".join(self._parts)]
+        state = (self._pos, len(self._parts), len(self._entities), self._code, self._continued)
+        if self._buffer:
+            self._line(self._buffer, newline=False)
+        self._close_code()
+        rendered = Rendered("".join(self._parts), sorted(self._entities, key=_entity_order))
+        self._pos, parts, entities, self._code, self._continued = state
+        del self._parts[parts:]
+        del self._entities[entities:]
+        return rendered
+
+    def close(self) -> Rendered:
+        self.commit_partial()
+        self._close_code()
+        return Rendered("".join(self._parts), sorted(self._entities, key=_entity_order))
+
+    # ---- блоки ----
+
+    def _append(self, text: str):
+        if text:
+            self._parts.append(text)
+            self._pos += len(text)
+
+    def _close_code(self):
+        if self._code is not None:
+            start, language = self._code
+            length = self._pos - start
+            # Перевод строки после последней строки блока — уже не код
+            if length and self._parts[-1].endswith("\n"):
+                length -= 1
+            if length > 0:
+                self._entities.append((PRE, start, length, language))
+            self._code = None
+
+    def _line(self, line: str, newline: bool = True):
+        continued, self._continued = self._continued, False
+        stripped = line.strip()
+        if self._code is not None:
+            if stripped.startswith("```") and not continued:
+                self._close_code()
+            else:
+                self._append(line + "\n" if newline else line)
+            return
+        if stripped.startswith("```") and not continued:
+            language = stripped[3:].strip()
+            self._code = (self._pos, language if _LANGUAGE.match(language) else None)
+            return
+        if not continued:
+            heading = _HEADING.match(line)
+            if heading:
+                title = heading.group(2)
+                # "### **Заголовок**" — жирный уже дан заголовком
+                if len(title) > 4 and title.startswith("**") and title.endswith("**"):
+                    title = title[2:-2]
+                start = self._pos
+                self._inline(title, 0, len(title), (BOLD,))
+                if self._pos > start:
+                    self._entities.append((BOLD, start, self._pos - start, None))
+                self._append("\n" if newline else "")
+                return
+            if len(stripped) >= 3 and stripped[0] in "-*_" and stripped == stripped[0] * len(stripped):
+                self._append("——————" + ("\n" if newline else ""))
+                return
+            indent = len(line) - len(line.lstrip(" "))
+            item = _LIST_ITEM.match(line, indent)
+            if item:
+                self._append(line[:indent] + "• ")
+                line = line[item.end():]
+        self._inline(line, 0, len(line), ())
+        if newline:
+            self._append("\n")
+
+    # ---- строчная разметка ----
+
+    def _inline(self, line: str, i: int, end: int, active: tuple):
+        while i < end:
+            match = _SPECIAL.search(line, i, end)
+            if match is None:
+                self._append(line[i:end])
+                return
+            j = match.start()
+            self._append(line[i:j])
+            i = self._marker(line, j, end, active)
+
+    def _span(self, kind: str, line: str, start: int, end: int, active: tuple):
+        # Одинаковые вложенные сущности Telegram не принимает — внутренняя становится просто текстом
+        if kind in active:
+            self._inline(line, start, end, active)
+            return
+        offset = self._pos
+        self._inline(line, start, end, active + (kind,))
+        if self._pos > offset:
+            self._entities.append((kind, offset, self._pos - offset, None))
+
+    def _marker(self, line: str, i: int, end: int, active: tuple) -> int:
+        """Разбирает маркер в позиции i и возвращает позицию после него."""
+        char = line[i]
+        if char == "\\":
+            if i + 1 < end and line[i + 1] in _PUNCTUATION:
+                self._append(line[i + 1])
+                return i + 2
+            self._append("\\")
+            return i + 1
+        run = _run_length(line, i, end)
+        if char == "`":
+            close = line.find("`" * run, i + run, end)
+            while close != -1 and _run_length(line, close, end) != run:
+                close = line.find("`" * run, close + _run_length(line, close, end), end)
+            if close == -1 or not line[i + run:close].strip():
+                self._append(line[i:i + run])
+                return i + run
+            if CODE not in active:
+                self._entities.append((CODE, self._pos, close - i - run, None))
+            self._append(line[i + run:close])
+            return close + run
+        if char == "[":
+            return self._link(line, i, end, active)
+        if char == "~":
+            if run == 2:
+                close = _find_closer(line, "~~", i + 2, end)
+                if close != -1:
+                    self._span(STRIKETHROUGH, line, i + 2, close, active)
+                    return close + 2
+            self._append(line[i:i + run])
+            return i + run
+        # * и _
+        opens = run <= 3 and i + run < end and not line[i + run].isspace()
+        if opens and char == "_" and i > 0 and line[i - 1].isalnum():
+            opens = False
+        if opens and char == "*" and _between_digits(line, i, run, end):
+            opens = False
+        if opens:
+            marker = char * run
+            close = _find_closer(line, marker, i + run, end)
+            if close != -1:
+                if run == 3:
+                    self._bold_italic(line, i + 3, close, active)
+                else:
+                    self._span(BOLD if run == 2 else ITALIC, line, i + run, close, active)
+                return close + run
+        self._append(line[i:i + run])
+        return i + run
+
+    def _bold_italic(self, line: str, start: int, end: int, active: tuple):
+        if BOLD in active:
+            self._span(ITALIC, line, start, end, active)
+            return
+        offset = self._pos
+        self._span(ITALIC, line, start, end, active + (BOLD,))
+        if self._pos > offset:
+            self._entities.append((BOLD, offset, self._pos - offset, None))
+
+    def _link(self, line: str, i: int, end: int, active: tuple) -> int:
+        middle = line.find("](", i + 1, end)
+        close = _link_end(line, middle + 2, end) if middle != -1 else -1
+        url = line[middle + 2:close].strip() if close != -1 else ""
+        if close == -1 or middle == i + 1 or not url.startswith(_LINK_SCHEMES) or " " in url:
+            self._append("[")
+            return i + 1
+        if TEXT_LINK in active:
+            self._inline(line, i + 1, middle, active)
+            return close + 1
+        offset = self._pos
+        self._inline(line, i + 1, middle, active + (TEXT_LINK,))
+        if self._pos > offset:
+            self._entities.append((TEXT_LINK, offset, self._pos - offset, url))
+        return close + 1
+
+
+def _run_length(line: str, i: int, end: int) -> int:
+    char = line[i]
+    j = i + 1
+    while j < end and line[j] == char:
+        j += 1
+    return j - i
+
+
+def _between_digits(line: str, i: int, run: int, end: int) -> bool:
+    # * внутри формулы («10*вес», «2*3») — умножение, а не разметка
+    before = line[i - 1] if i > 0 else ""
+    after = line[i + run] if i + run < end else ""
+    return before.isalnum() and after.isalnum() and (before.isdigit() or after.isdigit())
+
+
+def _link_end(line: str, start: int, end: int) -> int:
+    # Закрывающая скобка ссылки с учётом парных скобок в URL: https://x.y/a_(b)
+    depth = 0
+    for j in range(start, end):
+        if line[j] == "(":
+            depth += 1
+        elif line[j] == ")":
+            if not depth:
+                return j
+            depth -= 1
+    return -1
+
+
+def _find_closer(line: str, marker: str, start: int, end: int) -> int:
+    # Закрывающий маркер: ровно такой же длины, не после пробела, у _ — не внутри слова,
+    # у * — не внутри формулы
+    size = len(marker)
+    close = line.find(marker, start, end)
+    while close != -1:
+        run = _run_length(line, close, end)
+        if (run == size and close > start and not line[close - 1].isspace()
+                and not (marker[0] == "_" and close + size < end and line[close + size].isalnum())
+                and not (marker[0] == "*" and _between_digits(line, close, size, end))):
+            return close
+        close = line.find(marker, close + run, end)
+    return -1
+
+
+def _entity_order(entity: tuple):
+    # Внешние сущности раньше вложенных
+    return entity[1], -entity[2]
+
+
+def render_markdown(text: str) -> Rendered:
+    renderer = MarkdownRenderer()
+    renderer.feed(text)
+    return renderer.close()
+
+
+# =========================================
+# Разбиение на сообщения
+# =========================================
+
+def _has_astral(text: str) -> bool:
+    # Символы вне BMP (эмодзи) занимают в UTF-16 две единицы
+    return not text.isascii() and max(text) > "\uffff"
+
+
+def _utf16_length(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _covered(entities: list) -> tuple:
+    """Объединение интервалов сущностей: (начала, концы) непересекающихся отрезков."""
+    starts, ends = [], []
+    for _, offset, length, _ in entities:
+        if ends and offset < ends[-1]:
+            ends[-1] = max(ends[-1], offset + length)
+        else:
+            starts.append(offset)
+            ends.append(offset + length)
+    return starts, ends
+
+
+def _inside_entity(covered: tuple, position: int) -> bool:
+    starts, ends = covered
+    index = bisect.bisect_left(starts, position) - 1
+    return index >= 0 and position < ends[index]
+
+
+def _best_cut(text: str, covered: tuple, start: int, limit: int) -> int:
+    # Абзац, строка, пробел — сначала вне сущностей и не в первой половине части
+    half = start + (limit - start) // 2
+    for low in (half, start + 1):
+        for separator in ("\n\n", "\n", " "):
+            position = text.rfind(separator, low, limit)
+            attempts = 0
+            while position != -1 and attempts < 64:
+                if low == start + 1 or not _inside_entity(covered, position):
+                    return position
+                position = text.rfind(separator, low, position)
+                attempts += 1
+    return limit
+
+
+def split_spans(rendered: Rendered, max_length: int = TELEGRAM_MAX_LENGTH) -> list:
+    """Границы частей [(начало, конец), ...] без пробелов по краям."""
+    text = rendered.text
+    size = len(text)
+    astral = _has_astral(text)
+    covered = None
+    spans = []
+    start = 0
+    while True:
+        while start < size and text[start].isspace():
+            start += 1
+        if start >= size:
+            return spans
+        limit = start + max_length
+        if astral:
+            # Символ вне BMP — две единицы: убираем не больше половины лишнего, пока не влезет
+            excess = _utf16_length(text[start:limit]) - max_length
+            while excess > 0:
+                limit -= (excess + 1) // 2
+                excess = _utf16_length(text[start:limit]) - max_length
+        if limit >= size:
+            cut = size
+        else:
+            if covered is None:
+                covered = _covered(rendered.entities)
+            cut = _best_cut(text, covered, start, limit)
+        end = cut
+        while end > start and text[end - 1].isspace():
+            end -= 1
+        spans.append((start, end))
+        start = cut
+
+
+def split_rendered(rendered: Rendered, max_length: int = TELEGRAM_MAX_LENGTH) -> list:
+    spans = split_spans(rendered, max_length)
+    starts = [start for start, _ in spans]
+    entities = [[] for _ in spans]
+    # Сущности отсортированы — раскладываем по частям за один проход
+    for kind, offset, length, extra in rendered.entities:
+        index = max(0, bisect.bisect_right(starts, offset) - 1)
+        while index < len(spans) and spans[index][0] < offset + length:
+            start, end = spans[index]
+            lo, hi = max(offset, start), min(offset + length, end)
+            if hi > lo:
+                entities[index].append((kind, lo - start, hi - lo, extra))
+            index += 1
+    return [Rendered(rendered.text[start:end], part) for (start, end), part in zip(spans, entities)]
+
+
+def render_chunks(text: str, max_length: int = TELEGRAM_MAX_LENGTH) -> list:
+    """Ответ GPT -> части для отдельных сообщений."""
+    return split_rendered(render_markdown(text), max_length)
+
+
+# =========================================
+# Вывод: entities Bot API или MarkdownV2
+# =========================================
+
+def telegram_entities(rendered: Rendered) -> list:
+    """Сущности в формате Bot API (смещения в единицах UTF-16)."""
+    text = rendered.text
+    units = None
+    if _has_astral(text):
+        # Длины в UTF-16 до каждой границы сущностей — нарастающим итогом
+        units = {}
+        total = previous = 0
+        for position in sorted({p for _, offset, length, _ in rendered.entities for p in (offset, offset + length)}):
+            total += _utf16_length(text[previous:position])
+            units[position] = total
+            previous = position
+    result = []
+    for kind, offset, length, extra in rendered.entities:
+        if units is not None:
+            offset, length = units[offset], units[offset + length] - units[offset]
+        entity = {"type": kind, "offset": offset, "length": length}
+        if kind == TEXT_LINK:
+            entity["url"] = extra
+        elif kind == PRE and extra:
+            entity["language"] = extra
+        result.append(entity)
+    return result
+
+
+def to_markdown_v2(rendered: Rendered) -> str:
+    """Тот же результат строкой для parse_mode=MarkdownV2, с экранированием."""
+    text = rendered.text
+    opens = {}
+    for entity in rendered.entities:
+        opens.setdefault(entity[1], []).append(entity)
+    closes = {}
+    for entity in rendered.entities:
+        closes.setdefault(entity[1] + entity[2], []).append(entity)
+    out = []
+    stack = []
+    table = _ESCAPE_TEXT
+    last = 0
+    for position in sorted(set(opens) | set(closes)):
+        out.append(text[last:position].translate(table))
+        last = position
+        while stack and stack[-1][1] + stack[-1][2] == position:
+            kind, _, _, extra = stack.pop()
+            if kind == PRE:
+                out.append("\n```")
+            elif kind == TEXT_LINK:
+                out.append("](" + extra.translate(_ESCAPE_URL) + ")")
+            else:
+                out.append(_MARKDOWN_V2[kind])
+            if kind in (CODE, PRE):
+                table = _ESCAPE_TEXT
+        for entity in sorted(opens.get(position, ()), key=_entity_order):
+            kind, _, length, extra = entity
+            if kind == PRE:
+                out.append("```" + (extra or "") + "\n")
+            elif kind == TEXT_LINK:
+                out.append("[")
+            else:
+                out.append(_MARKDOWN_V2[kind])
+            if kind in (CODE, PRE):
+                table = _ESCAPE_CODE
+            stack.append(entity)
+    out.append(text[last:].translate(table))
+    return "".join(out)
@@ -0,0 +1,140 @@
+# =========================================
+# Персистентные хранилища состояний FSM
+# =========================================
+# MemoryStorage теряет состояния (онбординг, редактирование дневника и т.д.)
+# при каждом перезапуске и не видно другим процессам. Эти хранилища
+# сохраняют их в SQLite-файл (один хост) или в Firestore (несколько
+# процессов за балансировщиком).
+
+import asyncio
+import copy
+import json
+import sqlite3
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DEFAULT_DESTINY
+
+from cache import TTLCache
+from metrics import record_firestore
+from profiler import profile_methods
+
+
+def storage_key_id(key) -> str:
+    parts = [str(key.bot_id), str(key.chat_id), str(key.user_id)]
+    if key.thread_id is not None:
+        parts.append(f"t{key.thread_id}")
+    if key.destiny != DEFAULT_DESTINY:
+        parts.append(key.destiny)
+    return ":".join(parts)
+
+
+def _state_name(state):
+    return state.state if isinstance(state, State) else state
+
+
+class SQLiteStorage(BaseStorage):
+    """Состояния FSM в локальном SQLite-файле; запросы идут в пуле потоков."""
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = asyncio.Lock()
+        self._conn.execute("CREATE TABLE IF NOT EXISTS fsm (key TEXT PRIMARY KEY, state TEXT, data TEXT)")
+        self._conn.commit()
+
+    async def _execute(self, sql: str, params: tuple, fetch: bool = False):
+        def run():
+            cursor = self._conn.execute(sql, params)
+            if fetch:
+                return cursor.fetchone()
+            self._conn.commit()
+            return None
+
+        async with self._lock:
+            return await asyncio.to_thread(run)
+
+    async def set_state(self, key, state=None):
+        await self._execute(
+            "INSERT INTO fsm (key, state, data) VALUES (?, ?, '{}') "
+            "ON CONFLICT(key) DO UPDATE SET state = excluded.state",
+            (storage_key_id(key), _state_name(state)),
+        )
+
+    async def get_state(self, key):
+        row = await self._execute("SELECT state FROM fsm WHERE key = ?", (storage_key_id(key),), fetch=True)
+        return row[0] if row else None
+
+    async def set_data(self, key, data):
+        await self._execute(
+            "INSERT INTO fsm (key, state, data) VALUES (?, NULL, ?) "
+            "ON CONFLICT(key) DO UPDATE SET data = excluded.data",
+            (storage_key_id(key), json.dumps(data, ensure_ascii=False)),
+        )
+
+    async def get_data(self, key):
+        row = await self._execute("SELECT data FROM fsm WHERE key = ?", (storage_key_id(key),), fetch=True)
+        return json.loads(row[0]) if row and row[0] else {}
+
+    async def close(self):
+        self._conn.close()
+
+
+@profile_methods("fsm")
+class FirestoreStorage(BaseStorage):
+    """Состояния FSM в коллекции Firestore (документ на пользователя/чат).
+
+    Локальный write-through кэш с коротким TTL убирает повторные чтения
+    в пределах одного апдейта (aiogram читает состояние несколько раз);
+    TTL должен быть меньше паузы между сообщениями пользователя, чтобы
+    другой процесс не увидел устаревшее состояние.
+    """
+
+    def __init__(self, db, collection: str = "fsm_states", cache_ttl: float = 1.0, cache_size: int = 10000):
+        self._db = db
+        self._collection_name = collection
+        self._cache = TTLCache(maxsize=cache_size, ttl=cache_ttl) if cache_ttl > 0 else None
+
+    @property
+    def _collection(self):
+        # Клиент Firestore может создаваться лениво — не трогаем его при сборке бота
+        return self._db.collection(self._collection_name)
+
+    async def _load(self, key) -> dict:
+        doc_id = storage_key_id(key)
+        if self._cache is not None:
+            record = self._cache.get(doc_id)
+            if record is not None:
+                return record
+        doc = await self._collection.document(doc_id).get()
+        record_firestore("fsm_states.get", reads=1)
+        record = doc.to_dict() if doc.exists else {}
+        record = {"state": record.get("state"), "data": record.get("data") or {}}
+        if self._cache is not None:
+            self._cache.set(doc_id, record)
+        return record
+
+    async def _store(self, key, field: str, value):
+        doc_id = storage_key_id(key)
+        await self._collection.document(doc_id).set({field: value}, merge=[field])
+        record_firestore("fsm_states.set", writes=1)
+        if self._cache is not None:
+            record = self._cache.get(doc_id)
+            if record is not None:
+                record[field] = value
+            else:
+                # Второе поле неизвестно — пусть следующее чтение возьмёт документ целиком
+                self._cache.invalidate(doc_id)
+
+    async def set_state(self, key, state=None):
+        await self._store(key, "state", _state_name(state))
+
+    async def get_state(self, key):
+        return (await self._load(key))["state"]
+
+    async def set_data(self, key, data):
+        await self._store(key, "data", copy.deepcopy(data))
+
+    async def get_data(self, key):
+        return copy.deepcopy((await self._load(key))["data"])
+
+    async def close(self):
+        pass
@@ -0,0 +1,75 @@
+# =========================================
+# Запись истории диалога (users/{id}.history)
+# =========================================
+
+import asyncio
+import logging
+
+
+class HistoryWriter:
+    """Дописывает реплики пользователя и бота в history одной транзакцией.
+
+    При flush_interval > 0 работает как write-behind буфер: реплики копятся
+    в памяти и сбрасываются в Firestore раз в flush_interval секунд и при
+    остановке бота (close), ответ пользователю не ждёт записи.
+    Реплики, вытесненные за limit, передаются в on_overflow(user_id, entries)
+    пачками не меньше summary_batch: до этого они лежат в history сверх limit
+    и вместе с остальными попадают в промпт (merged), где лишнее по бюджету
+    токенов отбрасывает PromptBuilder.
+    """
+
+    def __init__(self, user_repo, limit: int = 5, flush_interval: float = 0.0, on_overflow=None,
+                 summary_batch: int = 0):
+        self._repo = user_repo
+        self.limit = limit
+        self.summary_batch = summary_batch
+        self.flush_interval = flush_interval
+        self._on_overflow = on_overflow
+        self._pending = {}
+        self._task = None
+
+    async def append(self, user_id: str, turns: list):
+        entries = [{"role": role, "text": text} for role, text in turns]
+        if self.flush_interval <= 0:
+            await self._write(user_id, entries)
+            return
+        self._pending.setdefault(user_id, []).extend(entries)
+
+    def merged(self, user_id: str, history: list) -> list:
+        # История из Firestore плюс ещё не сброшенные реплики из буфера — целиком:
+        # всё, что ещё не попало в сводку, должно быть доступно промпту
+        return history + self._pending.get(user_id, [])
+
+    async def _write(self, user_id: str, entries: list):
+        _, dropped = await self._repo.append_history(user_id, entries, self.limit, self.summary_batch)
+        if dropped and self._on_overflow is not None:
+            self._on_overflow(user_id, dropped)
+
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        for user_id, entries in pending.items():
+            try:
+                await self._write(user_id, entries)
+            except Exception:
+                logging.exception("Не удалось записать историю пользователя %s", user_id)
+                # Возвращаем реплики в буфер, чтобы записать их при следующем сбросе
+                self._pending[user_id] = entries + self._pending.get(user_id, [])
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def start(self):
+        if self.flush_interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
@@ -0,0 +1,236 @@
+# =========================================
+# Планировщик запросов к OpenAI
+# =========================================
+# Все вызовы LLM идут через LLMScheduler: глобальный лимит одновременных
+# запросов, token bucket по запросам и токенам в минуту, повторы с
+# экспоненциальной задержкой и джиттером, честная очередь по пользователям
+# (round-robin), чтобы один активный пользователь не занимал все слоты.
+
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+
+from metrics import record_llm, record_llm_error, record_llm_failure, record_llm_retry, record_llm_wait
+from profiler import stage
+from ratelimit import TokenBucket
+from services import LazyModule
+
+# openai импортируется при первом запросе, а не при старте бота
+openai = LazyModule("openai")
+_retryable_errors = None
+
+
+def retryable_errors() -> tuple:
+    global _retryable_errors
+    if _retryable_errors is None:
+        _retryable_errors = (
+            openai.RateLimitError,
+            openai.APITimeoutError,
+            openai.APIConnectionError,
+            openai.InternalServerError,
+        )
+    return _retryable_errors
+
+
+class LLMUnavailableError(Exception):
+    """OpenAI не ответил после всех повторов."""
+
+
+def estimate_tokens(messages: list, max_tokens: int = 0) -> int:
+    # Грубая оценка для лимитов: ~3 символа на токен для русского текста
+    chars = sum(len(message.get("content") or "") for message in messages)
+    return chars // 3 + max_tokens
+
+
+def _retry_after(error) -> float:
+    response = getattr(error, "response", None)
+    if response is None:
+        return 0.0
+    try:
+        return float(response.headers.get("retry-after", 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class LLMScheduler:
+    def __init__(
+        self,
+        max_concurrency: int = 8,
+        requests_per_minute: float = 500,
+        tokens_per_minute: float = 200000,
+        max_retries: int = 4,
+        base_delay: float = 1.0,
+        max_delay: float = 30.0,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._requests = TokenBucket(requests_per_minute / 60, capacity=max(1.0, requests_per_minute / 60))
+        self._tokens = TokenBucket(tokens_per_minute / 60, capacity=tokens_per_minute / 6)
+        self._queues = {}
+        self._ring = deque()
+        self._active = 0
+        # Метрики
+        self.waiting = 0
+        self.max_waiting = 0
+        self.wait_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.retries = 0
+        self.failures = 0
+
+    def _pump(self):
+        # Раздаёт свободные слоты по кругу: по одному запросу от каждого пользователя
+        while self._active < self.max_concurrency and self._ring:
+            user_id = self._ring.popleft()
+            queue = self._queues[user_id]
+            ticket = queue.popleft()
+            if queue:
+                self._ring.append(user_id)
+            else:
+                del self._queues[user_id]
+            if not ticket.done():
+                self._active += 1
+                ticket.set_result(None)
+
+    async def _acquire_slot(self, user_id: str, purpose: str):
+        ticket = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(user_id)
+        if queue is None:
+            queue = self._queues[user_id] = deque()
+            self._ring.append(user_id)
+        queue.append(ticket)
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        started = time.monotonic()
+        self._pump()
+        try:
+            await ticket
+        except asyncio.CancelledError:
+            if ticket.done() and not ticket.cancelled():
+                # Слот уже выдан, но ждать его перестали — возвращаем
+                self._release()
+            raise
+        finally:
+            self.waiting -= 1
+        waited = time.monotonic() - started
+        self.wait_count += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        record_llm_wait(purpose, waited)
+
+    def _release(self):
+        self._active -= 1
+        self._pump()
+
+    async def run(self, user_id: str, call, tokens: int = 0, purpose: str = "chat"):
+        """Выполняет call() (корутинную функцию с запросом к OpenAI) с учётом
+        лимитов. При исчерпании повторов бросает LLMUnavailableError.
+        purpose — метка запроса в метриках (chat, topic, food, summary)."""
+        for attempt in range(self.max_retries + 1):
+            with stage("openai.queue"):
+                await self._acquire_slot(user_id, purpose)
+            try:
+                with stage("openai.queue"):
+                    await self._requests.acquire(1)
+                    await self._tokens.acquire(tokens)
+                started = time.monotonic()
+                with stage(f"openai.{purpose}"):
+                    response = await call()
+                # У потокового ответа usage нет — токены записывает вызывающий код
+                usage = getattr(response, "usage", None)
+                record_llm(
+                    purpose, time.monotonic() - started, user_id,
+                    getattr(usage, "prompt_tokens", 0) or 0, getattr(usage, "completion_tokens", 0) or 0,
+                )
+                return response
+            except retryable_errors() as e:
+                error = e
+                record_llm_error(purpose, e)
+            except Exception as e:
+                record_llm_error(purpose, e)
+                raise
+            finally:
+                self._release()
+            if attempt == self.max_retries:
+                break
+            await self._backoff(attempt, error, purpose)
+        self._fail(purpose)
+        raise LLMUnavailableError(str(error)) from error
+
+    async def stream(self, user_id: str, call, tokens: int = 0, purpose: str = "chat"):
+        """Как run(), но для call() с stream=True: асинхронный генератор
+        фрагментов ответа. Слот занят, пока поток не дочитан (или генератор не
+        закрыт — используйте contextlib.aclosing). Повтор возможен, пока
+        пользователю не отдан ни один фрагмент; ошибка OpenAI посреди ответа
+        превращается в LLMUnavailableError."""
+        for attempt in range(self.max_retries + 1):
+            with stage("openai.queue"):
+                await self._acquire_slot(user_id, purpose)
+            streamed = False
+            try:
+                with stage("openai.queue"):
+                    await self._requests.acquire(1)
+                    await self._tokens.acquire(tokens)
+                started = time.monotonic()
+                with stage(f"openai.{purpose}"):
+                    response = await call()
+                # Время до первого ответа; токены записывает вызывающий код
+                record_llm(purpose, time.monotonic() - started, user_id)
+                chunks = response.__aiter__()
+                while True:
+                    with stage("openai.stream"):
+                        try:
+                            chunk = await chunks.__anext__()
+                        except StopAsyncIteration:
+                            return
+                    streamed = True
+                    yield chunk
+            except retryable_errors() as e:
+                error = e
+                record_llm_error(purpose, e)
+                if streamed:
+                    self._fail(purpose)
+                    raise LLMUnavailableError(str(e)) from e
+            except Exception as e:
+                if isinstance(e, openai.APIError) or not streamed:
+                    record_llm_error(purpose, e)
+                if streamed and isinstance(e, openai.APIError):
+                    self._fail(purpose)
+                    raise LLMUnavailableError(str(e)) from e
+                raise
+            finally:
+                self._release()
+            if attempt == self.max_retries:
+                break
+            await self._backoff(attempt, error, purpose)
+        self._fail(purpose)
+        raise LLMUnavailableError(str(error)) from error
+
+    def _fail(self, purpose: str):
+        self.failures += 1
+        record_llm_failure(purpose)
+
+    async def _backoff(self, attempt: int, error, purpose: str):
+        self.retries += 1
+        record_llm_retry(purpose)
+        retry_after = _retry_after(error)
+        if isinstance(error, openai.RateLimitError):
+            self._requests.pause(retry_after or self.base_delay)
+        delay = max(retry_after, random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
+        logging.warning("OpenAI: %s, повтор %s через %.1f с", type(error).__name__, attempt + 1, delay)
+        await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        return {
+            "active": self._active,
+            "queue_depth": self.waiting,
+            "max_queue_depth": self.max_waiting,
+            "wait_avg": self.wait_total / self.wait_count if self.wait_count else 0.0,
+            "wait_max": self.wait_max,
+            "retries": self.retries,
+            "failures": self.failures,
+        }
@@ -0,0 +1,342 @@
+# =========================================
+# Firestore в памяти для нагрузочных тестов
+# =========================================
+# Поддерживает ровно то подмножество async-клиента, которым пользуются
+# repository.py и fsm_storage.py: документы и подколлекции, set/update/
+# delete, запросы where/order_by/select/limit/start_after, get_all, пакеты
+# и транзакции с оптимистичной блокировкой (как у Firestore: транзакция
+# перезапускается, если прочитанный документ изменили). Каждый вызов к
+# «серверу» ждёт latency секунд (± jitter) и учитывается в счётчиках.
+#
+# Вместе с клиентом нужен модуль-заместитель firebase_admin.firestore
+# (FakeFirestoreModule) — декоратор транзакций, Query, Increment.
+
+import asyncio
+import copy
+import itertools
+import random
+import uuid
+
+_MISSING = object()
+
+
+class Increment:
+    def __init__(self, value):
+        self.value = value
+
+
+class Query:
+    ASCENDING = "ASCENDING"
+    DESCENDING = "DESCENDING"
+
+
+class TransactionConflict(Exception):
+    """Прочитанный в транзакции документ изменили до коммита."""
+
+
+class FakeFirestoreModule:
+    """Заместитель firebase_admin.firestore для repository.firestore."""
+
+    Increment = Increment
+    Query = Query
+
+    @staticmethod
+    def async_transactional(fn, max_attempts: int = 5):
+        async def run(transaction, *args, **kwargs):
+            for attempt in range(max_attempts):
+                transaction._begin()
+                try:
+                    result = await fn(transaction, *args, **kwargs)
+                    await transaction._commit()
+                    return result
+                except TransactionConflict:
+                    transaction.client.conflicts += 1
+                    if attempt == max_attempts - 1:
+                        raise
+        return run
+
+
+def _apply_value(old, new):
+    # Increment внутри set/update: прибавляем к текущему числу
+    if isinstance(new, Increment):
+        return (old if isinstance(old, (int, float)) else 0) + new.value
+    if isinstance(new, dict):
+        return {key: _apply_value(None, value) for key, value in new.items()}
+    return copy.deepcopy(new)
+
+
+def _merge(old: dict, new: dict) -> dict:
+    # set(merge=True): вложенные словари сливаются поле за полем
+    result = dict(old)
+    for key, value in new.items():
+        if isinstance(value, dict) and isinstance(result.get(key), dict):
+            result[key] = _merge(result[key], value)
+        else:
+            result[key] = _apply_value(result.get(key), value)
+    return result
+
+
+def _set_path(data: dict, path: str, value):
+    # update({"params.вес": ...}): точка разделяет вложенные поля
+    *parents, leaf = path.split(".")
+    for part in parents:
+        child = data.get(part)
+        if not isinstance(child, dict):
+            child = data[part] = {}
+        data = child
+    data[leaf] = _apply_value(data.get(leaf), value)
+
+
+class DocumentSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+
+class DocumentReference:
+    def __init__(self, client, path: tuple):
+        self._client = client
+        self.path = path
+        self.id = path[-1]
+
+    def collection(self, name: str):
+        return CollectionReference(self._client, self.path + (name,))
+
+    async def get(self, transaction=None):
+        await self._client._rpc(reads=1)
+        if transaction is not None:
+            transaction._read(self.path)
+        return DocumentSnapshot(self, self._client._docs.get(self.path))
+
+    async def set(self, data: dict, merge=False):
+        await self._client._rpc(writes=1)
+        self._client._set(self.path, data, merge)
+
+    async def update(self, fields: dict):
+        await self._client._rpc(writes=1)
+        self._client._update(self.path, fields)
+
+    async def delete(self):
+        await self._client._rpc(writes=1)
+        self._client._delete(self.path)
+
+
+class CollectionReference:
+    def __init__(self, client, path: tuple, filters=(), orders=(), fields=None, limit=None, after=None):
+        self._client = client
+        self.path = path
+        self._filters = filters
+        self._orders = orders
+        self._fields = fields
+        self._limit = limit
+        self._after = after
+
+    def _copy(self, **changes):
+        state = {
+            "filters": self._filters, "orders": self._orders, "fields": self._fields,
+            "limit": self._limit, "after": self._after,
+        }
+        state.update(changes)
+        return CollectionReference(self._client, self.path, **state)
+
+    def document(self, document_id: str = None):
+        return DocumentReference(self._client, self.path + (document_id or uuid.uuid4().hex[:20],))
+
+    def where(self, field: str, op: str, value):
+        return self._copy(filters=self._filters + ((field, op, value),))
+
+    def order_by(self, field: str, direction: str = Query.ASCENDING):
+        return self._copy(orders=self._orders + ((field, direction),))
+
+    def select(self, fields):
+        return self._copy(fields=list(fields))
+
+    def limit(self, count: int):
+        return self._copy(limit=count)
+
+    def start_after(self, values: dict):
+        return self._copy(after=values)
+
+    def _matches(self, data: dict) -> bool:
+        for field, op, value in self._filters:
+            actual = data.get(field, _MISSING)
+            if op == "==":
+                ok = actual == value
+            elif op == "array_contains_any":
+                ok = isinstance(actual, list) and any(item in actual for item in value)
+            elif op == "array_contains":
+                ok = isinstance(actual, list) and value in actual
+            elif op == "in":
+                ok = actual in value
+            else:
+                raise NotImplementedError(f"FakeFirestore: оператор {op!r} не поддерживается")
+            if not ok:
+                return False
+        return True
+
+    def _run(self) -> list:
+        store = self._client._docs
+        docs = [
+            (doc_id, store[self.path + (doc_id,)]) for doc_id in self._client._children.get(self.path, ())
+        ]
+        docs = [(doc_id, data) for doc_id, data in docs if self._matches(data)]
+        for field, direction in reversed(self._orders or (("__name__", Query.ASCENDING),)):
+            def key(item, field=field):
+                value = item[0] if field == "__name__" else item[1].get(field)
+                return (value is None, value)
+            docs.sort(key=key, reverse=direction == Query.DESCENDING)
+        if self._after is not None:
+            after = self._after.get("__name__")
+            docs = [doc for doc in docs if doc[0] > after]
+        if self._limit is not None:
+            docs = docs[:self._limit]
+        if self._fields is not None:
+            docs = [(doc_id, {f: data[f] for f in self._fields if f in data}) for doc_id, data in docs]
+        return docs
+
+    async def stream(self, transaction=None):
+        await self._client._rpc()
+        docs = self._run()
+        # Запрос тарифицируется минимум одним чтением
+        self._client.stats["reads"] += max(1, len(docs))
+        for doc_id, data in docs:
+            path = self.path + (doc_id,)
+            if transaction is not None:
+                transaction._read(path)
+            yield DocumentSnapshot(DocumentReference(self._client, path), copy.deepcopy(data))
+
+
+class WriteBatch:
+    def __init__(self, client):
+        self.client = client
+        self._writes = []
+
+    def set(self, reference, data: dict, merge=False):
+        self._writes.append(("set", reference.path, data, merge))
+
+    def update(self, reference, fields: dict):
+        self._writes.append(("update", reference.path, fields, None))
+
+    def delete(self, reference):
+        self._writes.append(("delete", reference.path, None, None))
+
+    def _apply(self):
+        for kind, path, data, merge in self._writes:
+            if kind == "set":
+                self.client._set(path, data, merge)
+            elif kind == "update":
+                self.client._update(path, data)
+            else:
+                self.client._delete(path)
+        self._writes = []
+
+    async def commit(self):
+        await self.client._rpc(writes=len(self._writes))
+        self._apply()
+
+
+class Transaction(WriteBatch):
+    def __init__(self, client):
+        super().__init__(client)
+        self._versions = {}
+
+    def _begin(self):
+        self._writes = []
+        self._versions = {}
+
+    def _read(self, path: tuple):
+        self._versions.setdefault(path, self.client._versions.get(path, 0))
+
+    async def _commit(self):
+        await self.client._rpc()
+        # Проверка и запись без await между ними — атомарно для event loop
+        if any(self.client._versions.get(path, 0) != version for path, version in self._versions.items()):
+            raise TransactionConflict()
+        self.client.stats["writes"] += len(self._writes)
+        self._apply()
+
+
+class FakeFirestore:
+    """Асинхронный клиент Firestore в памяти процесса."""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, seed: int = None):
+        self.latency = latency
+        self.jitter = jitter
+        self._random = random.Random(seed)
+        self._docs = {}
+        # Индекс документов по коллекциям: путь коллекции -> id документов
+        self._children = {}
+        self._versions = {}
+        self._version_counter = itertools.count(1)
+        # rpc — вызовы к «серверу», reads/writes — документы (как в тарификации Firestore)
+        self.stats = {"rpc": 0, "reads": 0, "writes": 0}
+        self.conflicts = 0
+
+    async def _rpc(self, reads: int = 0, writes: int = 0):
+        self.stats["rpc"] += 1
+        self.stats["reads"] += reads
+        self.stats["writes"] += writes
+        delay = self.latency + (self._random.uniform(-self.jitter, self.jitter) if self.jitter else 0.0)
+        # Даже при нулевой задержке отдаём управление, как настоящий сетевой вызов
+        await asyncio.sleep(max(0.0, delay))
+
+    def _touch(self, path: tuple):
+        self._versions[path] = next(self._version_counter)
+        if path in self._docs:
+            self._children.setdefault(path[:-1], set()).add(path[-1])
+        else:
+            self._children.get(path[:-1], set()).discard(path[-1])
+
+    def _set(self, path: tuple, data: dict, merge):
+        old = self._docs.get(path) or {}
+        if merge is True:
+            self._docs[path] = _merge(old, data)
+        elif merge:
+            # merge=[поля]: меняются только перечисленные поля
+            updated = dict(old)
+            for field in merge:
+                updated[field] = _apply_value(old.get(field), data.get(field))
+            self._docs[path] = updated
+        else:
+            self._docs[path] = {key: _apply_value(None, value) for key, value in data.items()}
+        self._touch(path)
+
+    def _update(self, path: tuple, fields: dict):
+        if path not in self._docs:
+            raise KeyError(f"FakeFirestore: документ {'/'.join(path)} не найден (update)")
+        data = copy.deepcopy(self._docs[path])
+        for field, value in fields.items():
+            _set_path(data, field, value)
+        self._docs[path] = data
+        self._touch(path)
+
+    def _delete(self, path: tuple):
+        self._docs.pop(path, None)
+        self._touch(path)
+
+    def collection(self, name: str):
+        return CollectionReference(self, (name,))
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def transaction(self):
+        return Transaction(self)
+
+    async def get_all(self, references):
+        references = list(references)
+        await self._rpc(reads=len(references))
+        for reference in references:
+            yield DocumentSnapshot(reference, copy.deepcopy(self._docs.get(reference.path)))
+
+    def count(self, collection: str) -> int:
+        # Документов во всех коллекциях с таким именем (в том числе подколлекциях)
+        return sum(len(ids) for path, ids in self._children.items() if path[-1] == collection)
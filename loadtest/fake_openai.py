@@ -0,0 +1,134 @@
+# =========================================
+# Локальный сервер, отвечающий как OpenAI Chat Completions
+# =========================================
+# Настоящий клиент openai ходит сюда через OPENAI_BASE_URL, поэтому под
+# нагрузкой работают и сам клиент, и разбор потокового ответа (SSE).
+# Ответ зависит от запроса: проверка темы ("да"), оценка КБЖУ (JSON),
+# сводка истории и обычный ответ пользователю. latency — время до первого
+# токена, tokens_per_second — скорость генерации, error_rate — доля 429.
+
+import asyncio
+import itertools
+import json
+import random
+import time
+
+from aiohttp import web
+
+ANSWER = (
+    "**Коротко:** для результата важны регулярность и питание.\n\n"
+    "• Тренируйся 3–4 раза в неделю, чередуя силовые и кардио.\n"
+    "• Держи белок на уровне 1,6–2 г на кг веса.\n"
+    "• Спи 7–9 часов — восстановление не менее важно, чем нагрузка.\n"
+)
+
+
+def _tokens(text: str) -> int:
+    # Та же грубая оценка, что в llm.estimate_tokens
+    return max(1, len(text) // 3)
+
+
+class FakeOpenAIServer:
+    def __init__(self, latency: float = 0.5, tokens_per_second: float = 80.0, answer_tokens: int = 250,
+                 error_rate: float = 0.0, seed: int = None):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.answer_tokens = answer_tokens
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._ids = itertools.count(1)
+        self._runner = None
+        self.base_url = None
+        self.stats = {"requests": 0, "streamed": 0, "errors": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.base_url = f"http://{host}:{port}/v1"
+        return self.base_url
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def _reply(self, body: dict) -> str:
+        messages = body.get("messages") or []
+        last = messages[-1]["content"] if messages else ""
+        if (body.get("response_format") or {}).get("type") == "json_object":
+            try:
+                names = json.loads(last)
+            except ValueError:
+                names = []
+            foods = [
+                {"name": name, "kcal": 150, "protein": 8, "fat": 5, "carbs": 18, "piece_g": None}
+                for name in names
+            ]
+            return json.dumps({"foods": foods}, ensure_ascii=False)
+        if (body.get("max_tokens") or 0) <= 10:
+            return "да"
+        if messages and messages[0]["content"].startswith("Сожми переписку"):
+            return "Пользователь хочет похудеть, тренируется дома, колено не нагружать."
+        # Ответ нужной длины: повторяем образец до answer_tokens токенов
+        repeats = max(1, self.answer_tokens * 3 // len(ANSWER))
+        return (ANSWER * repeats)[:self.answer_tokens * 3]
+
+    async def _handle(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.stats["requests"] += 1
+        await asyncio.sleep(self.latency)
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.stats["errors"] += 1
+            return web.json_response(
+                {"error": {"message": "Rate limit reached (fake)", "type": "requests", "code": "rate_limit_exceeded"}},
+                status=429, headers={"retry-after": "0"},
+            )
+        content = self._reply(body)
+        prompt_tokens = sum(_tokens(m.get("content") or "") for m in body.get("messages") or [])
+        completion_tokens = _tokens(content)
+        self.stats["prompt_tokens"] += prompt_tokens
+        self.stats["completion_tokens"] += completion_tokens
+        completion_id = f"chatcmpl-fake{next(self._ids)}"
+        created = int(time.time())
+        if not body.get("stream"):
+            await asyncio.sleep(completion_tokens / self.tokens_per_second)
+            return web.json_response({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": body.get("model", "gpt-4o-mini"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+            })
+        self.stats["streamed"] += 1
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def send(delta: dict, finish_reason=None):
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": body.get("model", "gpt-4o-mini"),
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+
+        await send({"role": "assistant", "content": ""})
+        # Куски по ~4 токена (12 символов) со скоростью tokens_per_second
+        step = 12
+        for i in range(0, len(content), step):
+            await asyncio.sleep(4 / self.tokens_per_second)
+            await send({"content": content[i:i + step]})
+        await send({}, finish_reason="stop")
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
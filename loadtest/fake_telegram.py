@@ -0,0 +1,67 @@
+# =========================================
+# Telegram без сети: сессия-заглушка Bot API и генератор апдейтов
+# =========================================
+# FakeSession отвечает на методы Bot API после latency секунд и считает
+# вызовы; апдейты подаются прямо в Dispatcher.feed_update, минуя polling
+# и webhook.
+
+import asyncio
+import itertools
+import time
+from collections import Counter
+
+from aiogram import types
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import EditMessageText, SendMessage
+
+
+class FakeSession(BaseSession):
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls[type(method).__name__] += 1
+        await asyncio.sleep(self.latency)
+        if isinstance(method, (SendMessage, EditMessageText)):
+            return types.Message(
+                message_id=getattr(method, "message_id", None) or next(self._message_ids),
+                date=int(time.time()),
+                chat=types.Chat(id=method.chat_id or 0, type="private"),
+                text=method.text,
+            )
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+    @property
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+
+class UpdateFactory:
+    """Апдейты с текстовыми сообщениями от пользователей с заданным id."""
+
+    def __init__(self, first_user_id: int = 10 ** 9):
+        self.first_user_id = first_user_id
+        self._update_ids = itertools.count(1)
+
+    def message(self, user_index: int, text: str) -> types.Update:
+        user_id = self.first_user_id + user_index
+        update_id = next(self._update_ids)
+        return types.Update.model_validate({
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private", "first_name": f"Load{user_index}"},
+                "from": {"id": user_id, "is_bot": False, "first_name": f"Load{user_index}", "language_code": "ru"},
+                "text": text,
+            },
+        })
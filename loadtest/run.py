@@ -0,0 +1,234 @@
+# =========================================
+# Нагрузочный тест bot.py без сети
+# =========================================
+# Запуск из корня репозитория:
+#   python loadtest/run.py --users 50 --duration 30
+#   python loadtest/run.py --users 20 --iterations 10 --json result.json --max-p95-ms 3000
+#
+# Виртуальные пользователи проходят онбординг, затем сценарии из смеси
+# (--mix) и отправляют следующее сообщение, как только бот ответил на
+# предыдущее (плюс --think секунд). Апдейты подаются в Dispatcher
+# напрямую; Telegram — FakeSession, Firestore — FakeFirestore в памяти,
+# OpenAI — локальный FakeOpenAIServer (через OPENAI_BASE_URL). Остальные
+# настройки бота берутся из переменных окружения как обычно; лимиты
+# OpenAI по умолчанию подняты, чтобы мерить сам бот, а не лимит аккаунта.
+#
+# Результат: пропускная способность, p50/p95/p99 задержки ответа на апдейт
+# (всего и по сценариям), обращения к Firestore, OpenAI и Telegram на
+# апдейт. С --max-* порогами код выхода 1 при их превышении — для CI.
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_firestore import FakeFirestore, FakeFirestoreModule
+from fake_openai import FakeOpenAIServer
+from fake_telegram import FakeSession, UpdateFactory
+from scenarios import MIX, ONBOARDING, SCENARIOS, parse_mix
+
+BOT_ENV = {
+    "BOT_TOKEN": "123456:loadtest",
+    "OPENAI_API_KEY": "sk-loadtest",
+    "BOT_MODE": "polling",
+    "METRICS_LOG_INTERVAL": "0",
+    "OPENAI_RPM": "1000000",
+    "OPENAI_TPM": "1000000000",
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с локальными заглушками сервисов")
+    parser.add_argument("--users", type=int, default=20, help="одновременных пользователей")
+    parser.add_argument("--duration", type=float, default=20.0, help="длительность, с (если не задано --iterations)")
+    parser.add_argument("--iterations", type=int, default=0, help="сценариев на пользователя после онбординга")
+    parser.add_argument("--mix", default=None, help="смесь сценариев: question=30,diary_add=20,...")
+    parser.add_argument("--think", type=float, default=0.0, help="пауза пользователя между сообщениями, с")
+    parser.add_argument("--firestore-latency", type=float, default=0.02)
+    parser.add_argument("--firestore-jitter", type=float, default=0.005)
+    parser.add_argument("--openai-latency", type=float, default=0.4, help="время до первого токена, с")
+    parser.add_argument("--openai-tps", type=float, default=80.0, help="токенов в секунду")
+    parser.add_argument("--openai-error-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--telegram-latency", type=float, default=0.03)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="сохранить результат в файл")
+    parser.add_argument("--max-p95-ms", type=float, help="порог p95 задержки апдейта")
+    parser.add_argument("--max-firestore-reads", type=float, help="порог чтений Firestore на апдейт")
+    parser.add_argument("--max-llm-calls", type=float, help="порог запросов к OpenAI на апдейт")
+    parser.add_argument("--verbose", action="store_true", help="не глушить логи бота")
+    return parser.parse_args()
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99]) * 1000
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99), "max": float(max(values)) * 1000}
+
+
+class LoadTest:
+    def __init__(self, args, app):
+        self.args = args
+        self.app = app
+        self.updates = UpdateFactory()
+        self.mix = parse_mix(args.mix) if args.mix else MIX
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    async def send(self, user: int, text: str, scenario: str):
+        update = self.updates.message(user, text)
+        started = time.perf_counter()
+        try:
+            await self.app.dp.feed_update(self.app.bot, update)
+        except Exception as e:
+            self.errors[f"{scenario}: {type(e).__name__}: {e}"[:200]] += 1
+        self.latencies[scenario].append(time.perf_counter() - started)
+        if self.args.think:
+            await asyncio.sleep(self.args.think)
+
+    async def user(self, user: int, deadline: float):
+        rng = random.Random(self.args.seed * 100003 + user)
+        state = {}
+        for text in SCENARIOS[ONBOARDING](rng, state):
+            await self.send(user, text, ONBOARDING)
+        names, weights = list(self.mix), list(self.mix.values())
+        iteration = 0
+        while (iteration < self.args.iterations) if self.args.iterations else (time.monotonic() < deadline):
+            scenario = rng.choices(names, weights)[0]
+            for text in SCENARIOS[scenario](rng, state):
+                await self.send(user, text, scenario)
+            iteration += 1
+
+    async def run(self) -> float:
+        deadline = time.monotonic() + self.args.duration
+        started = time.perf_counter()
+        await asyncio.gather(*(self.user(user, deadline) for user in range(self.args.users)))
+        return time.perf_counter() - started
+
+
+def llm_calls_by_purpose(metrics) -> dict:
+    calls = defaultdict(int)
+    for (name, labels), histogram in metrics._histograms.items():
+        if name == "bot_openai_request_duration_seconds":
+            calls[dict(labels)["purpose"]] += histogram.count
+    return dict(calls)
+
+
+async def main():
+    args = parse_args()
+    openai_server = FakeOpenAIServer(
+        latency=args.openai_latency, tokens_per_second=args.openai_tps,
+        error_rate=args.openai_error_rate, seed=args.seed,
+    )
+    base_url = await openai_server.start()
+    for key, value in BOT_ENV.items():
+        os.environ.setdefault(key, value)
+    os.environ["OPENAI_BASE_URL"] = base_url
+
+    import bot as app
+    import repository
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    # Заглушки вместо внешних сервисов: модуль firestore в репозиториях, клиент базы, сессия Telegram
+    repository.firestore = FakeFirestoreModule
+    db = FakeFirestore(latency=args.firestore_latency, jitter=args.firestore_jitter, seed=args.seed)
+    app.db.set(db)
+    session = FakeSession(latency=args.telegram_latency)
+    app.bot.session = session
+
+    await app.dp.emit_startup(dispatcher=app.dp, bot=app.bot, bots=[app.bot])
+    # Клиент OpenAI создаётся в фоне при старте — ждём, чтобы не мерить холодный старт
+    await asyncio.gather(*list(app.background_tasks))
+
+    test = LoadTest(args, app)
+    elapsed = await test.run()
+    # Фоновая работа (оценка КБЖУ, сводки истории) дописывается при остановке и входит в счётчики
+    await app.dp.emit_shutdown(dispatcher=app.dp, bot=app.bot, bots=[app.bot])
+    await openai_server.close()
+
+    all_latencies = [value for values in test.latencies.values() for value in values]
+    updates = len(all_latencies)
+    llm_calls = llm_calls_by_purpose(app.metrics)
+    result = {
+        "users": args.users,
+        "updates": updates,
+        "errors": sum(test.errors.values()),
+        "elapsed_s": elapsed,
+        "throughput": updates / elapsed if elapsed else 0.0,
+        "latency_ms": percentiles(all_latencies),
+        "scenarios": {
+            name: {"updates": len(values), **percentiles(values)} for name, values in sorted(test.latencies.items())
+        },
+        "per_update": {
+            "firestore_rpc": db.stats["rpc"] / updates,
+            "firestore_reads": db.stats["reads"] / updates,
+            "firestore_writes": db.stats["writes"] / updates,
+            "llm_calls": openai_server.stats["requests"] / updates,
+            "telegram_calls": session.total_calls / updates,
+        },
+        "firestore_conflicts": db.conflicts,
+        "llm_calls": llm_calls,
+        "llm_tokens": {
+            "prompt": openai_server.stats["prompt_tokens"],
+            "completion": openai_server.stats["completion_tokens"],
+        },
+        "telegram_calls": dict(session.calls),
+    }
+    report(result, test.errors)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    return check_thresholds(args, result)
+
+
+def report(result: dict, errors: dict):
+    latency = result["latency_ms"]
+    per_update = result["per_update"]
+    print(f"\n{result['users']} пользователей, {result['updates']} апдейтов за {result['elapsed_s']:.1f} с "
+          f"— {result['throughput']:.1f} апд./с, ошибок: {result['errors']}")
+    print(f"задержка, мс: p50 {latency['p50']:.0f}  p95 {latency['p95']:.0f}  p99 {latency['p99']:.0f}  max {latency['max']:.0f}")
+    print(f"\n{'сценарий':<15}{'апдейтов':>10}{'p50':>8}{'p95':>8}{'p99':>8}")
+    for name, stats in result["scenarios"].items():
+        print(f"{name:<15}{stats['updates']:>10}{stats['p50']:>8.0f}{stats['p95']:>8.0f}{stats['p99']:>8.0f}")
+    print("\nна апдейт: "
+          f"Firestore {per_update['firestore_rpc']:.2f} вызовов ({per_update['firestore_reads']:.2f} чтений, "
+          f"{per_update['firestore_writes']:.2f} записей), OpenAI {per_update['llm_calls']:.3f}, "
+          f"Telegram {per_update['telegram_calls']:.2f}")
+    print(f"OpenAI по назначению: {result['llm_calls']}, токенов: {result['llm_tokens']}")
+    if result["firestore_conflicts"]:
+        print(f"перезапусков транзакций Firestore: {result['firestore_conflicts']}")
+    for error, count in sorted(errors.items(), key=lambda item: -item[1])[:10]:
+        print(f"  ошибка ×{count}: {error}")
+
+
+def check_thresholds(args, result: dict) -> int:
+    failures = []
+    if result["errors"]:
+        failures.append(f"ошибок при обработке: {result['errors']}")
+    if args.max_p95_ms is not None and result["latency_ms"]["p95"] > args.max_p95_ms:
+        failures.append(f"p95 {result['latency_ms']['p95']:.0f} мс > {args.max_p95_ms:g}")
+    if args.max_firestore_reads is not None and result["per_update"]["firestore_reads"] > args.max_firestore_reads:
+        failures.append(f"чтений Firestore на апдейт {result['per_update']['firestore_reads']:.2f} > {args.max_firestore_reads:g}")
+    if args.max_llm_calls is not None and result["per_update"]["llm_calls"] > args.max_llm_calls:
+        failures.append(f"запросов к OpenAI на апдейт {result['per_update']['llm_calls']:.3f} > {args.max_llm_calls:g}")
+    for failure in failures:
+        print(f"ПОРОГ: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    exit_code = asyncio.run(main())
+    sys.stdout.flush()
+    # Потоки фонового прогрева клиентов не держат процесс
+    os._exit(exit_code)
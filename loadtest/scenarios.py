@@ -0,0 +1,123 @@
+# =========================================
+# Сценарии нагрузочного теста: последовательности сообщений пользователя
+# =========================================
+# Каждый сценарий — функция (random.Random, состояние пользователя) ->
+# список текстов, которые виртуальный пользователь отправляет по очереди,
+# как нажатия кнопок и ответы в диалогах бота. В состоянии пользователя
+# сценарии запоминают, что он уже записал: правка и удаление идут в тот
+# раздел дневника, где есть записи. MIX — доли сценариев в смеси.
+
+ONBOARDING = "onboarding"
+
+KNOWN_FOODS = ["овсянка", "гречка", "куриная грудка", "банан", "творог 5%", "омлет из 2 яиц", "салат цезарь"]
+QUANTITIES = ["200 г", "150 гр", "1 шт", "250 г", "2 шт", "1 порция"]
+MEAL_BUTTONS = ["🍳 Завтрак", "🍲 Обед", "🍽 Ужин", "🍎 Перекус"]
+QUESTIONS = [
+    "Как накачать пресс дома без инвентаря?",
+    "Сколько белка нужно в день при похудении?",
+    "Что лучше для сжигания жира: бег или силовые?",
+    "Можно ли тренироваться каждый день?",
+    "Как восстановиться после тяжёлой тренировки ног?",
+    "Сколько воды пить во время тренировки?",
+    "Какие упражнения безопасны при больном колене?",
+    "Что съесть перед утренней тренировкой?",
+]
+
+
+def onboarding(rng, user):
+    return [
+        "/start",
+        rng.choice(["мужчина", "женщина"]),
+        str(rng.randint(55, 110)),
+        str(rng.randint(155, 195)),
+        str(rng.randint(18, 60)),
+        rng.choice(["нет ограничений", "болит колено", "нет"]),
+        f"похудеть до {rng.randint(55, 80)} кг",
+        "Лёгкая активность (1.375)",
+    ]
+
+
+def question(rng, user):
+    # Часть вопросов повторяется у разных пользователей — как в жизни (и для кэша ответов)
+    if rng.random() < 0.5:
+        return [rng.choice(QUESTIONS)]
+    return [f"{rng.choice(QUESTIONS)} Мне {rng.randint(18, 60)} лет, вешу {rng.randint(55, 110)} кг."]
+
+
+def diary_add(rng, user):
+    # Примерно каждое пятое блюдо неизвестно локальной таблице — его оценит GPT пачкой
+    meal = rng.choice(KNOWN_FOODS) if rng.random() < 0.8 else f"домашнее блюдо №{rng.randint(1, 200)}"
+    button = rng.choice(MEAL_BUTTONS)
+    user.setdefault("meals", []).append(button)
+    return ["📒 Дневник питания", "✅ Добавить запись (питание)", button, meal, rng.choice(QUANTITIES)]
+
+
+def diary_edit(rng, user):
+    if not user.get("meals"):
+        return diary_add(rng, user)
+    button = rng.choice(user["meals"])
+    return ["✏️ Изменить последнюю запись (питание)", button, "⚖️ Количество", rng.choice(QUANTITIES)]
+
+
+def diary_delete(rng, user):
+    if not user.get("meals"):
+        return diary_add(rng, user)
+    button = user["meals"].pop(rng.randrange(len(user["meals"])))
+    return ["🗑 Удалить последнюю запись (питание)", button, "✅ Да, удалить"]
+
+
+def diary_view(rng, user):
+    return [rng.choice(["📅 Итоги за день и неделю (питание)", "📌 Последние записи (питание)"])]
+
+
+def progress_add(rng, user):
+    return [
+        "📊 Мой прогресс",
+        "✅ Добавить запись (прогресс)",
+        f"{rng.uniform(60, 100):.1f}".replace(".", ","),
+        rng.choice([f"талия {rng.randint(65, 100)}", "пропустить"]),
+    ]
+
+
+def progress_view(rng, user):
+    return [rng.choice(["📊 Мой прогресс", "📌 Последние показатели (прогресс)", "📌 Мои параметры"])]
+
+
+def menu(rng, user):
+    return [rng.choice(["❓ FAQ", "🍽 Посчитать КБЖУ", "💎 Подписка", "🔙 В главное меню", "привет"])]
+
+
+SCENARIOS = {
+    ONBOARDING: onboarding,
+    "question": question,
+    "diary_add": diary_add,
+    "diary_edit": diary_edit,
+    "diary_delete": diary_delete,
+    "diary_view": diary_view,
+    "progress_add": progress_add,
+    "progress_view": progress_view,
+    "menu": menu,
+}
+
+MIX = {
+    "question": 30,
+    "diary_add": 20,
+    "diary_edit": 5,
+    "diary_delete": 5,
+    "diary_view": 10,
+    "progress_add": 10,
+    "progress_view": 10,
+    "menu": 10,
+}
+
+
+def parse_mix(text: str) -> dict:
+    """'question=50,diary_add=50' -> {"question": 50, "diary_add": 50}."""
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in SCENARIOS or name == ONBOARDING:
+            raise ValueError(f"Неизвестный сценарий: {name!r}")
+        mix[name] = float(weight or 1)
+    return mix
@@ -0,0 +1,35 @@
+# =========================================
+# Маршрутизация кнопок меню через словарь
+# =========================================
+# Вместо отдельного фильтра msg.text == "…" на каждую кнопку (aiogram
+# проверяет их по очереди для каждого апдейта) в диспетчере регистрируется
+# один хендлер, а нужная функция находится поиском в словаре по тексту.
+
+import inspect
+
+from metrics import set_handler
+
+
+class MenuRouter:
+    def __init__(self):
+        self._handlers = {}
+
+    def button(self, text: str):
+        def decorator(handler):
+            if text in self._handlers:
+                raise ValueError(f"Кнопка {text!r} уже зарегистрирована")
+            # Хендлеры меню принимают (message) или (message, state)
+            wants_state = len(inspect.signature(handler).parameters) > 1
+            self._handlers[text] = (handler, wants_state)
+            return handler
+        return decorator
+
+    def __contains__(self, text) -> bool:
+        return text in self._handlers
+
+    async def dispatch(self, message, state):
+        handler, wants_state = self._handlers[message.text]
+        set_handler(handler.__name__)
+        if wants_state:
+            return await handler(message, state)
+        return await handler(message)
@@ -0,0 +1,305 @@
+# =========================================
+# Метрики: задержки хендлеров, обращения к Firestore, токены OpenAI
+# =========================================
+# Общий реестр в памяти процесса (registry). Отдаётся в текстовом формате
+# Prometheus на /metrics (режим webhook) и раз в интервал сводкой в лог.
+# Счётчики Firestore на апдейт ведутся через contextvars: MetricsMiddleware
+# открывает контекст апдейта, репозитории вызывают record_firestore(), и
+# чтения попадают в апдейт, в рамках которого выполнялись (в том числе из
+# созданных в нём задач).
+
+import asyncio
+import bisect
+import contextvars
+import logging
+import time
+from collections import Counter
+
+# Границы корзин гистограмм (секунды и штуки)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34)
+
+_update = contextvars.ContextVar("metrics_update", default=None)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        # Последняя корзина — всё, что больше верхней границы (+Inf)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self) -> tuple:
+        return list(self.counts), self.sum, self.count
+
+
+def quantile(buckets, counts, q: float) -> float:
+    """Оценка квантиля по корзинам гистограммы (линейно внутри корзины)."""
+    total = sum(counts)
+    if not total:
+        return 0.0
+    rank = q * total
+    seen = 0
+    for i, count in enumerate(counts):
+        if count and seen + count >= rank:
+            low = buckets[i - 1] if i > 0 else 0.0
+            if i == len(buckets):
+                return float(low)
+            return low + (buckets[i] - low) * (rank - seen) / count
+        seen += count
+    return float(buckets[-1])
+
+
+def _labels(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    items = labels + extra
+    if not items:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in items)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + "}"
+
+
+class Metrics:
+    def __init__(self):
+        self._meta = {}
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        # Токены по пользователям — только для сводки в лог (в /metrics слишком много меток).
+        # Очищаются в summary(); без периодической сводки их не копим (track_user_tokens = False)
+        self.user_tokens = Counter()
+        self.track_user_tokens = True
+        self._last = None
+
+    def counter(self, name: str, help: str):
+        self._meta[name] = ("counter", help)
+
+    def histogram(self, name: str, help: str, buckets=LATENCY_BUCKETS):
+        self._meta[name] = ("histogram", help, tuple(buckets))
+
+    def gauge(self, name: str, help: str, fn):
+        """fn() -> число; вызывается при каждой выдаче /metrics."""
+        self._meta[name] = ("gauge", help)
+        self._gauges[name] = fn
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, _labels(labels))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, _labels(labels))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram(self._meta[name][2])
+        histogram.observe(value)
+
+    def render(self) -> str:
+        """Текстовый формат Prometheus (exposition format 0.0.4)."""
+        lines = []
+        for name, meta in self._meta.items():
+            lines.append(f"# HELP {name} {meta[1]}")
+            lines.append(f"# TYPE {name} {meta[0]}")
+            if meta[0] == "gauge":
+                try:
+                    lines.append(f"{name} {float(self._gauges[name]())}")
+                except Exception:
+                    logging.exception("Метрики: не удалось получить значение %s", name)
+            elif meta[0] == "counter":
+                for (key_name, labels), value in self._counters.items():
+                    if key_name == name:
+                        lines.append(f"{name}{_format_labels(labels)} {value}")
+            else:
+                for (key_name, labels), histogram in self._histograms.items():
+                    if key_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_format_labels(labels, (('le', bound),))} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def _interval(self) -> tuple:
+        # Приращения счётчиков и гистограмм с прошлой сводки
+        counters = dict(self._counters)
+        histograms = {key: h.snapshot() for key, h in self._histograms.items()}
+        last_counters, last_histograms = self._last or ({}, {})
+        self._last = (counters, histograms)
+        counter_delta = {key: value - last_counters.get(key, 0) for key, value in counters.items()}
+        histogram_delta = {}
+        for key, (counts, total, count) in histograms.items():
+            old_counts, old_total, old_count = last_histograms.get(key, ([0] * len(counts), 0.0, 0))
+            histogram_delta[key] = ([a - b for a, b in zip(counts, old_counts)], total - old_total, count - old_count)
+        return counter_delta, histogram_delta
+
+    def summary(self, top_users: int = 5) -> str:
+        """Сводка за интервал с прошлого вызова — для периодического лога."""
+        counters, histograms = self._interval()
+        lines = []
+        handlers = sorted(
+            ((dict(labels).get("handler"), h) for (name, labels), h in histograms.items()
+             if name == "bot_handler_duration_seconds" and h[2]),
+            key=lambda item: -item[1][2],
+        )
+        updates = sum(h[2] for _, h in handlers)
+        lines.append(f"апдейтов: {updates}")
+        for handler, (counts, total, count) in handlers:
+            buckets = self._meta["bot_handler_duration_seconds"][2]
+            reads = histograms.get(("bot_update_firestore_reads", (("handler", handler),)), ([], 0.0, 0))
+            writes = histograms.get(("bot_update_firestore_writes", (("handler", handler),)), ([], 0.0, 0))
+            lines.append(
+                f"  {handler}: {count} шт, p50 {quantile(buckets, counts, 0.5) * 1000:.0f} мс, "
+                f"p95 {quantile(buckets, counts, 0.95) * 1000:.0f} мс, "
+                f"Firestore чтений {reads[1] / count:.1f} / записей {writes[1] / count:.1f} на апдейт"
+            )
+        calls = {dict(labels)["purpose"]: h for (name, labels), h in histograms.items()
+                 if name == "bot_openai_request_duration_seconds" and h[2]}
+        # Цели, где все запросы закончились отказом, тоже попадают в сводку
+        for (name, labels), value in counters.items():
+            if name == "bot_openai_failures_total" and value:
+                calls.setdefault(dict(labels)["purpose"], ([], 0.0, 0))
+        for purpose, (counts, total, count) in sorted(calls.items()):
+            prompt = counters.get(("bot_openai_tokens_total", (("kind", "prompt"), ("purpose", purpose))), 0)
+            completion = counters.get(("bot_openai_tokens_total", (("kind", "completion"), ("purpose", purpose))), 0)
+            wait_counts, wait_total, waits = histograms.get(("bot_openai_queue_wait_seconds", (("purpose", purpose),)), ([], 0.0, 0))
+            wait = ""
+            if waits:
+                wait_p95 = quantile(self._meta["bot_openai_queue_wait_seconds"][2], wait_counts, 0.95)
+                wait = f", очередь среднее {wait_total / waits:.2f} с / p95 {wait_p95:.2f} с"
+            retries = counters.get(("bot_openai_retries_total", (("purpose", purpose),)), 0)
+            failures = counters.get(("bot_openai_failures_total", (("purpose", purpose),)), 0)
+            lines.append(
+                f"OpenAI {purpose}: {count} запросов, среднее {total / count if count else 0:.2f} с{wait}, "
+                f"токенов {prompt:.0f} + {completion:.0f}, повторов {retries:.0f}, отказов {failures:.0f}"
+            )
+        stages = {dict(labels)["stage"]: value for (name, labels), value in counters.items()
+                  if name == "bot_topic_stage_total" and value}
+        if stages:
+            checked = sum(stages.values())
+            lines.append("классификатор темы: " + ", ".join(
+                f"{stage} {value / checked:.0%}" for stage, value in sorted(stages.items(), key=lambda item: -item[1])
+            ))
+        cache = {dict(labels)["result"]: value for (name, labels), value in counters.items()
+                 if name == "bot_answer_cache_total" and value}
+        if cache:
+            looked_up = sum(value for result, value in cache.items() if result != "skipped")
+            found = cache.get("hit", 0) + cache.get("near_hit", 0)
+            lines.append(
+                f"кэш ответов: попаданий {found / looked_up if looked_up else 0:.0%} "
+                f"(точных {cache.get('hit', 0):.0f}, похожих {cache.get('near_hit', 0):.0f}, "
+                f"промахов {cache.get('miss', 0):.0f}), мимо кэша {cache.get('skipped', 0):.0f}"
+            )
+        if self.user_tokens:
+            lines.append("больше всего токенов: " + ", ".join(
+                f"{user_id} {tokens}" for user_id, tokens in self.user_tokens.most_common(top_users)
+            ))
+            self.user_tokens.clear()
+        return "\n".join(lines)
+
+
+registry = Metrics()
+registry.histogram("bot_handler_duration_seconds", "Время обработки апдейта по хендлерам")
+registry.histogram("bot_update_firestore_reads", "Прочитанных документов Firestore на апдейт", COUNT_BUCKETS)
+registry.histogram("bot_update_firestore_writes", "Записанных документов Firestore на апдейт", COUNT_BUCKETS)
+registry.counter("bot_firestore_reads_total", "Прочитанные документы Firestore по операциям")
+registry.counter("bot_firestore_writes_total", "Записанные документы Firestore по операциям")
+registry.histogram("bot_openai_request_duration_seconds", "Время запроса к OpenAI (для потока — до первого ответа)")
+registry.counter("bot_openai_tokens_total", "Токены OpenAI (prompt/completion)")
+registry.counter("bot_openai_errors_total", "Ошибки запросов к OpenAI по типу")
+registry.histogram("bot_openai_queue_wait_seconds", "Ожидание слота OpenAI в очереди LLMScheduler")
+registry.counter("bot_openai_retries_total", "Повторы запросов к OpenAI после временных ошибок")
+registry.counter("bot_openai_failures_total", "Запросы к OpenAI, не выполненные после всех повторов (LLMUnavailableError)")
+registry.counter("bot_topic_stage_total", "Какой ступенью классификатора определена тема сообщения")
+registry.counter("bot_answer_cache_total", "Обращения к кэшу ответов GPT (hit/near_hit/miss/skipped)")
+
+
+def start_update() -> tuple:
+    stats = {"handler": "unhandled", "reads": 0, "writes": 0}
+    return stats, _update.set(stats)
+
+
+def finish_update(stats: dict, token, started: float):
+    _update.reset(token)
+    handler = stats["handler"]
+    registry.observe("bot_handler_duration_seconds", time.monotonic() - started, handler=handler)
+    registry.observe("bot_update_firestore_reads", stats["reads"], handler=handler)
+    registry.observe("bot_update_firestore_writes", stats["writes"], handler=handler)
+
+
+def current_update() -> dict:
+    # Счётчики текущего апдейта (handler, reads, writes) или None вне апдейта
+    return _update.get()
+
+
+def set_handler(name: str):
+    # Имя хендлера для меток; для кнопок меню — конкретная функция, а не общий маршрутизатор
+    stats = _update.get()
+    if stats is not None:
+        stats["handler"] = name
+
+
+def record_firestore(op: str, reads: int = 0, writes: int = 0):
+    if reads:
+        registry.inc("bot_firestore_reads_total", reads, op=op)
+    if writes:
+        registry.inc("bot_firestore_writes_total", writes, op=op)
+    stats = _update.get()
+    if stats is not None:
+        stats["reads"] += reads
+        stats["writes"] += writes
+
+
+def record_llm(purpose: str, seconds: float, user_id: str = None, prompt_tokens: int = 0, completion_tokens: int = 0):
+    if seconds is not None:
+        registry.observe("bot_openai_request_duration_seconds", seconds, purpose=purpose)
+    record_tokens(purpose, user_id, prompt_tokens, completion_tokens)
+
+
+def record_tokens(purpose: str, user_id: str = None, prompt_tokens: int = 0, completion_tokens: int = 0):
+    registry.inc("bot_openai_tokens_total", prompt_tokens, purpose=purpose, kind="prompt")
+    registry.inc("bot_openai_tokens_total", completion_tokens, purpose=purpose, kind="completion")
+    if user_id is not None and registry.track_user_tokens:
+        registry.user_tokens[user_id] += prompt_tokens + completion_tokens
+
+
+def record_llm_error(purpose: str, error: Exception):
+    registry.inc("bot_openai_errors_total", purpose=purpose, error=type(error).__name__)
+
+
+def record_llm_wait(purpose: str, seconds: float):
+    registry.observe("bot_openai_queue_wait_seconds", seconds, purpose=purpose)
+
+
+def record_llm_retry(purpose: str):
+    registry.inc("bot_openai_retries_total", purpose=purpose)
+
+
+def record_llm_failure(purpose: str):
+    registry.inc("bot_openai_failures_total", purpose=purpose)
+
+
+def record_topic_stage(stage: str):
+    registry.inc("bot_topic_stage_total", stage=stage)
+
+
+def record_answer_cache(result: str):
+    registry.inc("bot_answer_cache_total", result=result)
+
+
+async def log_summary_every(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            logging.info("Метрики за %.0f с:\n%s", interval, registry.summary())
+        except Exception:
+            logging.exception("Метрики: не удалось собрать сводку")
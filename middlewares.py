@@ -0,0 +1,89 @@
+# =========================================
+# Middleware диспетчера
+# =========================================
+
+import asyncio
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+
+from metrics import current_update, finish_update, set_handler, start_update
+
+
+class ConcurrencyLimitMiddleware(BaseMiddleware):
+    """Ограничивает число апдейтов, обрабатываемых одновременно.
+
+    Регистрируется как outer-middleware на dp.update: лишние апдейты ждут
+    свободного слота, а не открывают сотни параллельных запросов к
+    Firestore и OpenAI. wait_idle() нужен для мягкой остановки.
+    """
+
+    def __init__(self, limit: int):
+        self._semaphore = asyncio.Semaphore(limit)
+        self._in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    async def __call__(self, handler, event, data):
+        self._in_flight += 1
+        self._idle.clear()
+        try:
+            async with self._semaphore:
+                return await handler(event, data)
+        finally:
+            self._in_flight -= 1
+            if self._in_flight == 0:
+                self._idle.set()
+
+    async def wait_idle(self, timeout: float):
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Задержка обработки и число обращений к Firestore на апдейт.
+
+    Регистрируется outer-middleware на dp.update (открывает контекст
+    апдейта и замеряет время) и middleware на dp.message /
+    dp.callback_query (запоминает, какой хендлер сработал).
+    """
+
+    async def __call__(self, handler, event, data):
+        if not isinstance(event, Update):
+            handler_object = data.get("handler")
+            if handler_object is not None:
+                set_handler(handler_object.callback.__name__)
+            return await handler(event, data)
+        stats, token = start_update()
+        started = time.monotonic()
+        try:
+            return await handler(event, data)
+        finally:
+            finish_update(stats, token, started)
+
+
+class ProfilerMiddleware(BaseMiddleware):
+    """Передаёт апдейты SlowUpdateProfiler. Регистрируется outer-middleware
+    на dp.update после MetricsMiddleware — от неё берётся имя хендлера."""
+
+    def __init__(self, profiler):
+        self._profiler = profiler
+
+    async def __call__(self, handler, event, data):
+        profile, task, token = self._profiler.begin(event.update_id)
+        try:
+            return await handler(event, data)
+        finally:
+            stats = current_update() or {}
+            self._profiler.end(profile, task, token, stats.get("handler"), {
+                "firestore_reads": stats.get("reads", 0),
+                "firestore_writes": stats.get("writes", 0),
+            })
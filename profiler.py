@@ -0,0 +1,323 @@
+# =========================================
+# Профилировщик медленных апдейтов
+# =========================================
+# Включается переменными окружения (см. bot.py). Для каждого апдейта
+# считается разбивка времени по стадиям (Firestore, OpenAI, Telegram;
+# остальное — код бота и aiogram), а фоновый поток раз в interval
+# секунд снимает стек event loop, если тот занят, и относит его к
+# апдейту, задача которого сейчас выполняется. Апдейт попадает в файл,
+# если он медленнее порога или выпал в случайной выборке; остальные
+# данные отбрасываются. Записи — JSON-строки в ротируемом файле, стеки —
+# в свёрнутом виде "файл:функция:строка;..." (годится и для flamegraph).
+#
+# Сводка по файлам:
+#   python profiler.py report profile.jsonl [--top 15]
+
+import asyncio
+import contextvars
+import functools
+import glob
+import inspect
+import json
+import logging
+import logging.handlers
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+import numpy as np
+
+MAX_STACK_DEPTH = 40
+
+_profile = contextvars.ContextVar("profile_update", default=None)
+# Открытая стадия в текущей задаче: вложенные стадии не считаются повторно
+_active_stage = contextvars.ContextVar("profile_stage", default=None)
+
+
+class UpdateProfile:
+    def __init__(self, update_id):
+        self.update_id = update_id
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.samples = []
+
+
+class stage:
+    """with stage("openai.chat"): ... — время внутри блока идёт в стадию
+    текущего апдейта. Без профилируемого апдейта ничего не делает."""
+
+    __slots__ = ("name", "_profile", "_token", "_started")
+
+    def __init__(self, name: str):
+        self.name = name
+        self._profile = None
+
+    def __enter__(self):
+        profile = _profile.get()
+        if profile is not None and _active_stage.get() is None:
+            self._profile = profile
+            self._token = _active_stage.set(self.name)
+            self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self._profile is not None:
+            elapsed = time.perf_counter() - self._started
+            _active_stage.reset(self._token)
+            total = self._profile.stages.setdefault(self.name, [0.0, 0])
+            total[0] += elapsed
+            total[1] += 1
+            self._profile = None
+        return False
+
+
+def profile_methods(prefix: str):
+    """Декоратор класса репозитория: публичные корутины класса становятся
+    стадиями "firestore.<prefix>.<метод>"."""
+    def decorate(cls):
+        for name, method in list(vars(cls).items()):
+            if name.startswith("_") or not inspect.iscoroutinefunction(method):
+                continue
+            setattr(cls, name, _timed(method, f"firestore.{prefix}.{name}"))
+        return cls
+    return decorate
+
+
+def _timed(method, stage_name: str):
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        if _profile.get() is None:
+            return await method(*args, **kwargs)
+        with stage(stage_name):
+            return await method(*args, **kwargs)
+    return wrapper
+
+
+def _frame_stack(frame) -> list:
+    stack = []
+    while frame is not None and len(stack) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    stack.reverse()
+    # Кадры самого event loop (run_forever -> Handle._run) одинаковы во всех стеках
+    for i in range(len(stack) - 1, -1, -1):
+        if stack[i].startswith("events.py:_run:"):
+            return stack[i + 1:]
+    return stack
+
+
+class SlowUpdateProfiler:
+    """slow_threshold — апдейты не быстрее этого (сек) пишутся всегда;
+    sample_rate — доля остальных апдейтов, которые пишутся для сравнения."""
+
+    def __init__(self, path: str, slow_threshold: float = 2.0, sample_rate: float = 0.0, interval: float = 0.01,
+                 max_bytes: int = 10 * 2 ** 20, backup_count: int = 3):
+        self.slow_threshold = slow_threshold
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self._by_task = {}
+        self._loop = None
+        self._thread = None
+        self._stopped = threading.Event()
+        self._log = logging.getLogger("profiler")
+        self._log.propagate = False
+        self._log.setLevel(logging.INFO)
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        self._log.addHandler(handler)
+        # Метрики
+        self.updates = 0
+        self.written = 0
+        self.samples = 0
+
+    def start(self):
+        if self._thread is None and self.interval > 0:
+            self._loop = asyncio.get_running_loop()
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._sample_loop, args=(threading.get_ident(),),
+                                            name="profiler", daemon=True)
+            self._thread.start()
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+
+    def _sample_loop(self, loop_thread_id: int):
+        current_tasks = asyncio.tasks._current_tasks
+        while not self._stopped.wait(self.interval):
+            if not self._by_task:
+                continue
+            frame = sys._current_frames().get(loop_thread_id)
+            task = current_tasks.get(self._loop)
+            profile = self._by_task.get(id(task)) if task is not None else None
+            if frame is None or profile is None:
+                # Event loop ждёт ввода-вывода или выполняет не профилируемую задачу
+                continue
+            profile.samples.append(";".join(_frame_stack(frame)))
+            self.samples += 1
+
+    def begin(self, update_id):
+        profile = UpdateProfile(update_id)
+        task = asyncio.current_task()
+        if task is not None:
+            self._by_task[id(task)] = profile
+        return profile, task, _profile.set(profile)
+
+    def end(self, profile: UpdateProfile, task, token, handler: str = None, extra: dict = None):
+        _profile.reset(token)
+        if task is not None:
+            self._by_task.pop(id(task), None)
+        self.updates += 1
+        duration = time.perf_counter() - profile.started
+        if duration >= self.slow_threshold:
+            reason = "slow"
+        elif self.sample_rate and random.random() < self.sample_rate:
+            reason = "sampled"
+        else:
+            return
+        stages = {name: {"seconds": round(seconds, 6), "calls": calls} for name, (seconds, calls) in profile.stages.items()}
+        record = {
+            "ts": datetime.now().isoformat(timespec="seconds"),
+            "reason": reason,
+            "update_id": profile.update_id,
+            "handler": handler or "unhandled",
+            "duration": round(duration, 6),
+            "stages": stages,
+            "other": round(max(0.0, duration - sum(seconds for seconds, _ in profile.stages.values())), 6),
+            "interval": self.interval,
+            "stacks": dict(Counter(list(profile.samples))),
+            **(extra or {}),
+        }
+        try:
+            self._log.info(json.dumps(record, ensure_ascii=False))
+            self.written += 1
+        except Exception:
+            logging.exception("Профилировщик: не удалось записать апдейт %s", profile.update_id)
+
+
+class ProfilerRequestMiddleware:
+    """Middleware сессии бота: вызовы Bot API — стадии "telegram.<метод>"."""
+
+    async def __call__(self, make_request, bot, method):
+        if _profile.get() is None:
+            return await make_request(bot, method)
+        with stage(f"telegram.{type(method).__name__}"):
+            return await make_request(bot, method)
+
+
+# =========================================
+# Сводка по записанным апдейтам
+# =========================================
+
+def load_records(paths: list) -> list:
+    records = []
+    for path in paths:
+        # Ротированные файлы: profile.jsonl.1, profile.jsonl.2, ...
+        for name in [path] + sorted(glob.glob(glob.escape(path) + ".*")):
+            with open(name, encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        try:
+                            records.append(json.loads(line))
+                        except ValueError:
+                            continue
+    return records
+
+
+def _frame_name(frame: str) -> str:
+    # "bot.py:is_greeting_fuzzy:412" -> "bot.py:is_greeting_fuzzy" (строки внутри функции суммируются)
+    return frame.rsplit(":", 1)[0]
+
+
+def report(records: list, top: int = 15) -> str:
+    lines = []
+    reasons = Counter(record.get("reason") for record in records)
+    lines.append(f"Апдейтов: {len(records)} (" + ", ".join(f"{k}: {v}" for k, v in reasons.items()) + ")")
+
+    by_handler = defaultdict(list)
+    for record in records:
+        by_handler[record.get("handler", "unhandled")].append(record)
+    lines.append("\nХендлеры (по суммарному времени):")
+    lines.append(f"  {'хендлер':<32}{'шт':>6}{'p50, с':>9}{'p95, с':>9}{'max, с':>9}  основная стадия")
+    ranked = sorted(by_handler.items(), key=lambda item: -sum(r["duration"] for r in item[1]))
+    for handler, items in ranked[:top]:
+        durations = np.array([r["duration"] for r in items])
+        stages = Counter()
+        for r in items:
+            stages["other"] += r.get("other", 0.0)
+            for name, value in r.get("stages", {}).items():
+                stages[name] += value["seconds"]
+        main_stage, main_seconds = stages.most_common(1)[0] if stages else ("—", 0.0)
+        share = main_seconds / durations.sum() if durations.sum() else 0.0
+        lines.append(
+            f"  {handler:<32}{len(items):>6}{np.percentile(durations, 50):>9.2f}"
+            f"{np.percentile(durations, 95):>9.2f}{durations.max():>9.2f}  {main_stage} ({share:.0%})"
+        )
+
+    stage_seconds = Counter()
+    stage_calls = Counter()
+    for record in records:
+        stage_seconds["other"] += record.get("other", 0.0)
+        for name, value in record.get("stages", {}).items():
+            stage_seconds[name] += value["seconds"]
+            stage_calls[name] += value["calls"]
+    total = sum(r["duration"] for r in records) or 1.0
+    lines.append("\nСтадии (доля всего времени записанных апдейтов):")
+    for name, seconds in stage_seconds.most_common(top):
+        calls = f", {stage_calls[name]} вызовов" if name in stage_calls else ""
+        lines.append(f"  {name:<48}{seconds:>9.2f} с {seconds / total:>5.0%}{calls}")
+
+    # Стеки: собственное время (верхний кадр) и суммарное (кадр где-то в стеке)
+    self_time = Counter()
+    cumulative = Counter()
+    sampled = 0.0
+    for record in records:
+        interval = record.get("interval", 0.01)
+        for stack, count in record.get("stacks", {}).items():
+            frames = stack.split(";")
+            seconds = count * interval
+            sampled += seconds
+            self_time[_frame_name(frames[-1])] += seconds
+            for frame in set(_frame_name(frame) for frame in frames):
+                cumulative[frame] += seconds
+    if sampled:
+        lines.append(f"\nСтеки event loop (≈{sampled:.2f} с процессорного времени в выборках):")
+        lines.append("  собственное время:")
+        for frame, seconds in self_time.most_common(top):
+            lines.append(f"    {frame:<60}{seconds:>8.2f} с {seconds / sampled:>5.0%}")
+        lines.append("  включая вызванные функции:")
+        for frame, seconds in cumulative.most_common(top):
+            lines.append(f"    {frame:<60}{seconds:>8.2f} с {seconds / sampled:>5.0%}")
+    return "\n".join(lines)
+
+
+def main(argv):
+    if len(argv) < 2 or argv[0] != "report":
+        print("Использование: python profiler.py report profile.jsonl [ещё файлы...] [--top N]")
+        return 1
+    top = 15
+    paths = []
+    args = iter(argv[1:])
+    for arg in args:
+        if arg == "--top":
+            top = int(next(args))
+        else:
+            paths.append(arg)
+    records = load_records(paths)
+    if not records:
+        print("Записей нет.")
+        return 0
+    print(report(records, top=top))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
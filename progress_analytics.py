@@ -0,0 +1,154 @@
+# =========================================
+# Аналитика прогресса: тренд веса, темп, прогноз, выбросы
+# =========================================
+# Вес и обхваты в записях progress хранятся строками как ввёл пользователь
+# ("72,5", "72.5 кг", "талия 80, грудь 95"). Здесь они разбираются в
+# массивы NumPy и по всей истории считаются скользящее среднее, темп за
+# неделю, прогноз даты достижения цели и выбросы (опечатки при вводе).
+
+import re
+from datetime import datetime, timedelta
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from cache import TTLCache
+
+_NUMBER = re.compile(r"\d+(?:[.,]\d+)?")
+_MEASUREMENT = re.compile(r"(талия|талии|грудь|груди|бёдра|бедра|бёдер|бедер|живот|рука|бицепс|шея)\D{0,10}?(\d+(?:[.,]\d+)?)")
+_CANONICAL = {
+    "талия": "талия", "талии": "талия", "грудь": "грудь", "груди": "грудь",
+    "бёдра": "бёдра", "бедра": "бёдра", "бёдер": "бёдра", "бедер": "бёдра",
+    "живот": "живот", "рука": "бицепс", "бицепс": "бицепс", "шея": "шея",
+}
+# Числа без подписей — в порядке, предложенном при вводе: талия, грудь, бёдра
+_POSITIONAL = ("талия", "грудь", "бёдра")
+
+MA_WINDOW_DAYS = 7
+TREND_WINDOW_DAYS = 28
+OUTLIER_Z = 3.5
+OUTLIER_NEIGHBOURS = 7
+# Нижняя граница масштаба отклонений, кг: у ровного ряда MAD = 0, а опечатку всё равно нужно найти
+OUTLIER_MIN_SCALE = 0.3
+MIN_WEIGHT, MAX_WEIGHT = 25.0, 350.0
+
+
+def parse_weight(text) -> float:
+    if isinstance(text, (int, float)):
+        value = float(text)
+    else:
+        m = _NUMBER.search(str(text or ""))
+        if not m:
+            return None
+        value = float(m.group().replace(",", "."))
+    return value if MIN_WEIGHT <= value <= MAX_WEIGHT else None
+
+
+def parse_measurements(text) -> dict:
+    text = str(text or "").lower()
+    found = {_CANONICAL[name]: float(value.replace(",", ".")) for name, value in _MEASUREMENT.findall(text)}
+    if found:
+        return found
+    numbers = [float(n.replace(",", ".")) for n in _NUMBER.findall(text)]
+    return dict(zip(_POSITIONAL, numbers))
+
+
+def parse_goal_weight(goal) -> float:
+    # «похудеть до 60 кг» -> 60; цель без числа — прогноза даты нет
+    return parse_weight(goal) if goal and _NUMBER.search(str(goal)) else None
+
+
+def _rolling_mean(t: np.ndarray, values: np.ndarray, window: float) -> np.ndarray:
+    # Среднее по окну window дней, заканчивающемуся в каждой точке (t отсортирован)
+    left = np.searchsorted(t, t - window, side="left")
+    sums = np.concatenate(([0.0], np.cumsum(values)))
+    right = np.arange(1, len(values) + 1)
+    return (sums[right] - sums[left]) / (right - left)
+
+
+def _rolling_median(values: np.ndarray, size: int) -> np.ndarray:
+    # Медиана по size соседним записям (по центру); края дополняются крайними значениями
+    half = size // 2
+    padded = np.concatenate((np.repeat(values[:1], half), values, np.repeat(values[-1:], half)))
+    return np.median(sliding_window_view(padded, size), axis=1)
+
+
+def _outliers(values: np.ndarray) -> np.ndarray:
+    # Отклонение от медианы соседей (одиночная опечатка её не сдвигает),
+    # затем модифицированный z-score по медианному абсолютному отклонению (MAD).
+    # MAD = 0 (стабильный вес, округление до 0,5 кг, ровный тренд) — берём среднее
+    # абсолютное отклонение (1.2533 приводит его к масштабу MAD / 0.6745)
+    residuals = values - _rolling_median(values, OUTLIER_NEIGHBOURS)
+    deviations = np.abs(residuals - np.median(residuals))
+    scale = np.median(deviations) / 0.6745
+    if scale == 0:
+        scale = 1.2533 * deviations.mean()
+    return deviations / max(scale, OUTLIER_MIN_SCALE) > OUTLIER_Z
+
+
+def analyze(entries: list, goal_weight: float = None) -> dict:
+    """entries — записи progress (timestamp, weight, measurements) в любом порядке."""
+    points = [
+        (entry["timestamp"], parse_weight(entry.get("weight")), parse_measurements(entry.get("measurements")))
+        for entry in entries if isinstance(entry.get("timestamp"), datetime)
+    ]
+    points.sort(key=lambda point: point[0])
+    weighed = [(ts, weight) for ts, weight, _ in points if weight is not None]
+    result = {"entries": len(points), "weighed": len(weighed)}
+    if weighed:
+        origin = weighed[0][0]
+        t = np.array([(ts - origin).total_seconds() / 86400 for ts, _ in weighed])
+        w = np.array([weight for _, weight in weighed])
+        outliers = _outliers(w) if len(w) >= 5 else np.zeros(len(w), dtype=bool)
+        # Скользящее среднее и тренд — без выбросов
+        tc, wc = t[~outliers], w[~outliers]
+        ma = _rolling_mean(tc, wc, MA_WINDOW_DAYS)
+        recent = tc >= tc[-1] - TREND_WINDOW_DAYS
+        result.update({
+            "first_weight": float(wc[0]),
+            "last_weight": float(wc[-1]),
+            "average_weight": float(ma[-1]),
+            "total_change": float(wc[-1] - wc[0]),
+            "min_weight": float(wc.min()),
+            "max_weight": float(wc.max()),
+            "since": weighed[0][0],
+            "outliers": [(weighed[i][0], float(w[i])) for i in np.flatnonzero(outliers)],
+            "weekly_rate": None,
+            "goal_weight": goal_weight,
+            "goal_date": None,
+        })
+        if recent.sum() >= 2 and np.ptp(tc[recent]) >= 3:
+            slope = np.polyfit(tc[recent], wc[recent], 1)[0]
+            result["weekly_rate"] = float(slope * 7)
+            if goal_weight is not None and slope != 0:
+                days_left = (goal_weight - ma[-1]) / slope
+                if 0 < days_left < 3 * 365:
+                    result["goal_date"] = origin + timedelta(days=float(tc[-1] + days_left))
+    measured = [(ts, m) for ts, _, m in points if m]
+    if measured:
+        first, last = measured[0][1], measured[-1][1]
+        result["measurements"] = {name: (value, value - first[name] if name in first else None) for name, value in last.items()}
+    return result
+
+
+class ProgressAnalytics:
+    """Кэш результатов analyze() по пользователю; сбрасывается при любом
+    изменении записей прогресса (invalidate) — только в этом процессе.
+    ttl = 0 — без кэша (несколько процессов бота)."""
+
+    def __init__(self, progress_repo, cache_size: int = 10000, ttl: float = 3600):
+        self._repo = progress_repo
+        self._cache = TTLCache(maxsize=cache_size, ttl=ttl) if ttl > 0 else None
+
+    async def get(self, user_id: str, goal_weight: float = None) -> dict:
+        cached = self._cache.get(user_id) if self._cache is not None else None
+        if cached is not None and cached[0] == goal_weight:
+            return cached[1]
+        result = analyze(await self._repo.all(user_id), goal_weight)
+        if self._cache is not None:
+            self._cache.set(user_id, (goal_weight, result))
+        return result
+
+    def invalidate(self, user_id: str):
+        if self._cache is not None:
+            self._cache.invalidate(user_id)
@@ -0,0 +1,203 @@
+# =========================================
+# Сборка промпта для GPT: бюджет токенов и сводка старых реплик
+# =========================================
+# Порядок сообщений рассчитан на кэширование префикса у провайдера:
+# сначала неизменная инструкция (одинаковая у всех пользователей), затем
+# параметры и сводка пользователя, затем последние реплики и вопрос.
+# Реплики, вытесненные из history, не теряются, а сжимаются в
+# history_summary фоновым запросом к GPT — пачкой раз в несколько ответов.
+
+import asyncio
+import logging
+
+try:
+    import tiktoken
+except ImportError:  # без tiktoken считаем приблизительно по символам
+    tiktoken = None
+
+SYSTEM_PROMPT = (
+    "Ты профессиональный AI-тренер, консультируешь по фитнесу, здоровью и питанию. "
+    "Если пользователь спрашивает про вредные продукты (чипсы, фастфуд, алкоголь и т.д.), "
+    "объясняй возможный вред, указывай калорийность, давай советы по умеренности и предлагай более здоровые альтернативы. "
+    "Если пользователь спрашивает про здоровое питание, тренировки, баланс — помогай. "
+    "Если есть ограничения по здоровью, предлагай альтернативы. "
+    "Отвечай дружелюбно и понятно, используя Markdown, совместимый с Telegram. "
+    "Не используй заголовки вида '###'; вместо этого используй жирный текст. "
+    "Если вопрос не по теме, отвечай: 'Извини, я могу отвечать только на вопросы о фитнесе, тренировках и здоровом образе жизни.'"
+)
+
+SUMMARY_PROMPT = (
+    "Сожми переписку фитнес-бота с пользователем в краткую сводку для памяти бота: "
+    "факты о пользователе, его цели, ограничения, договорённости и уже данные советы. "
+    "Без приветствий и воды, не длиннее {max_chars} символов. Если есть прежняя сводка — "
+    "дополни её, убрав устаревшее."
+)
+
+# Накладные расходы формата чата на сообщение и на ответ (как у OpenAI)
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+
+_encoding = None
+
+
+def _get_encoding():
+    global _encoding
+    if _encoding is None and tiktoken is not None:
+        try:
+            _encoding = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            # Старый tiktoken или нет доступа к файлам словаря
+            logging.warning("tiktoken: словарь o200k_base недоступен, токены считаются приблизительно")
+            _encoding = False
+    return _encoding or None
+
+
+def count_tokens(text: str) -> int:
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    # ~3 символа на токен для русского текста (та же оценка, что в llm.estimate_tokens)
+    return (len(text) + 2) // 3
+
+
+def count_message_tokens(messages: list) -> int:
+    return sum(count_tokens(m["content"]) + TOKENS_PER_MESSAGE for m in messages) + TOKENS_PER_REPLY
+
+
+def _truncate(text: str, tokens: int) -> str:
+    # Грубая обрезка по символам до нужного числа токенов, с запасом
+    while text and count_tokens(text) > tokens:
+        text = text[:max(0, int(len(text) * 0.9) - 1)]
+    return text
+
+
+def params_context(params: dict) -> str:
+    if not params:
+        return ""
+    return (
+        f"Параметры пользователя: Пол: {params.get('пол', 'N/A')}, "
+        f"Вес: {params.get('вес', 'N/A')} кг, "
+        f"Рост: {params.get('рост', 'N/A')} см, "
+        f"Возраст: {params.get('возраст', 'N/A')}, "
+        f"Состояние здоровья: {params.get('здоровье', 'N/A')}, "
+        f"Цель: {params.get('цель', 'N/A')}."
+    )
+
+
+def history_messages(history: list) -> list:
+    return [
+        {"role": "assistant" if entry.get("role") == "bot" else "user", "content": entry.get("text") or ""}
+        for entry in history
+    ]
+
+
+class PromptBuilder:
+    """Собирает сообщения для ответа пользователю в пределах budget токенов.
+
+    Если не помещается, сначала выбрасываются самые старые реплики, затем
+    укорачивается сводка, в последнюю очередь — сам вопрос. history_budget
+    ограничивает токены реплик отдельно: history приходит целиком (всё, что
+    ещё не в сводке), и без него длинные ответы бота съедали бы весь бюджет.
+    """
+
+    def __init__(self, budget: int = 2000, system_prompt: str = SYSTEM_PROMPT, history_budget: int = None):
+        self.budget = budget
+        self.system_prompt = system_prompt
+        self.history_budget = history_budget
+        # Метрики: входные токены на ответ
+        self.requests = 0
+        self.prompt_tokens = 0
+
+    def build(self, user_message: str, user_data: dict) -> tuple:
+        """Возвращает (messages, оценка входных токенов)."""
+        static = {"role": "system", "content": self.system_prompt}
+        context_parts = [params_context(user_data.get("params", {}))]
+        summary = user_data.get("history_summary")
+        history = history_messages(user_data.get("history", []))
+        question = {"role": "user", "content": user_message}
+
+        fixed = count_message_tokens([static, question]) + TOKENS_PER_MESSAGE + count_tokens(context_parts[0])
+        if fixed > self.budget:
+            question["content"] = _truncate(user_message, max(1, count_tokens(user_message) - (fixed - self.budget)))
+            fixed = self.budget
+        left = self.budget - fixed
+        # Последние реплики важнее сводки: берём их с конца, пока помещаются
+        history_left = left if self.history_budget is None else min(left, self.history_budget)
+        kept = []
+        for entry in reversed(history):
+            cost = count_tokens(entry["content"]) + TOKENS_PER_MESSAGE
+            if cost > history_left:
+                break
+            kept.append(entry)
+            history_left -= cost
+            left -= cost
+        kept.reverse()
+        if summary and left > 0:
+            summary = _truncate(f"Что известно из прошлых разговоров: {summary}", left)
+            if summary:
+                context_parts.append(summary)
+        context = " ".join(part for part in context_parts if part)
+        messages = [static]
+        if context:
+            messages.append({"role": "system", "content": context})
+        messages += kept + [question]
+        tokens = count_message_tokens(messages)
+        self.requests += 1
+        self.prompt_tokens += tokens
+        return messages, tokens
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "prompt_tokens_avg": self.prompt_tokens / self.requests if self.requests else 0.0,
+        }
+
+
+class SummaryMemory:
+    """Сжимает вытесненные из history реплики в users/{id}.history_summary.
+
+    add() не ждёт GPT: реплики копятся по пользователю, и одна фоновая
+    задача на пользователя дописывает их в сводку по очереди.
+    summarize(user_id, summary, entries) — корутина, возвращает новую сводку.
+    """
+
+    def __init__(self, user_repo, summarize):
+        self._repo = user_repo
+        self._summarize = summarize
+        self._pending = {}
+        self._tasks = {}
+
+    def add(self, user_id: str, entries: list):
+        self._pending.setdefault(user_id, []).extend(entries)
+        if user_id not in self._tasks:
+            self._tasks[user_id] = asyncio.create_task(self._run(user_id))
+
+    async def _run(self, user_id: str):
+        try:
+            while self._pending.get(user_id):
+                entries = self._pending.pop(user_id)
+                try:
+                    user_data = await self._repo.get(user_id)
+                    summary = await self._summarize(user_id, user_data.get("history_summary", ""), entries)
+                    await self._repo.update(user_id, {"history_summary": summary})
+                except Exception:
+                    logging.exception("Не удалось обновить сводку истории пользователя %s", user_id)
+        finally:
+            del self._tasks[user_id]
+
+    async def close(self):
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+
+def _clip(text: str, limit: int) -> str:
+    return text if len(text) <= limit else text[:limit].rstrip() + "…"
+
+
+def summary_messages(summary: str, entries: list, max_chars: int = 600, entry_chars: int = 400) -> list:
+    # Для сводки хватает начала реплики: длинные ответы бота обрезаются до entry_chars
+    dialog = "\n".join(f"{entry.get('role')}: {_clip(entry.get('text') or '', entry_chars)}" for entry in entries)
+    content = f"Прежняя сводка: {summary}\n\nНовые реплики:\n{dialog}" if summary else f"Реплики:\n{dialog}"
+    return [
+        {"role": "system", "content": SUMMARY_PROMPT.format(max_chars=max_chars)},
+        {"role": "user", "content": content},
+    ]
@@ -0,0 +1,43 @@
+# =========================================
+# Token bucket для ограничения частоты запросов
+# =========================================
+
+import asyncio
+import time
+
+
+class TokenBucket:
+    """Ведро на capacity токенов, пополняется со скоростью rate токенов/сек.
+
+    acquire(n) ждёт, пока в ведре наберётся n токенов; ожидающие
+    обслуживаются строго по очереди.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, amount: float = 1) -> float:
+        # Возвращает, сколько секунд пришлось ждать
+        amount = min(amount, self.capacity)
+        started = time.monotonic()
+        async with self._lock:
+            self._refill()
+            while self._tokens < amount:
+                await asyncio.sleep((amount - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= amount
+        return time.monotonic() - started
+
+    def pause(self, seconds: float):
+        # Сервер попросил подождать (429 / retry_after): обнуляем ведро на это время
+        self._refill()
+        self._tokens = min(self._tokens, 0) - seconds * self.rate
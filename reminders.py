@@ -0,0 +1,191 @@
+# =========================================
+# Напоминания: расписания пользователей и планировщик
+# =========================================
+# Расписание хранится одним документом на пользователя (минуты суток UTC).
+# Планировщик раз в window_minutes одним запросом загружает только тех, у
+# кого есть напоминания в ближайшем окне, раскладывает их в кучу по времени
+# и отдаёт наступившие в пул воркеров, которые отправляют сообщения через
+# общий RateLimitedSender. Никаких задач и таймеров на пользователя.
+
+import asyncio
+import heapq
+import logging
+import re
+import time
+
+from sender import BLOCKED, SENT
+
+REMINDER_TEXTS = {
+    "meal": "🍽 Не забудь записать приём пищи в «📒 Дневник питания».",
+    "weigh": "⚖️ Время взвеситься! Добавь запись в «📊 Мой прогресс».",
+    "workout": "🏋️ Пора на тренировку! 💪",
+}
+REMINDER_TITLES = {
+    "meal": "Приёмы пищи",
+    "weigh": "Взвешивание",
+    "workout": "Тренировка",
+}
+
+MINUTES_PER_DAY = 1440
+# array_contains_any принимает не больше 30 значений — это и предел окна
+MAX_WINDOW_MINUTES = 30
+MAX_TIMES_PER_KIND = 6
+
+_TIME = re.compile(r"^(\d{1,2})[:.](\d{2})$")
+
+
+def parse_times(text: str) -> list:
+    """'09:00, 13:30 19.00' -> [540, 810, 1140] (минуты местного времени).
+    'выкл' -> []; при ошибке бросает ValueError."""
+    text = text.strip().lower()
+    if text in ("выкл", "выключить", "нет", "off"):
+        return []
+    minutes = set()
+    for part in re.split(r"[,;\s]+", text):
+        if not part:
+            continue
+        m = _TIME.match(part)
+        if not m or int(m.group(1)) > 23 or int(m.group(2)) > 59:
+            raise ValueError(part)
+        minutes.add(int(m.group(1)) * 60 + int(m.group(2)))
+    if not minutes or len(minutes) > MAX_TIMES_PER_KIND:
+        raise ValueError(text)
+    return sorted(minutes)
+
+
+def format_minute(minute: int) -> str:
+    return f"{minute // 60:02d}:{minute % 60:02d}"
+
+
+def build_schedule(chat_id: int, local_times: dict, tz_offset: int) -> dict:
+    # local_times: {вид: [минуты местного времени]}; tz_offset — смещение от UTC в минутах
+    reminders = {
+        kind: sorted((minute - tz_offset) % MINUTES_PER_DAY for minute in minutes)
+        for kind, minutes in local_times.items() if minutes
+    }
+    slots = sorted({minute for minutes in reminders.values() for minute in minutes})
+    return {"chat_id": chat_id, "tz_offset": tz_offset, "reminders": reminders, "slots": slots}
+
+
+def local_times(schedule: dict) -> dict:
+    if not schedule:
+        return {}
+    tz_offset = schedule.get("tz_offset", 0)
+    return {
+        kind: sorted((minute + tz_offset) % MINUTES_PER_DAY for minute in minutes)
+        for kind, minutes in (schedule.get("reminders") or {}).items()
+    }
+
+
+class ReminderScheduler:
+    def __init__(self, repo, sender, window_minutes: int = 10, workers: int = 30):
+        self._repo = repo
+        self._sender = sender
+        self.window_minutes = min(window_minutes, MAX_WINDOW_MINUTES)
+        self.workers = workers
+        self._heap = []
+        self._queue = asyncio.Queue()
+        # Версии расписаний, изменённых в текущем окне: устаревшие элементы кучи пропускаются
+        self._versions = {}
+        self._window_start = 0.0
+        self._window_end = 0.0
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        # Метрики
+        self.loaded = 0
+        self.sent = 0
+        self.disabled = 0
+
+    def _push(self, user_id: str, schedule: dict, version: int):
+        start, end = self._window_start, self._window_end
+        day_start = start - start % 86400
+        for kind, minutes in (schedule.get("reminders") or {}).items():
+            for minute in minutes:
+                due = day_start + minute * 60
+                if due < start:
+                    due += 86400
+                if due < end:
+                    heapq.heappush(self._heap, (due, user_id, kind, schedule["chat_id"], version))
+
+    async def _load_window(self, start: float):
+        previous = self._window_start, self._window_end
+        self._window_start = start
+        self._window_end = start + self.window_minutes * 60
+        self._versions.clear()
+        first = int(start // 60) % MINUTES_PER_DAY
+        minutes = [(first + i) % MINUTES_PER_DAY for i in range(self.window_minutes)]
+        try:
+            docs = await self._repo.due(minutes)
+        except Exception:
+            # Окно не загружено — возвращаем прежние границы, чтобы _run повторил загрузку
+            self._window_start, self._window_end = previous
+            raise
+        for doc in docs:
+            # Расписание изменили, пока шёл запрос, — актуальные элементы уже в куче
+            if doc["id"] not in self._versions:
+                self._push(doc["id"], doc, 0)
+        self.loaded += len(docs)
+
+    def reschedule(self, user_id: str, schedule: dict = None):
+        """Вызывается после изменения расписания: заменяет элементы текущего окна."""
+        version = self._versions.get(user_id, 0) + 1
+        self._versions[user_id] = version
+        if schedule and self._window_end:
+            self._push(user_id, schedule, version)
+            self._wakeup.set()
+
+    def _pop_due(self, now: float):
+        while self._heap and self._heap[0][0] <= now:
+            due, user_id, kind, chat_id, version = heapq.heappop(self._heap)
+            if self._versions.get(user_id, 0) == version:
+                self._queue.put_nowait((user_id, chat_id, kind))
+
+    async def _run(self):
+        while True:
+            now = time.time()
+            # Сначала отдаём наступившие: к концу окна куча пуста и версии можно сбросить
+            self._pop_due(now)
+            if now >= self._window_end:
+                # После долгой паузы (засыпание хоста) не догоняем пропущенные окна
+                start = self._window_end if now - self._window_end < 60 else now - now % 60
+                try:
+                    await self._load_window(start)
+                except Exception:
+                    logging.exception("Напоминания: не удалось загрузить окно")
+                    await asyncio.sleep(5)
+                    continue
+                self._pop_due(time.time())
+            next_due = min(self._heap[0][0], self._window_end) if self._heap else self._window_end
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(0.0, next_due - time.time()))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _worker(self):
+        while True:
+            user_id, chat_id, kind = await self._queue.get()
+            try:
+                result = await self._sender.send(chat_id, REMINDER_TEXTS.get(kind, REMINDER_TEXTS["meal"]))
+                if result == BLOCKED:
+                    # Бот заблокирован — напоминания этому пользователю больше не планируем
+                    await self._repo.delete(user_id)
+                    self.reschedule(user_id, None)
+                    self.disabled += 1
+                elif result == SENT:
+                    self.sent += 1
+            except Exception:
+                logging.exception("Напоминания: ошибка отправки пользователю %s", user_id)
+            finally:
+                self._queue.task_done()
+
+    async def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._run())]
+            self._tasks += [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
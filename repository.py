@@ -0,0 +1,456 @@
+# =========================================
+# Асинхронный слой доступа к Firestore
+# =========================================
+# Все обращения к Firestore из хендлеров идут через эти репозитории.
+# Они построены на асинхронном клиенте (firestore_async), поэтому
+# медленный запрос к базе не блокирует event loop и остальные чаты.
+
+import copy
+from datetime import datetime
+
+from metrics import record_firestore
+from profiler import profile_methods
+from services import LazyModule
+
+# Импорт firestore тяжёлый — откладывается до первого запроса к базе
+firestore = LazyModule("firebase_admin.firestore")
+
+
+def _query_reads(docs: list) -> int:
+    # Запрос тарифицируется минимум одним чтением, даже если ничего не нашёл
+    return max(1, len(docs))
+
+
+def _to_entry(doc) -> dict:
+    # Документ подколлекции -> словарь с id документа
+    data = doc.to_dict() or {}
+    data["id"] = doc.id
+    return data
+
+
+@profile_methods("users")
+class UserRepository:
+    """Документы users/{user_id}.
+
+    Если передан cache (TTLCache), прочитанные документы кэшируются между
+    апдейтами, а любая запись через репозиторий сбрасывает запись в кэше.
+    """
+
+    def __init__(self, db, cache=None):
+        self._db = db
+        self._cache = cache
+
+    def ref(self, user_id: str):
+        return self._db.collection("users").document(user_id)
+
+    async def get(self, user_id: str) -> dict:
+        if self._cache is not None:
+            cached = self._cache.get(user_id)
+            if cached is not None:
+                return copy.deepcopy(cached)
+        doc = await self.ref(user_id).get()
+        record_firestore("users.get", reads=1)
+        data = doc.to_dict() if doc.exists else {}
+        if self._cache is not None:
+            self._cache.set(user_id, copy.deepcopy(data))
+        return data
+
+    def invalidate(self, user_id: str):
+        if self._cache is not None:
+            self._cache.invalidate(user_id)
+
+    async def page_ids(self, after: str = None, limit: int = 500) -> list:
+        # Страница id пользователей по порядку id документа; select([]) — без полей, только имена
+        query = self._db.collection("users").select([]).order_by("__name__").limit(limit)
+        if after:
+            query = query.start_after({"__name__": after})
+        ids = [doc.id async for doc in query.stream()]
+        record_firestore("users.page_ids", reads=_query_reads(ids))
+        return ids
+
+    async def set(self, user_id: str, data: dict, merge: bool = True):
+        try:
+            await self.ref(user_id).set(data, merge=merge)
+            record_firestore("users.set", writes=1)
+        finally:
+            self.invalidate(user_id)
+
+    async def update(self, user_id: str, fields: dict):
+        try:
+            await self.ref(user_id).update(fields)
+            record_firestore("users.update", writes=1)
+        finally:
+            self.invalidate(user_id)
+
+    async def append_history(self, user_id: str, entries: list, limit: int, batch: int = 0) -> tuple:
+        # Чтение, дописывание и обрезка history в одной транзакции:
+        # параллельные сообщения одного пользователя не теряют реплики.
+        # History обрезается до limit, только когда перерастает limit + batch:
+        # вытесненные реплики идут в сводку пачкой, а не по одной на ответ.
+        # Возвращает (history, вытесненные реплики).
+        ref = self.ref(user_id)
+
+        @firestore.async_transactional
+        async def append(transaction):
+            snapshot = await ref.get(transaction=transaction)
+            history = (snapshot.to_dict() or {}).get("history", []) if snapshot.exists else []
+            history = history + entries
+            dropped = []
+            if len(history) > limit + batch:
+                dropped, history = history[:-limit], history[-limit:]
+            transaction.set(ref, {"history": history}, merge=True)
+            return history, dropped
+
+        try:
+            result = await append(self._db.transaction())
+        finally:
+            self.invalidate(user_id)
+        # Тело транзакции повторяется при конфликтах — учитываем только итоговую попытку
+        record_firestore("users.append_history", reads=1, writes=1)
+        return result
+
+
+@profile_methods("progress")
+class ProgressRepository:
+    """Подколлекция users/{user_id}/progress и кольцевой буфер последних
+    записей users/{user_id}.progress_history.
+
+    Буфер меняется в той же транзакции, что и сама запись, поэтому для
+    показа последних показателей достаточно документа пользователя.
+    """
+
+    def __init__(self, db, user_repo, history_limit: int = 7):
+        self._db = db
+        self._users = user_repo
+        self.history_limit = history_limit
+
+    def collection(self, user_id: str):
+        return self._db.collection("users").document(user_id).collection("progress")
+
+    def _latest_query(self, user_id: str, limit: int):
+        return self.collection(user_id).order_by("timestamp", direction=firestore.Query.DESCENDING).limit(limit)
+
+    async def add(self, user_id: str, entry: dict, user_fields: dict = None) -> str:
+        # user_fields — поля users/{id}, обновляемые заодно (например, params.вес)
+        ref = self.collection(user_id).document()
+        user_ref = self._users.ref(user_id)
+
+        @firestore.async_transactional
+        async def add(transaction):
+            snapshot = await user_ref.get(transaction=transaction)
+            history = (snapshot.to_dict() or {}).get("progress_history", []) if snapshot.exists else []
+            history = [_history_item(ref.id, entry)] + history[:self.history_limit - 1]
+            transaction.set(ref, entry)
+            transaction.update(user_ref, {"progress_history": history, **(user_fields or {})})
+            return ref.id
+
+        try:
+            entry_id = await add(self._db.transaction())
+        finally:
+            self._users.invalidate(user_id)
+        record_firestore("progress.add", reads=1, writes=2)
+        return entry_id
+
+    async def latest(self, user_id: str, limit: int = 7) -> list:
+        entries = [_to_entry(doc) async for doc in self._latest_query(user_id, limit).stream()]
+        record_firestore("progress.latest", reads=_query_reads(entries))
+        return entries
+
+    async def history(self, user_id: str) -> list:
+        # Последние записи из буфера в документе пользователя (он обычно уже в кэше)
+        return (await self._users.get(user_id)).get("progress_history", [])
+
+    async def last(self, user_id: str):
+        history = await self.history(user_id)
+        if history and history[0].get("id"):
+            return history[0]
+        # Буфер записан до появления id в элементах — читаем подколлекцию
+        entries = await self.latest(user_id, limit=1)
+        return entries[0] if entries else None
+
+    async def all(self, user_id: str) -> list:
+        # Вся история для аналитики: только нужные поля, по возрастанию времени
+        query = self.collection(user_id).select(["timestamp", "weight", "measurements"]).order_by("timestamp")
+        entries = [_to_entry(doc) async for doc in query.stream()]
+        record_firestore("progress.all", reads=_query_reads(entries))
+        return entries
+
+    async def update(self, user_id: str, entry_id: str, fields: dict, user_fields: dict = None):
+        ref = self.collection(user_id).document(entry_id)
+        user_ref = self._users.ref(user_id)
+
+        @firestore.async_transactional
+        async def update(transaction):
+            snapshot = await user_ref.get(transaction=transaction)
+            history = (snapshot.to_dict() or {}).get("progress_history", []) if snapshot.exists else []
+            changed = [item for item in history if item.get("id") == entry_id]
+            if changed:
+                # Правка ставит новый timestamp — запись поднимается в начало буфера
+                item = _history_item(entry_id, {**changed[0], **fields})
+                history = [item] + [item for item in history if item.get("id") != entry_id]
+            transaction.update(ref, fields)
+            transaction.update(user_ref, {"progress_history": history, **(user_fields or {})})
+
+        try:
+            await update(self._db.transaction())
+        finally:
+            self._users.invalidate(user_id)
+        record_firestore("progress.update", reads=1, writes=2)
+
+    async def delete(self, user_id: str, entry_id: str):
+        ref = self.collection(user_id).document(entry_id)
+        user_ref = self._users.ref(user_id)
+
+        @firestore.async_transactional
+        async def delete(transaction):
+            # Буфер дополняется следующей по давности записью — один запрос, только при удалении
+            query = self._latest_query(user_id, self.history_limit + 1)
+            entries = [_to_entry(doc) async for doc in query.stream(transaction=transaction)]
+            history = [_history_item(e["id"], e) for e in entries if e["id"] != entry_id][:self.history_limit]
+            transaction.delete(ref)
+            transaction.update(user_ref, {"progress_history": history})
+            return _query_reads(entries)
+
+        try:
+            reads = await delete(self._db.transaction())
+        finally:
+            self._users.invalidate(user_id)
+        record_firestore("progress.delete", reads=reads, writes=2)
+
+
+def _history_item(entry_id: str, entry: dict) -> dict:
+    timestamp = entry.get("timestamp")
+    return {
+        "id": entry_id,
+        "timestamp": timestamp,
+        "timestamp_str": timestamp.strftime("%d.%m.%Y %H:%M") if isinstance(timestamp, datetime) else "N/A",
+        "weight": entry.get("weight"),
+        "measurements": entry.get("measurements"),
+    }
+
+
+NUTRITION_FIELDS = ("kcal", "protein", "fat", "carbs")
+
+
+def day_key(timestamp) -> str:
+    return timestamp.strftime("%Y-%m-%d")
+
+
+def _add_to_daily(deltas: dict, entry: dict, sign: int):
+    # Вклад записи дневника в сводку её дня (sign = +1 / -1)
+    day = deltas.setdefault(day_key(entry["timestamp"]), {"entries": 0, "meals": {}, "totals": {}})
+    day["entries"] += sign
+    meal_type = entry.get("meal_type", "перекус")
+    day["meals"][meal_type] = day["meals"].get(meal_type, 0) + sign
+    nutrition = entry.get("nutrition") or {}
+    for field in NUTRITION_FIELDS:
+        if isinstance(nutrition.get(field), (int, float)):
+            day["totals"][field] = day["totals"].get(field, 0) + sign * nutrition[field]
+
+
+def _daily_write(day: str, delta: dict) -> dict:
+    # Сводка дня -> поля для set(merge=True) с атомарными инкрементами
+    fields = {"date": day}
+    if delta["entries"]:
+        fields["entries"] = firestore.Increment(delta["entries"])
+    meals = {k: firestore.Increment(v) for k, v in delta["meals"].items() if v}
+    if meals:
+        fields["meals"] = meals
+    totals = {k: firestore.Increment(v) for k, v in delta["totals"].items() if v}
+    if totals:
+        fields["totals"] = totals
+    return fields
+
+
+@profile_methods("diary")
+class DiaryRepository:
+    """Подколлекция users/{user_id}/diary и сводки по дням users/{user_id}/daily/{YYYY-MM-DD}.
+
+    Сводка (число записей, записи по приёмам пищи, сумма КБЖУ) меняется в
+    той же транзакции/пакете, что и сама запись, поэтому для дневных и
+    недельных итогов достаточно прочитать один документ на день.
+    """
+
+    def __init__(self, db):
+        self._db = db
+
+    def collection(self, user_id: str):
+        return self._db.collection("users").document(user_id).collection("diary")
+
+    def daily_collection(self, user_id: str):
+        return self._db.collection("users").document(user_id).collection("daily")
+
+    def _write_daily(self, writer, user_id: str, deltas: dict):
+        for day, delta in deltas.items():
+            writer.set(self.daily_collection(user_id).document(day), _daily_write(day, delta), merge=True)
+
+    async def add(self, user_id: str, entry: dict) -> str:
+        ref = self.collection(user_id).document()
+        deltas = {}
+        _add_to_daily(deltas, entry, +1)
+        batch = self._db.batch()
+        batch.set(ref, entry)
+        self._write_daily(batch, user_id, deltas)
+        await batch.commit()
+        record_firestore("diary.add", writes=1 + len(deltas))
+        return ref.id
+
+    async def latest(self, user_id: str, limit: int = 20) -> list:
+        query = self.collection(user_id).order_by("timestamp", direction=firestore.Query.DESCENDING).limit(limit)
+        entries = [_to_entry(doc) async for doc in query.stream()]
+        record_firestore("diary.latest", reads=_query_reads(entries))
+        return entries
+
+    async def last_by_type(self, user_id: str, meal_type: str):
+        query = (
+            self.collection(user_id)
+            .where("meal_type", "==", meal_type)
+            .order_by("timestamp", direction=firestore.Query.DESCENDING)
+            .limit(1)
+        )
+        entries = [_to_entry(doc) async for doc in query.stream()]
+        record_firestore("diary.last_by_type", reads=_query_reads(entries))
+        return entries[0] if entries else None
+
+    async def update(self, user_id: str, entry_id: str, fields: dict, if_match: dict = None):
+        # if_match: запись меняется, только если эти поля не изменились с момента чтения
+        ref = self.collection(user_id).document(entry_id)
+
+        @firestore.async_transactional
+        async def update(transaction):
+            # Возвращает число записей: 0 — запись не изменена
+            snapshot = await ref.get(transaction=transaction)
+            if not snapshot.exists:
+                return 0
+            old = snapshot.to_dict()
+            if if_match and any(old.get(k) != v for k, v in if_match.items()):
+                return 0
+            deltas = {}
+            _add_to_daily(deltas, old, -1)
+            _add_to_daily(deltas, {**old, **fields}, +1)
+            transaction.update(ref, fields)
+            self._write_daily(transaction, user_id, deltas)
+            return 1 + len(deltas)
+
+        writes = await update(self._db.transaction())
+        record_firestore("diary.update", reads=1, writes=writes)
+        return writes > 0
+
+    async def delete(self, user_id: str, entry_id: str):
+        ref = self.collection(user_id).document(entry_id)
+
+        @firestore.async_transactional
+        async def delete(transaction):
+            snapshot = await ref.get(transaction=transaction)
+            if not snapshot.exists:
+                return 0
+            deltas = {}
+            _add_to_daily(deltas, snapshot.to_dict(), -1)
+            transaction.delete(ref)
+            self._write_daily(transaction, user_id, deltas)
+            return 1 + len(deltas)
+
+        writes = await delete(self._db.transaction())
+        record_firestore("diary.delete", reads=1, writes=writes)
+        return writes > 0
+
+    async def daily_summaries(self, user_id: str, days: list) -> dict:
+        # Сводки за несколько дней одним запросом: {"YYYY-MM-DD": {...}}
+        refs = [self.daily_collection(user_id).document(day) for day in days]
+        summaries = {}
+        async for doc in self._db.get_all(refs):
+            if doc.exists:
+                summaries[doc.id] = doc.to_dict()
+        record_firestore("daily.get_many", reads=len(refs))
+        return summaries
+
+
+@profile_methods("foods")
+class FoodRepository:
+    """Общий для всех пользователей кэш КБЖУ блюд, которых нет в локальной
+    таблице: foods/{нормализованное название} с КБЖУ на 100 г."""
+
+    def __init__(self, db):
+        self._db = db
+
+    def collection(self):
+        return self._db.collection("foods")
+
+    async def get_many(self, keys: list) -> dict:
+        refs = [self.collection().document(key) for key in keys]
+        foods = {}
+        async for doc in self._db.get_all(refs):
+            if doc.exists:
+                foods[doc.id] = doc.to_dict()
+        record_firestore("foods.get_many", reads=len(refs))
+        return foods
+
+    async def set_many(self, foods: dict):
+        batch = self._db.batch()
+        for key, food in foods.items():
+            batch.set(self.collection().document(key), food)
+        await batch.commit()
+        record_firestore("foods.set_many", writes=len(foods))
+
+
+@profile_methods("reminders")
+class ReminderRepository:
+    """Расписания напоминаний reminders/{user_id}.
+
+    Документ: chat_id, tz_offset, reminders {вид: [минуты суток UTC]} и
+    slots — все минуты из reminders. По slots планировщик одним запросом
+    array_contains_any выбирает пользователей с напоминаниями в ближайшем окне.
+    """
+
+    def __init__(self, db):
+        self._db = db
+
+    def collection(self):
+        return self._db.collection("reminders")
+
+    async def get(self, user_id: str):
+        doc = await self.collection().document(user_id).get()
+        record_firestore("reminders.get", reads=1)
+        return doc.to_dict() if doc.exists else None
+
+    async def set(self, user_id: str, schedule: dict):
+        await self.collection().document(user_id).set(schedule)
+        record_firestore("reminders.set", writes=1)
+
+    async def delete(self, user_id: str):
+        await self.collection().document(user_id).delete()
+        record_firestore("reminders.delete", writes=1)
+
+    async def due(self, minutes: list) -> list:
+        # Не больше 30 значений в array_contains_any (ограничение Firestore)
+        query = self.collection().where("slots", "array_contains_any", minutes)
+        docs = [_to_entry(doc) async for doc in query.stream()]
+        record_firestore("reminders.due", reads=_query_reads(docs))
+        return docs
+
+
+@profile_methods("broadcasts")
+class BroadcastRepository:
+    """Рассылки broadcasts/{id}: текст, статус, курсор (последний
+    обработанный id пользователя) и счётчики — для возобновления."""
+
+    def __init__(self, db):
+        self._db = db
+
+    def collection(self):
+        return self._db.collection("broadcasts")
+
+    async def get(self, broadcast_id: str):
+        doc = await self.collection().document(broadcast_id).get()
+        record_firestore("broadcasts.get", reads=1)
+        return _to_entry(doc) if doc.exists else None
+
+    async def set(self, broadcast_id: str, fields: dict):
+        await self.collection().document(broadcast_id).set(fields, merge=True)
+        record_firestore("broadcasts.set", writes=1)
+
+    async def unfinished(self):
+        query = self.collection().where("status", "==", "running").limit(1)
+        entries = [_to_entry(doc) async for doc in query.stream()]
+        record_firestore("broadcasts.unfinished", reads=_query_reads(entries))
+        return entries[0] if entries else None
@@ -0,0 +1,63 @@
+# =========================================
+# Отправка сообщений с общим лимитом Telegram
+# =========================================
+# Telegram допускает около 30 сообщений в секунду на бота. Все фоновые
+# рассылки (напоминания и т.п.) идут через один RateLimitedSender, чтобы
+# вместе не превышать лимит и не получать 429.
+
+import asyncio
+import logging
+
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter, TelegramBadRequest
+
+from ratelimit import TokenBucket
+
+SENT = "sent"
+BLOCKED = "blocked"
+FAILED = "failed"
+
+
+class RateLimitedSender:
+    """send(chat_id, text) ждёт свободный токен и отправляет сообщение.
+
+    На TelegramRetryAfter ведро ставится на паузу (она действует на всех
+    отправителей) и отправка повторяется. Результат — SENT, BLOCKED
+    (пользователь заблокировал бота или чат не найден) или FAILED.
+    """
+
+    def __init__(self, bot, rate: float = 30, max_concurrency: int = 30, max_retries: int = 3):
+        self._bot = bot
+        self._bucket = TokenBucket(rate, capacity=rate)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_retries = max_retries
+        self.sent = 0
+        self.blocked = 0
+        self.failed = 0
+
+    async def send(self, chat_id, text: str, **kwargs) -> str:
+        async with self._semaphore:
+            for attempt in range(self.max_retries + 1):
+                await self._bucket.acquire(1)
+                try:
+                    await self._bot.send_message(chat_id, text, **kwargs)
+                except TelegramRetryAfter as e:
+                    self._bucket.pause(e.retry_after)
+                    if attempt < self.max_retries:
+                        continue
+                    logging.warning("Рассылка: чат %s, лимит Telegram не отпустил после %s попыток", chat_id, attempt + 1)
+                except TelegramForbiddenError:
+                    self.blocked += 1
+                    return BLOCKED
+                except TelegramBadRequest as e:
+                    if "chat not found" in str(e).lower():
+                        self.blocked += 1
+                        return BLOCKED
+                    logging.warning("Рассылка: чат %s, %s", chat_id, e)
+                except Exception:
+                    logging.exception("Рассылка: не удалось отправить сообщение в чат %s", chat_id)
+                else:
+                    self.sent += 1
+                    return SENT
+                break
+            self.failed += 1
+            return FAILED
@@ -0,0 +1,93 @@
+# =========================================
+# Ленивая инициализация тяжёлых клиентов (Firestore, OpenAI)
+# =========================================
+# Импорт google.cloud.firestore и openai и создание клиентов занимают
+# заметную часть холодного старта. Модули бота получают заместители:
+# клиент создаётся при первом обращении или заранее в фоновом потоке
+# (warm_up) уже после того, как бот начал принимать апдейты.
+
+import asyncio
+import importlib
+import json
+import logging
+import os
+import threading
+
+
+class LazyModule:
+    """Модуль импортируется при первом обращении к его атрибуту."""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+class LazyService:
+    """Заместитель клиента: factory() вызывается один раз, при первом
+    обращении к атрибуту или в warm_up(); атрибуты проксируются клиенту."""
+
+    def __init__(self, name: str, factory):
+        self._name = name
+        self._factory = factory
+        self._instance = None
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self._instance is not None
+
+    def set(self, instance):
+        # Готовый клиент вместо factory (нагрузочные тесты, эмуляторы)
+        with self._lock:
+            self._instance = instance
+
+    def get(self):
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    self._instance = self._factory()
+                    logging.info("%s: клиент инициализирован", self._name)
+        return self._instance
+
+    async def warm_up(self):
+        try:
+            await asyncio.to_thread(self.get)
+        except Exception:
+            # Не удалось заранее — повторим при первом обращении и покажем ошибку там
+            logging.exception("%s: не удалось инициализировать клиент заранее", self._name)
+
+    def __getattr__(self, attr):
+        return getattr(self.get(), attr)
+
+
+def firebase_credentials(credentials_json: str = None):
+    from firebase_admin import credentials
+
+    if credentials_json:
+        # Ключ сервисного аккаунта прямо из переменной окружения, без временного файла
+        return credentials.Certificate(json.loads(credentials_json))
+    if os.path.exists("firebase.json"):
+        return credentials.Certificate("firebase.json")
+    logging.warning("FIREBASE_CREDENTIALS не задана, используются учётные данные окружения по умолчанию")
+    return credentials.ApplicationDefault()
+
+
+def create_firestore_client(credentials_json: str = None):
+    import firebase_admin
+    from firebase_admin import firestore_async
+
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app(firebase_credentials(credentials_json))
+    return firestore_async.client()
+
+
+def create_openai_client(api_key: str, timeout: float):
+    from openai import AsyncOpenAI
+
+    # Повторы делает LLMScheduler, встроенные повторы клиента отключены
+    return AsyncOpenAI(api_key=api_key, timeout=timeout, max_retries=0)
@@ -0,0 +1,151 @@
+# =========================================
+# Потоковая отправка ответа GPT с редактированием сообщения
+# =========================================
+
+import asyncio
+import logging
+import time
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import MessageEntity
+
+from formatting import TELEGRAM_MAX_LENGTH, MarkdownRenderer, render_chunks, split_spans, telegram_entities
+
+
+def message_entities(rendered) -> list:
+    return [MessageEntity(**entity) for entity in telegram_entities(rendered)]
+
+
+async def send_rendered(bot, chat_id, rendered, **kwargs):
+    # parse_mode=None: разметка уже в entities, Telegram текст не разбирает
+    return await bot.send_message(
+        chat_id, rendered.text, entities=message_entities(rendered), parse_mode=None, **kwargs
+    )
+
+
+async def send_markdown(bot, chat_id, text: str, max_length: int = TELEGRAM_MAX_LENGTH):
+    """Ответ GPT с Markdown — одним или несколькими сообщениями."""
+    for part in render_chunks(text, max_length):
+        await send_rendered(bot, chat_id, part)
+
+
+class StreamingReply:
+    """Показывает ответ по мере генерации.
+
+    Первое сообщение отправляется сразу с первым фрагментом, дальше оно
+    редактируется не чаще раза в edit_interval секунд (лимиты Telegram на
+    edit_message_text). Разметка рендерится в entities по ходу потока
+    (MarkdownRenderer), так что и промежуточные правки идут с ней. Когда
+    текст перерастает max_length, готовая часть остаётся в текущем
+    сообщении, а продолжение уходит новым.
+    """
+
+    def __init__(self, bot, chat_id, edit_interval: float = 1.0, max_length: int = TELEGRAM_MAX_LENGTH):
+        self._bot = bot
+        self._chat_id = chat_id
+        self.edit_interval = edit_interval
+        self.max_length = max_length
+        self._chunks = []
+        self._renderer = MarkdownRenderer()
+        # Начало текущего сообщения в отрендеренном тексте
+        self._base = 0
+        self._message_id = None
+        self._shown = None
+        self._last_edit = 0.0
+
+    @property
+    def text(self) -> str:
+        return "".join(self._chunks)
+
+    async def feed(self, delta: str):
+        if not delta:
+            return
+        self._chunks.append(delta)
+        self._renderer.feed(delta)
+        if self._message_id is not None and time.monotonic() - self._last_edit < self.edit_interval:
+            return
+        rendered = self._renderer.snapshot()
+        spans = split_spans(rendered.slice(self._base), self.max_length)
+        if len(spans) > 1:
+            rendered = await self._rollover(rendered)
+            spans = split_spans(rendered.slice(self._base), self.max_length)
+        if not spans:
+            return
+        start, end = spans[0]
+        part = rendered.slice(self._base + start, self._base + end)
+        if self._message_id is None:
+            message = await send_rendered(self._bot, self._chat_id, part)
+            self._message_id = message.message_id
+            self._shown = part
+            self._last_edit = time.monotonic()
+        else:
+            await self._edit(part)
+
+    async def finish(self) -> str:
+        rendered = self._renderer.close()
+        spans = split_spans(rendered.slice(self._base), self.max_length)
+        for index, (start, end) in enumerate(spans):
+            if index:
+                self._message_id = None
+            await self._finalize(rendered.slice(self._base + start, self._base + end))
+        return self.text
+
+    async def _rollover(self, rendered):
+        # Отправленные части больше не меняются, поэтому уходят только завершённые строки.
+        # Если их набралось меньше половины сообщения (идёт очень длинная строка),
+        # незавершённая строка фиксируется как есть
+        committed = self._renderer.committed_length
+        if committed - self._base < self.max_length // 2:
+            self._renderer.commit_partial()
+            rendered = self._renderer.snapshot()
+            committed = self._renderer.committed_length
+        spans = split_spans(rendered.slice(self._base, committed), self.max_length)
+        # Из нескольких частей последняя остаётся текущим сообщением и дополняется дальше
+        if len(spans) > 1:
+            done, base = spans[:-1], self._base + spans[-1][0]
+        else:
+            done, base = spans, committed
+        for start, end in done:
+            await self._finalize(rendered.slice(self._base + start, self._base + end))
+            self._message_id = None
+            self._shown = None
+        self._base = base
+        return rendered
+
+    async def _finalize(self, part):
+        if self._message_id is None:
+            message = await send_rendered(self._bot, self._chat_id, part)
+            self._message_id = message.message_id
+            self._shown = part
+            return
+        if part == self._shown:
+            return
+        try:
+            await self._bot.edit_message_text(
+                part.text, chat_id=self._chat_id, message_id=self._message_id,
+                entities=message_entities(part), parse_mode=None,
+            )
+        except TelegramRetryAfter as e:
+            # Финальную версию терять нельзя — ждём и повторяем
+            await asyncio.sleep(e.retry_after)
+            await self._finalize(part)
+        except TelegramBadRequest as e:
+            logging.warning("Не удалось обновить сообщение: %s", e)
+        else:
+            self._shown = part
+
+    async def _edit(self, part):
+        if part == self._shown:
+            return
+        try:
+            await self._bot.edit_message_text(
+                part.text, chat_id=self._chat_id, message_id=self._message_id,
+                entities=message_entities(part), parse_mode=None,
+            )
+        except TelegramRetryAfter as e:
+            logging.info("Telegram просит подождать %s с перед правкой сообщения", e.retry_after)
+        except TelegramBadRequest as e:
+            logging.warning("Не удалось обновить сообщение: %s", e)
+        else:
+            self._shown = part
+        self._last_edit = time.monotonic()
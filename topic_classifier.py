@@ -0,0 +1,159 @@
+# =========================================
+# Локальный классификатор темы сообщения (фитнес / не фитнес)
+# =========================================
+# Линейная модель (логистическая регрессия) на хэшированных символьных
+# n-граммах. Работает на CPU за доли миллисекунды и обучается на решениях,
+# которые раньше принимал GPT (журнал DecisionLog).
+#
+# Обучение:
+#   python topic_classifier.py train decisions.jsonl topic_model.npz
+
+import json
+import logging
+import os
+import re
+import sys
+import zlib
+from datetime import datetime
+
+import numpy as np
+
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    return _SPACES.sub(" ", text.lower().replace("ё", "е")).strip()
+
+
+class CharNgramClassifier:
+    """Логистическая регрессия на символьных n-граммах (hashing trick).
+
+    Признаки — символьные n-граммы (длины из ngram_range) текста с пробелами
+    по краям, хэшированные crc32 в n_features корзин и нормированные по L2.
+    """
+
+    def __init__(self, n_features: int = 2 ** 18, ngram_range=(2, 4)):
+        self.n_features = n_features
+        self.ngram_range = ngram_range
+        self.weights = np.zeros(n_features, dtype=np.float32)
+        self.bias = 0.0
+
+    def features(self, text: str):
+        padded = f" {normalize_text(text)} "
+        counts = {}
+        low, high = self.ngram_range
+        for n in range(low, high + 1):
+            for i in range(len(padded) - n + 1):
+                index = zlib.crc32(padded[i:i + n].encode("utf-8")) % self.n_features
+                counts[index] = counts.get(index, 0) + 1
+        if not counts:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        indices = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        values = np.log1p(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+        values /= np.linalg.norm(values)
+        return indices, values
+
+    def predict_proba(self, text: str) -> float:
+        indices, values = self.features(text)
+        score = float(np.dot(self.weights[indices], values)) + self.bias
+        return float(1.0 / (1.0 + np.exp(-score)))
+
+    def fit(self, texts, labels, epochs: int = 10, learning_rate: float = 0.5, l2: float = 1e-6, seed: int = 0):
+        samples = [self.features(text) for text in texts]
+        targets = np.asarray(labels, dtype=np.float32)
+        rng = np.random.default_rng(seed)
+        for _ in range(epochs):
+            for i in rng.permutation(len(samples)):
+                indices, values = samples[i]
+                score = float(np.dot(self.weights[indices], values)) + self.bias
+                grad = 1.0 / (1.0 + np.exp(-score)) - targets[i]
+                self.weights[indices] -= learning_rate * (grad * values + l2 * self.weights[indices])
+                self.bias -= learning_rate * grad
+        return self
+
+    def save(self, path: str):
+        np.savez_compressed(
+            path,
+            weights=self.weights,
+            bias=np.float32(self.bias),
+            n_features=self.n_features,
+            ngram_range=np.asarray(self.ngram_range),
+        )
+
+    @classmethod
+    def load(cls, path: str):
+        data = np.load(path)
+        model = cls(n_features=int(data["n_features"]), ngram_range=tuple(int(n) for n in data["ngram_range"]))
+        model.weights = data["weights"].astype(np.float32)
+        model.bias = float(data["bias"])
+        return model
+
+
+class LocalTopicStage:
+    """Этап фильтра перед GPT: уверенные предсказания модели принимаются
+    сразу, неоднозначные (между порогами) возвращают None — спросить GPT."""
+
+    def __init__(self, model, threshold: float = 0.85):
+        self.model = model
+        self.threshold = threshold
+
+    def decide(self, text: str):
+        proba = self.model.predict_proba(text)
+        if proba >= self.threshold:
+            return True
+        if proba <= 1.0 - self.threshold:
+            return False
+        return None
+
+
+class DecisionLog:
+    """Журнал решений фильтра темы в JSONL — обучающая выборка для модели."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def write(self, text: str, label: bool, source: str):
+        record = {"text": text, "label": int(label), "source": source, "ts": datetime.now().isoformat()}
+        try:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        except OSError:
+            logging.exception("Не удалось записать решение классификатора в %s", self.path)
+
+
+def load_decisions(path: str):
+    texts, labels = [], []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            texts.append(record["text"])
+            labels.append(int(record["label"]))
+    return texts, labels
+
+
+def load_stage(path: str, threshold: float):
+    # Модель необязательна: без файла этап просто пропускается
+    if not path or not os.path.exists(path):
+        return None
+    logging.info("Загружаю локальный классификатор темы из %s", path)
+    return LocalTopicStage(CharNgramClassifier.load(path), threshold=threshold)
+
+
+def main(argv):
+    if len(argv) < 3 or argv[0] != "train":
+        print("Использование: python topic_classifier.py train decisions.jsonl topic_model.npz [epochs]")
+        return 1
+    texts, labels = load_decisions(argv[1])
+    epochs = int(argv[3]) if len(argv) > 3 else 10
+    model = CharNgramClassifier().fit(texts, labels, epochs=epochs)
+    correct = sum((model.predict_proba(t) >= 0.5) == bool(y) for t, y in zip(texts, labels))
+    print(f"Обучено на {len(texts)} примерах, точность на обучающей выборке: {correct / max(len(texts), 1):.3f}")
+    model.save(argv[2])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
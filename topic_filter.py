@@ -0,0 +1,91 @@
+# =========================================
+# Быстрый фильтр темы по ключевым словам и регуляркам
+# =========================================
+# Все списки собраны при импорте в одно регулярное выражение: текст
+# переводится в нижний регистр один раз и просматривается за один проход,
+# а результатом сразу становится категория совпадения.
+
+import re
+
+BLACKLIST = [
+    "политика", "финансы", "экономика", "инвестиции", "бизнес", "коррупция",
+    "расизм", "религия", "война", "конфликт", "скандал", "новости", "забастовка",
+    "кино", "игры", "секс", "шоу", "телевидение", "мем", "юмор",
+    "кредит", "банки", "инфляция", "акции", "инвестиционный", "трейдинг"
+]
+
+WHITELIST = [
+    "привет", "здравствуйте", "добрый день", "доброе утро", "хай", "приветствую",
+    "как дела", "спасибо",
+    "фитнес", "тренировка", "упражнения", "бег", "кардио", "силовые", "плавание",
+    "йога", "стретчинг", "физкультура", "спорт", "здоровье", "диета", "питание",
+    "мотивация", "прогресс", "результат", "расписание", "план",
+    "физическая активность", "тренир", "кроссфит", "силовые тренировки"
+]
+
+HEALTH_PATTERNS = [
+    r"\bне могу\b", r"\bиз-за\b", r"\bболит\b", r"\bболь\b",
+    r"\bограничен\b", r"\bнет возможности\b", r"\bпроблемы со\b", r"\bс травмой\b"
+]
+
+TOPIC_PATTERNS = [
+    r"\bфитнес\w*", r"\bтрениров\w*", r"\bтренир\w*", r"\bупражн\w*",
+    r"\bфизкульт\w*", r"\bспорт\w*", r"\bсил\w*", r"\bпресс\w*",
+    r"\bягодиц\w*", r"\bрастяжк\w*", r"\bвыносливост\w*",
+    r"\bдиет\w*", r"\bпитан\w*", r"\bкалор\w*", r"\bбелк\w*",
+    r"\bовощ\w*", r"\bфрукт\w*", r"\bменю\w*", r"\bрецепт\w*",
+    r"\bчипс\w*", r"\bснэк\w*", r"\bфастфуд\w*", r"\bбургер\w*", r"\bгамбургер\w*",
+    r"\bшаурм\w*", r"\bдонер\w*", r"\bкартофел[ьья]\s?фри", r"\bфри\b",
+    r"\bмайонез\w*", r"\bкетчуп\w*", r"\bсоус\w*", r"\bнаггетс\w*",
+    r"\bпицц\w*", r"\bролл\w*", r"\bсуши\w*", r"\bхотдог\w*",
+    r"\bсэндвич\w*", r"\bбутерброд\w*", r"\bджанкфуд\w*", r"\bjunk food\b",
+    r"\bгазиров\w*", r"\bкол\w*", r"\bпепси\w*", r"\bспрайт\w*",
+    r"\bэнергетик\w*", r"\bалкогол\w*", r"\bпиво\w*", r"\bвино\w*", r"\bспиртн\w*",
+    r"\bсухар\w*", r"\bшоколад\w*", r"\bконфет\w*", r"\bторт\w*", r"\bпирож\w*", r"\bвыпеч\w*",
+    r"\bмакарон\w*", r"\bпаста\w*", r"\bбулк\w*", r"\bхлеб\w*", r"\bбатон\w*"
+]
+
+# Категории в порядке приоритета: чёрный список перекрывает всё остальное
+BLACKLIST_MATCH = "blacklist"
+WHITELIST_MATCH = "whitelist"
+HEALTH_MATCH = "health"
+TOPIC_MATCH = "topic"
+CATEGORIES = (BLACKLIST_MATCH, WHITELIST_MATCH, HEALTH_MATCH, TOPIC_MATCH)
+
+
+def _literals(words):
+    # Длинные слова раньше коротких, чтобы альтернатива не обрывалась на префиксе
+    return "|".join(re.escape(word) for word in sorted(words, key=len, reverse=True))
+
+
+class TopicMatcher:
+    """Один проход по тексту -> категория первого по приоритету совпадения.
+
+    Группы собраны в просмотр вперёд (?=...), поэтому совпадения не
+    «съедают» текст и проверяются в каждой позиции: в одной позиции
+    побеждает группа с большим приоритетом, по всему тексту — тоже.
+    """
+
+    def __init__(self, blacklist=BLACKLIST, whitelist=WHITELIST, health=HEALTH_PATTERNS, topic=TOPIC_PATTERNS):
+        groups = {
+            BLACKLIST_MATCH: _literals(blacklist),
+            WHITELIST_MATCH: _literals(whitelist),
+            HEALTH_MATCH: "|".join(health),
+            TOPIC_MATCH: "|".join(topic),
+        }
+        alternatives = "|".join(f"(?P<{name}>{groups[name]})" for name in CATEGORIES)
+        self._pattern = re.compile(f"(?=(?:{alternatives}))")
+        self._priority = {name: i for i, name in enumerate(CATEGORIES)}
+
+    def match(self, text: str):
+        best = None
+        for m in self._pattern.finditer(text.lower()):
+            category = m.lastgroup
+            if category == BLACKLIST_MATCH:
+                return category
+            if best is None or self._priority[category] < self._priority[best]:
+                best = category
+        return best
+
+
+topic_matcher = TopicMatcher()
@@ -0,0 +1,31 @@
+# =========================================
+# Режим webhook: aiohttp-приложение для приёма апдейтов
+# =========================================
+
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+
+async def health(request: web.Request) -> web.Response:
+    return web.json_response({"status": "ok"})
+
+
+def metrics_handler(metrics):
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+    return handle
+
+
+def create_app(dp, bot, path: str, secret: str = None, metrics=None) -> web.Application:
+    app = web.Application()
+    app.router.add_get("/health", health)
+    if metrics is not None:
+        # Метрики в текстовом формате Prometheus
+        app.router.add_get("/metrics", metrics_handler(metrics))
+    # startup/shutdown диспетчера вызываются вместе с запуском и остановкой приложения.
+    # Регистрируем раньше обработчика запросов: при остановке апдейты должны
+    # доработать до того, как он закроет сессию бота.
+    setup_application(app, dp, bot=bot)
+    # Отвечаем Telegram сразу, апдейт обрабатывается в фоне (с лимитом ConcurrencyLimitMiddleware)
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret).register(app, path=path)
+    return app